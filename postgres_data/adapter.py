@@ -1,6 +1,13 @@
+import base64
+import datetime
+import json
 import logging
-from typing import List, Dict, Optional, Any, cast, Union
-from sqlalchemy import select, text
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union, cast
+from sqlalchemy import delete, select, text, func, case, literal_column, or_, tuple_, union_all, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import aliased
 
 from .db_session import AsyncSessionLocal
 from .models import ExampleRelation
@@ -30,6 +37,21 @@ class UserNotFoundError(AdapterError):
 class PostNotFoundError(AdapterError):
     pass
 
+
+class InvalidCursorError(AdapterError):
+    """分页游标无法解析（被篡改或来自旧版本），接口层应返回 400"""
+    pass
+
+
+class InvalidCredentialsError(AdapterError):
+    """登录校验未通过，接口层应返回 401"""
+    pass
+
+
+class UserAlreadyOnlineError(AdapterError):
+    """用户已在线，登录被拒绝，接口层应返回 403"""
+    pass
+
 # 模块级同步 engine/session 单例，避免每次调用都创建连接池
 _SYNC_ENGINE = None
 _SYNC_SessionFactory = None
@@ -76,6 +98,104 @@ def _is_loop_incompat_error(exc: Exception) -> bool:
     return False
 
 
+# 启动时幂等执行的增量 DDL。`create_all` 只会创建缺失的表，不会为已存在的表补建索引/列，
+# 因此已有库的结构演进统一登记在这里（每条语句必须可重复执行）。
+_SCHEMA_UPGRADES: List[str] = [
+    # /get_posts 分页：按板块过滤 + (created_at, id) 键集排序
+    "CREATE INDEX IF NOT EXISTS ix_posts_section_created_at_id ON posts (section, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_posts_created_at_id ON posts (created_at, id)",
+    # 帖子搜索：pg_trgm GIN 索引可加速 ILIKE '%关键词%'（需要数据库以 UTF-8 locale 初始化，
+    # 中文字符才会被当作词字符参与三元组；少于 3 个字符的查询无法利用索引，退化为重检扫描）
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_posts_title_trgm ON posts USING gin (title gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_posts_content_trgm ON posts USING gin (content gin_trgm_ops)",
+    # 帖子反范式计数（历史 comment_count 由 scripts/backfill_post_counters.py 一次性回填）
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS comment_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS last_activity_at TIMESTAMPTZ",
+    "ALTER TABLE posts ALTER COLUMN last_activity_at SET DEFAULT now()",
+    "CREATE INDEX IF NOT EXISTS ix_posts_comment_count_created_at_id ON posts (comment_count, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_posts_last_activity_at_id ON posts (last_activity_at, id)",
+    # 新加的列对已有帖子为 NULL，而 DESC 排序把 NULL 排在最前：按最后一条评论（无评论取发帖时间）补齐。
+    # 之后 IS NULL 只走上面的索引，重复执行不会扫表
+    "UPDATE posts SET last_activity_at = COALESCE((SELECT max(c.created_at) FROM comments c WHERE c.post_id = posts.id), posts.created_at) WHERE last_activity_at IS NULL",
+    # 评论按帖子批量加载 / 热度引擎按时间窗口预热
+    "CREATE INDEX IF NOT EXISTS ix_comments_post_id_id ON comments (post_id, id)",
+    "CREATE INDEX IF NOT EXISTS ix_comments_created_at ON comments (created_at)",
+    # 私信 / 群消息历史的键集分页
+    "CREATE INDEX IF NOT EXISTS ix_personal_messages_pair_created_id ON personal_messages (sender, receiver, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_group_messages_group_created_id ON group_messages (group_name, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_personal_messages_receiver_created_id ON personal_messages (receiver, created_at, id)",
+    # 消息幂等写入：客户端消息 id 在发送方（群消息为群 + 发送方）范围内唯一，
+    # INSERT ... ON CONFLICT (sender, client_msg_id) DO NOTHING（旧数据为 NULL，不冲突）
+    "ALTER TABLE personal_messages ADD COLUMN IF NOT EXISTS client_msg_id VARCHAR(64)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_personal_messages_sender_client_msg_id ON personal_messages (sender, client_msg_id)",
+    "DROP INDEX IF EXISTS ux_personal_messages_client_msg_id",
+    "ALTER TABLE group_messages ADD COLUMN IF NOT EXISTS client_msg_id VARCHAR(64)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_group_messages_group_sender_client_msg_id ON group_messages (group_name, sender, client_msg_id)",
+    "DROP INDEX IF EXISTS ux_group_messages_client_msg_id",
+]
+
+
+# pg_trgm 是否可用：`CREATE EXTENSION` 可能因权限不足（托管 PG、非超级用户）失败，
+# 启动时由 `detect_pg_trgm()` 按 pg_extension 校正；不可用时搜索不使用 similarity() 排序
+_PG_TRGM_AVAILABLE = True
+
+
+async def detect_pg_trgm() -> bool:
+    """查询 pg_extension 判断 pg_trgm 是否已安装，并据此设置搜索的排序方式。查询失败按不可用处理。"""
+    global _PG_TRGM_AVAILABLE
+    try:
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"))
+            _PG_TRGM_AVAILABLE = res.first() is not None
+    except Exception as exc:
+        logger.warning("检查 pg_trgm 扩展失败，搜索退化为 ILIKE 排序: %s", exc)
+        _PG_TRGM_AVAILABLE = False
+    if not _PG_TRGM_AVAILABLE:
+        logger.warning("pg_trgm 扩展不可用：帖子搜索不按相似度排序，且无法使用三元组索引")
+    return _PG_TRGM_AVAILABLE
+
+
+async def ensure_schema_upgrades() -> int:
+    """逐条执行 `_SCHEMA_UPGRADES`，每条独立事务，失败只记录日志不阻断启动。返回成功条数。
+
+    执行完后检查 pg_trgm 是否可用（见 `detect_pg_trgm`）。
+    """
+    applied = 0
+    for ddl in _SCHEMA_UPGRADES:
+        try:
+            async with AsyncSessionLocal() as session:
+                async with session.begin():
+                    await session.execute(text(ddl))
+            applied += 1
+        except Exception as exc:
+            logger.warning("执行结构升级语句失败（已跳过）: %s; error=%s", ddl, exc)
+    await detect_pg_trgm()
+    return applied
+
+
+def _encode_cursor(*parts: Any) -> str:
+    """把键集分页的位置编码为不透明字符串（base64url(JSON)），datetime 以 ISO 格式保存。"""
+    vals = [p.isoformat() if isinstance(p, datetime.datetime) else p for p in parts]
+    raw = json.dumps(vals, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode_post_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        ts, post_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return datetime.datetime.fromisoformat(ts), int(post_id)
+    except Exception as exc:
+        raise InvalidCursorError(f"无效的分页游标: {cursor!r}") from exc
+
+
+def _like_pattern(keyword: str) -> str:
+    """构造 ILIKE 子串匹配模式，转义用户输入中的通配符。"""
+    escaped = keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
 async def fetch_relations_rows() -> List[Dict[str, str]]:
     """从数据库中读取 example_relation 表，返回与旧 Excel 相同的字典列表格式。
 
@@ -103,6 +223,71 @@ async def fetch_relations_rows() -> List[Dict[str, str]]:
         raise DatabaseError(exc) from exc
 
 
+async def fetch_keyword_facets() -> List[Dict[str, Any]]:
+    """在数据库内聚合 example_relation 的关键词分面：去重关键词及其案例数。
+
+    三个关键词列经 UNION ALL 展开后 GROUP BY，只把聚合结果传回应用；
+    返回按案例数降序、关键词升序排列的 [{'keyword': str, 'count': int}]。
+    """
+    try:
+        from .models import ExampleRelation
+
+        cols = (ExampleRelation.keyword1, ExampleRelation.keyword2, ExampleRelation.keyword3)
+        expanded = union_all(*[
+            select(ExampleRelation.id.label('case_id'), func.trim(col).label('kw')) for col in cols
+        ]).subquery()
+        cnt = func.count(expanded.c.case_id.distinct())
+        stmt = (
+            select(expanded.c.kw, cnt.label('cnt'))
+            .where(expanded.c.kw.is_not(None), expanded.c.kw != '')
+            .group_by(expanded.c.kw)
+            .order_by(literal_column('cnt').desc(), expanded.c.kw)
+        )
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(stmt)).all()
+        return [{'keyword': str(kw), 'count': int(n)} for kw, n in rows]
+    except Exception as exc:
+        logger.exception("聚合关键词分面失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
+_BUMP_DATA_VERSION_SQL = (
+    "INSERT INTO data_versions (name, version, updated_at) VALUES (:name, 1, CURRENT_TIMESTAMP) "
+    "ON CONFLICT (name) DO UPDATE SET version = data_versions.version + 1, updated_at = CURRENT_TIMESTAMP"
+)
+
+
+async def get_data_version(name: str) -> int:
+    """读取参考数据版本号；从未写入过时返回 0。"""
+    try:
+        from .models import DataVersion
+
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(select(DataVersion.version).where(DataVersion.name == name))
+            v = res.scalar_one_or_none()
+        return int(v or 0)
+    except Exception as exc:
+        logger.exception("读取 data version 失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
+async def bump_data_version(name: str, session=None) -> None:
+    """递增参考数据版本号，使各服务进程的相关缓存失效。
+
+    传入 `session` 时在调用方事务内执行（与数据写入一起提交），否则使用独立事务。
+    """
+    try:
+        if session is not None:
+            await session.execute(text(_BUMP_DATA_VERSION_SQL), {'name': name})
+            return
+        async with AsyncSessionLocal() as s:
+            async with s.begin():
+                await s.execute(text(_BUMP_DATA_VERSION_SQL), {'name': name})
+    except Exception as exc:
+        logger.exception("递增 data version 失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
 async def fetch_example_legal_rows() -> List[Dict[str, str]]:
     """读取 example_legal 表，返回与 `_load_excel_rows` 相同结构的字典列表：
     每项包含 'region','url','name'。
@@ -135,58 +320,227 @@ def _format_dt(dt) -> str:
         return str(dt)
 
 
+# 单条语句中 IN 列表的最大长度；asyncpg 对单条语句的绑定参数有 32767 的上限
+_POST_ID_CHUNK = 5000
+
+
+def _comment_to_dict(c) -> Dict:
+    return {
+        'id': c.id,
+        'post_id': c.post_id,
+        'author': c.author_name,
+        'content': c.content,
+        'time': _format_dt(c.created_at),
+    }
+
+
+def _post_to_dict(p, author_name: Optional[str], comments_list: List[Dict]) -> Dict:
+    return {
+        'id': getattr(p, 'id', None),
+        'author': author_name,
+        'title': str(getattr(p, 'title', '') or ''),
+        'content': str(getattr(p, 'content', '') or ''),
+        'section': str(getattr(p, 'section', '') or ''),
+        'time': _format_dt(getattr(p, 'created_at', None)),
+        'comment_count': int(getattr(p, 'comment_count', 0) or 0),
+        'last_activity': _format_dt(getattr(p, 'last_activity_at', None)),
+        'comments': comments_list,
+    }
+
+
+def _posts_with_author_select():
+    """帖子与作者用户名一次性 LEFT JOIN 查询，替代逐帖查询 users。"""
+    from .models import Post, User
+    return select(Post, User.username).outerjoin(User, User.id == Post.author_id)
+
+
+def _comments_select(post_ids: List[int]):
+    from .models import Comment
+    return select(Comment).where(Comment.post_id.in_(post_ids)).order_by(Comment.post_id, Comment.id)
+
+
+def _chunks(ids: List[int], size: int = _POST_ID_CHUNK):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def _assemble_posts(post_rows, comments) -> List[Dict]:
+    """把 (Post, username) 行与批量查询到的评论按 post_id 组装为 `Post.to_dict()` 结构，保持帖子原有顺序。"""
+    by_post: Dict[Any, List[Dict]] = {}
+    for c in comments:
+        by_post.setdefault(c.post_id, []).append(_comment_to_dict(c))
+    return [_post_to_dict(p, author_name, by_post.get(p.id, [])) for p, author_name in post_rows]
+
+
+async def _attach_comments(session, post_rows) -> List[Dict]:
+    post_ids = [p.id for p, _ in post_rows]
+    comments: List[Any] = []
+    for chunk in _chunks(post_ids):
+        res = await session.execute(_comments_select(chunk))
+        comments.extend(res.scalars().all())
+    return _assemble_posts(post_rows, comments)
+
+
+async def _load_posts(session, stmt) -> List[Dict]:
+    """执行帖子查询并批量加载评论：帖子+作者 1 条语句，评论按 IN 批量 1 条语句（超大结果集按块拆分）。"""
+    post_rows = (await session.execute(stmt)).all()
+    return await _attach_comments(session, post_rows)
+
+
 async def fetch_posts_rows(section: Optional[str] = None) -> List[Dict]:
-    """读取 posts 及其评论，返回与 `Post.to_dict()` 类似的字典列表。"""
+    """读取 posts 及其评论，返回与 `Post.to_dict()` 类似的字典列表。
+
+    作者通过 JOIN 一并取出，评论按帖子 id 批量加载，整体为 2 条语句而非 1+2N。
+    """
     try:
-        from .models import Post, Comment, User
+        from .models import Post
 
+        stmt = _posts_with_author_select()
+        if section is not None:
+            stmt = stmt.where(Post.section == section)
         async with AsyncSessionLocal() as session:
-            if section is not None:
-                result = await session.execute(select(Post).where(Post.section == section))
-            else:
-                result = await session.execute(select(Post))
-            posts = result.scalars().all()
-            out: List[Dict] = []
-            for p in posts:
-                # 获取评论
-                comments_q = await session.execute(select(Comment).where(Comment.post_id == p.id))
-                comments = comments_q.scalars().all()
-                comments_list = []
-                for c in comments:
-                    comments_list.append({
-                        'id': c.id,
-                        'post_id': c.post_id,
-                        'author': c.author_name,
-                        'content': c.content,
-                        'time': _format_dt(c.created_at),
-                    })
-
-                # 作者用户名（若可关联）
-                author_name = None
-                try:
-                    if getattr(p, 'author_id', None) is not None:
-                        user_q = await session.execute(select(User).where(User.id == getattr(p, 'author_id')))
-                        u = user_q.scalars().first()
-                        if u:
-                            author_name = getattr(u, 'username', None)
-                except Exception:
-                    author_name = None
-
-                out.append({
-                    'id': getattr(p, 'id', None),
-                    'author': author_name,
-                    'title': str(getattr(p, 'title', '') or ''),
-                    'content': str(getattr(p, 'content', '') or ''),
-                    'section': str(getattr(p, 'section', '') or ''),
-                    'time': _format_dt(getattr(p, 'created_at', None)),
-                    'comments': comments_list,
-                })
-            return out
+            return await _load_posts(session, stmt)
     except Exception as exc:
         logger.exception("从数据库读取 posts 失败: %s", exc)
         raise DatabaseError(exc) from exc
 
 
+async def fetch_posts_page(section: Optional[str] = None, keyword: Optional[str] = None, limit: int = 20, cursor: Optional[str] = None) -> Dict[str, Any]:
+    """按 (created_at, id) 倒序的键集分页读取帖子。
+
+    板块过滤、关键词匹配、排序与分页边界全部在 SQL 中完成，命中
+    `ix_posts_section_created_at_id` 索引；每页只取 limit+1 行用于判断是否还有下一页。
+    返回 {'posts': [...], 'next_cursor': str|None}；游标无法解析时抛出 InvalidCursorError。
+    """
+    from .models import Post
+
+    stmt = _posts_with_author_select()
+    if section:
+        stmt = stmt.where(Post.section == section)
+    if keyword:
+        pattern = _like_pattern(keyword.strip())
+        stmt = stmt.where(or_(Post.title.ilike(pattern, escape='\\'), Post.content.ilike(pattern, escape='\\')))
+    if cursor:
+        c_ts, c_id = _decode_post_cursor(cursor)
+        stmt = stmt.where(tuple_(Post.created_at, Post.id) < tuple_(c_ts, c_id))
+    stmt = stmt.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit + 1)
+
+    try:
+        async with AsyncSessionLocal() as session:
+            post_rows = (await session.execute(stmt)).all()
+            has_more = len(post_rows) > limit
+            post_rows = post_rows[:limit]
+            posts = await _attach_comments(session, post_rows)
+    except Exception as exc:
+        logger.exception("分页读取 posts 失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+    next_cursor = None
+    if has_more and post_rows:
+        last = post_rows[-1][0]
+        next_cursor = _encode_cursor(last.created_at, last.id)
+    return {'posts': posts, 'next_cursor': next_cursor}
+
+
+async def search_posts(keyword: str, limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+    """在 title/content 上做子串搜索（由 pg_trgm GIN 索引加速），按相关度排序分页返回。
+
+    排序：标题命中优先，其次按标题与关键词的三元组相似度（pg_trgm 不可用时跳过），最后按发帖时间倒序。
+    只有命中的行会被传回应用；返回 {'posts': [...], 'total': int}。
+    """
+    from .models import Post
+
+    k = (keyword or '').strip()
+    if not k:
+        return {'posts': [], 'total': 0}
+    pattern = _like_pattern(k)
+    title_hit = Post.title.ilike(pattern, escape='\\')
+    matched = or_(title_hit, Post.content.ilike(pattern, escape='\\'))
+    rank = case((title_hit, 1.0), else_=0.0)
+    if _PG_TRGM_AVAILABLE:
+        rank = rank + func.similarity(Post.title, k)
+
+    stmt = (
+        _posts_with_author_select()
+        .where(matched)
+        .order_by(rank.desc(), Post.created_at.desc(), Post.id.desc())
+        .limit(limit)
+        .offset(offset)
+    )
+    try:
+        async with AsyncSessionLocal() as session:
+            total = int((await session.execute(select(func.count()).select_from(Post).where(matched))).scalar_one())
+            posts = await _load_posts(session, stmt) if total > offset else []
+        return {'posts': posts, 'total': total}
+    except Exception as exc:
+        logger.exception("搜索 posts 失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
+async def fetch_hot_posts(limit: int = 8, order: str = 'hot') -> List[Dict]:
+    """按反范式计数读取热帖（order='hot'：评论数、发帖时间倒序）或最近活跃帖（order='active'：
+    最后活动时间倒序）。均为带索引的 ORDER BY ... LIMIT，不再聚合全部评论。
+    """
+    from .models import Post
+
+    if order == 'active':
+        # 不加 NULLS LAST：DESC 默认 NULLS FIRST，正好是 (last_activity_at, id) 索引的反向扫描顺序，
+        # 无需额外排序；该列有默认值 now()，已有帖子由 _SCHEMA_UPGRADES 在启动时补齐，不会为 NULL
+        ordering = (Post.last_activity_at.desc(), Post.id.desc())
+    else:
+        ordering = (Post.comment_count.desc(), Post.created_at.desc(), Post.id.desc())
+    try:
+        async with AsyncSessionLocal() as session:
+            return await _load_posts(session, _posts_with_author_select().order_by(*ordering).limit(limit))
+    except Exception as exc:
+        logger.exception("读取热帖失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
+async def fetch_posts_by_ids(post_ids: List[int]) -> List[Dict]:
+    """按给定 id 顺序返回帖子（不存在的 id 被跳过），2 条语句完成。"""
+    if not post_ids:
+        return []
+    try:
+        from .models import Post
+
+        async with AsyncSessionLocal() as session:
+            rows = await _load_posts(session, _posts_with_author_select().where(Post.id.in_(list(post_ids))))
+        by_id = {r['id']: r for r in rows}
+        return [by_id[i] for i in post_ids if i in by_id]
+    except Exception as exc:
+        logger.exception("按 id 批量读取 posts 失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
+async def fetch_post_activity_since(since: datetime.datetime) -> Dict[str, List[Tuple]]:
+    """读取 `since` 之后的发帖与评论，用于热度引擎的预热与增量刷新。
+
+    返回 {'posts': [(post_id, created_at)], 'comments': [(comment_id, post_id, created_at, post_created_at)]}；
+    发帖先用 last_activity_at 索引缩小范围（last_activity_at 不早于 created_at），
+    评论走 created_at 索引，并带回所属帖子的真实发帖时间。
+    """
+    try:
+        from .models import Post, Comment
+
+        async with AsyncSessionLocal() as session:
+            posts = (await session.execute(
+                select(Post.id, Post.created_at).where(Post.last_activity_at >= since, Post.created_at >= since)
+            )).all()
+            comments = (await session.execute(
+                select(Comment.id, Comment.post_id, Comment.created_at, Post.created_at)
+                .join(Post, Post.id == Comment.post_id)
+                .where(Comment.created_at >= since)
+            )).all()
+        return {
+            'posts': [(int(pid), ts) for pid, ts in posts],
+            'comments': [(int(cid), int(pid), ts, post_ts) for cid, pid, ts, post_ts in comments],
+        }
+    except Exception as exc:
+        logger.exception("读取帖子活动窗口失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
 async def fetch_users_rows() -> List[Dict]:
     """读取 users 表，返回与 `user.to_dict()` 兼容的列表字典。"""
     try:
@@ -338,6 +692,96 @@ async def set_user_state_if_offline(username: Optional[str] = None, user_id: Opt
         raise DatabaseError(exc) from exc
 
 
+_STATE_BULK_CHUNK = 500
+
+
+async def sync_presence(worker_id: str, states: Dict[int, str], worker_ttl: float, retire: bool = False) -> int:
+    """同步本 worker 持有的在线状态，并据全部 worker 重新推导 users.state，同一事务提交。
+
+    - `states` 为本 worker 自上次同步以来变化的用户：online 表示持有至少一个连接（插入
+      presence_connections 行），offline 表示已全部断开（删除本 worker 的行）；
+    - 刷新本 worker 的心跳；超过 `worker_ttl` 秒未刷新的其它 worker 视为已退出，回收其连接行；
+      `retire=True`（进程退出）时回收本 worker 的全部行；
+    - 受影响的用户按“是否还有任何 worker 持有连接”改写 users.state，别的 worker 仍持有连接时不会被置为 offline。
+
+    先按 id 顺序对受影响的 users 行加锁（FOR UPDATE），同一用户的并发同步串行执行，
+    后提交的一方一定能看到先提交一方的连接行。返回实际改写 users.state 的行数。
+    """
+    from .models import PresenceConnection, PresenceWorker, User
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cutoff = now - datetime.timedelta(seconds=worker_ttl)
+    try:
+        updated = 0
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                dead = (await session.execute(
+                    select(PresenceWorker.worker_id).where(PresenceWorker.seen_at < cutoff, PresenceWorker.worker_id != worker_id)
+                )).scalars().all()
+                dead = list(dead) + ([worker_id] if retire else [])
+                reaped = []
+                if dead:
+                    reaped = (await session.execute(
+                        select(PresenceConnection.user_id).where(PresenceConnection.worker_id.in_(dead)).distinct()
+                    )).scalars().all()
+                affected = sorted({int(uid) for uid in states} | set(reaped))
+                for start in range(0, len(affected), _STATE_BULK_CHUNK):
+                    chunk = affected[start:start + _STATE_BULK_CHUNK]
+                    await session.execute(select(User.id).where(User.id.in_(chunk)).order_by(User.id).with_for_update())
+
+                if dead:
+                    await session.execute(delete(PresenceConnection).where(PresenceConnection.worker_id.in_(dead)))
+                    await session.execute(delete(PresenceWorker).where(PresenceWorker.worker_id.in_(dead)))
+                if not retire:
+                    await session.execute(
+                        pg_insert(PresenceWorker).values(worker_id=worker_id, seen_at=now)
+                        .on_conflict_do_update(index_elements=['worker_id'], set_={'seen_at': now})
+                    )
+                    online = [int(uid) for uid, state in states.items() if state == 'online']
+                    offline = [int(uid) for uid, state in states.items() if state != 'online']
+                    if online:
+                        await session.execute(
+                            pg_insert(PresenceConnection).values([{'worker_id': worker_id, 'user_id': uid} for uid in online])
+                            .on_conflict_do_nothing(index_elements=['worker_id', 'user_id'])
+                        )
+                    if offline:
+                        await session.execute(delete(PresenceConnection).where(
+                            PresenceConnection.worker_id == worker_id, PresenceConnection.user_id.in_(offline)
+                        ))
+
+                live = select(PresenceConnection.user_id).where(PresenceConnection.user_id == User.id).exists()
+                target = case((live, 'online'), else_='offline')
+                for start in range(0, len(affected), _STATE_BULK_CHUNK):
+                    chunk = affected[start:start + _STATE_BULK_CHUNK]
+                    res = await session.execute(
+                        update(User)
+                        .where(User.id.in_(chunk), User.state.is_distinct_from(target))
+                        .values(state=target)
+                        .returning(User.id)
+                        .execution_options(synchronize_session=False)
+                    )
+                    updated += len(res.fetchall())
+        return updated
+    except Exception as exc:
+        logger.exception("同步在线状态失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
+async def fetch_user_states(user_ids: List[int]) -> Dict[int, Optional[str]]:
+    """批量读取 users.state，返回 {user_id: state}；不存在的用户不出现在结果中。"""
+    if not user_ids:
+        return {}
+    try:
+        from .models import User
+
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(select(User.id, User.state).where(User.id.in_(list(user_ids))))
+            return {int(r.id): r.state for r in res.all()}
+    except Exception as exc:
+        logger.exception("批量读取 user state 失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
 async def create_user(user_id: int, username: Optional[str], password: Optional[str], identity: Optional[str], location: Optional[str], role: Optional[str], friends: Optional[list] = None, password_hash: Optional[str] = None) -> Dict:
     """在数据库中创建用户。返回用户基本信息字典或空字典表示失败。"""
     try:
@@ -398,42 +842,73 @@ async def get_user_credentials(user_id: int) -> Dict:
         raise DatabaseError(exc) from exc
 
 
-async def get_post_by_id(post_id: int) -> Dict:
+def _user_profile_columns(User) -> tuple:
+    return (User.id, User.username, User.identity, User.role, User.location, User.state, User.friends)
+
+
+def _user_profile(row) -> Dict:
+    return {
+        'id': row.id,
+        'username': row.username,
+        'identity': row.identity,
+        'role': row.role,
+        'location': row.location,
+        'state': row.state,
+        'friends': row.friends or [],
+    }
+
+
+async def login_user(user_id: int, verify: Callable[[Dict], Awaitable[bool]]) -> Dict:
+    """登录：读取凭据 -> 调用方校验 -> 原子置为在线并返回资料，共两条语句、两次短连接借用。
+
+    `verify` 接收 {'password','password_hash','state'}，返回 True 表示校验通过（可为异步的
+    argon2 校验）；其抛出的异常原样传给调用方。校验期间不持有连接与事务，排队中的登录不会
+    占满连接池；置在线的 UPDATE 带 `state IS DISTINCT FROM 'online'` 条件，两次借用之间的并发登录
+    只会有一个成功。成功返回与 `get_user_by_id` 相同的资料字典（state 已为 online）。
+
+    失败时抛出 UserNotFoundError / InvalidCredentialsError / UserAlreadyOnlineError；
+    数据库错误抛出 DatabaseError。
+    """
+    from .models import User
+
     try:
-        from .models import Post, Comment, User
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(select(Post).where(Post.id == post_id))
-            p = result.scalars().first()
-            if not p:
-                return {}
-            comments_q = await session.execute(select(Comment).where(Comment.post_id == p.id))
-            comments = comments_q.scalars().all()
-            comments_list = []
-            for c in comments:
-                comments_list.append({
-                    'id': c.id,
-                    'post_id': c.post_id,
-                    'author': c.author_name,
-                    'content': c.content,
-                    'time': _format_dt(c.created_at),
-                })
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                select(User.password, User.password_hash, User.state).where(User.id == user_id)
+            )
+            creds = res.first()
+    except SQLAlchemyError as exc:
+        logger.exception("登录查询失败: %s", exc)
+        raise DatabaseError(exc) from exc
+    if creds is None:
+        raise UserNotFoundError(user_id)
+    if not await verify({'password': creds.password, 'password_hash': creds.password_hash, 'state': creds.state}):
+        raise InvalidCredentialsError(user_id)
 
-            author_name = None
-            if getattr(p, 'author_id', None) is not None:
-                user_q = await session.execute(select(User).where(User.id == getattr(p, 'author_id')))
-                u = user_q.scalars().first()
-                if u:
-                    author_name = getattr(u, 'username', None)
+    try:
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                res = await session.execute(
+                    update(User)
+                    .where(User.id == user_id, User.state.is_distinct_from('online'))
+                    .values(state='online')
+                    .returning(*_user_profile_columns(User))
+                )
+                row = res.first()
+    except SQLAlchemyError as exc:
+        logger.exception("登录查询失败: %s", exc)
+        raise DatabaseError(exc) from exc
+    if row is None:
+        raise UserAlreadyOnlineError(user_id)
+    return _user_profile(row)
 
-            return {
-                'id': p.id,
-                'author': author_name,
-                'title': p.title or '',
-                'content': p.content or '',
-                'section': p.section or '',
-                'time': _format_dt(p.created_at),
-                'comments': comments_list,
-            }
+
+async def get_post_by_id(post_id: int) -> Dict:
+    try:
+        from .models import Post
+        async with AsyncSessionLocal() as session:
+            rows = await _load_posts(session, _posts_with_author_select().where(Post.id == post_id))
+        return rows[0] if rows else {}
     except Exception as exc:
         logger.exception("查询 post 失败: %s", exc)
         raise DatabaseError(exc) from exc
@@ -477,6 +952,7 @@ async def create_post(author: Union[str, int, None], title: Optional[str], conte
                     'content': new_post.content or '',
                     'section': new_post.section or '',
                     'time': _format_dt(new_post.created_at),
+                    'comment_count': 0,
                     'comments': [],
                 }
     except Exception as exc:
@@ -484,24 +960,28 @@ async def create_post(author: Union[str, int, None], title: Optional[str], conte
         raise DatabaseError(exc) from exc
 
 
-async def add_comment(post_id: int, author: Optional[object], content: Optional[str]) -> Dict:
+async def add_comment(post_id: int, author: Optional[object], content: Optional[str], author_name: Optional[str] = None) -> Dict:
     """在数据库中为帖子添加评论，返回与 `Comment.to_dict()` 兼容的字典。
 
     `author` 可以是用户名或用户 id；如果是 id，会尝试解析为用户名并写入 `author_name` 字段。
+    调用方已校验作者时可直接传入 `author_name`，跳过用户查询。
     """
     try:
         from .models import Comment, Post, User
 
         async with AsyncSessionLocal() as session:
             async with session.begin():
-                # 确认帖子存在
-                post_q = await session.execute(select(Post).where(Post.id == post_id))
-                p = post_q.scalars().first()
-                if not p:
+                # 确认帖子存在并在同一事务内维护反范式计数（行锁保证并发评论计数准确）
+                bumped = await session.execute(
+                    update(Post)
+                    .where(Post.id == post_id)
+                    .values(comment_count=Post.comment_count + 1, last_activity_at=func.now())
+                    .returning(Post.id)
+                )
+                if bumped.first() is None:
                     return {}
 
-                author_name = None
-                if author is not None:
+                if author_name is None and author is not None:
                     if isinstance(author, int):
                         user_q = await session.execute(select(User).where(User.id == author))
                         u = user_q.scalars().first()
@@ -566,9 +1046,11 @@ async def ensure_seed_data() -> Dict[str, int]:
         raise DatabaseError(exc) from exc
 
 
-async def create_personal_message(sender: Union[int, str], receiver: Union[int, str], content: str, timestamp: Optional[str] = None) -> Dict:
+async def create_personal_message(sender: Union[int, str], receiver: Union[int, str], content: str, timestamp: Optional[str] = None, client_msg_id: Optional[str] = None) -> Dict:
     """在数据库中创建私信记录，接受用户 id 或 username 作为 `sender`/`receiver`，
     内部解析为 id 再写入表。返回已创建行的字典；若无法解析为用户 id 则返回空字典。
+
+    同一发送方 `client_msg_id` 相同的消息只写入一次（超时后重试不会产生重复行），重复写入时返回已有的行。
     """
      
     try:
@@ -614,70 +1096,307 @@ async def create_personal_message(sender: Union[int, str], receiver: Union[int,
                     logger.warning("create_personal_message: 无法解析 sender/receiver 为用户 id: %s %s", sender, receiver)
                     return {}
 
-                pm = PersonalMessage(sender=sender_id, receiver=receiver_id, content=content)
-                session.add(pm)
+                rows = await _insert_messages(session, PersonalMessage, [
+                    {'sender': sender_id, 'receiver': receiver_id, 'content': content, 'client_msg_id': client_msg_id or uuid.uuid4().hex}
+                ])
 
-            return {
-                'id': pm.id,
-                'sender': pm.sender,
-                'receiver': pm.receiver,
-                'content': pm.content,
-                'time': _format_dt(pm.created_at),
-            }
+            return _personal_message_to_dict(rows[0])
     except Exception as exc:
         logger.exception("创建 personal message 失败: %s", exc)
         raise DatabaseError(exc) from exc
 
 
-async def fetch_personal_messages(user_a: int, user_b: int) -> List[Dict]:
+def _message_columns(model) -> tuple:
+    if model.__tablename__ == 'personal_messages':
+        return (model.id, model.sender, model.receiver, model.content, model.client_msg_id, model.created_at)
+    return (model.id, model.group_name, model.sender, model.content, model.client_msg_id, model.created_at)
+
+
+def _message_dedup_keys(model) -> Tuple[str, ...]:
+    # 与唯一索引 ux_*_client_msg_id 的列一致：client_msg_id 来自客户端，只在同一发送方内去重
+    if model.__tablename__ == 'personal_messages':
+        return ('sender', 'client_msg_id')
+    return ('group_name', 'sender', 'client_msg_id')
+
+
+async def _insert_messages(session, model, values: List[Dict[str, Any]]) -> list:
+    """多行 `INSERT ... ON CONFLICT (sender, client_msg_id) DO NOTHING RETURNING`，返回与 `values` 一一对应的行。
+
+    同一发送方已存在的 client_msg_id（之前已提交、这次是重试）不会再插入，改为按同样的键查出
+    已有的行补齐，因此调用方无论首次写入还是重试都得到同样的结果；其他用户的消息不会被返回。
+    """
+    cols = _message_columns(model)
+    keys = _message_dedup_keys(model)
+
+    def key_of(m) -> tuple:
+        return tuple(str(m[k]) for k in keys)
+
+    stmt = (
+        pg_insert(model)
+        .values(values)
+        .on_conflict_do_nothing(index_elements=list(keys))
+        .returning(*cols)
+    )
+    by_key = {key_of(r._mapping): r for r in (await session.execute(stmt)).all()}
+    missing = [tuple(v[k] for k in keys) for v in values if key_of(v) not in by_key]
+    if missing:
+        existing = await session.execute(
+            select(*cols).where(tuple_(*(getattr(model, k) for k in keys)).in_(missing))
+        )
+        by_key.update({key_of(r._mapping): r for r in existing.all()})
+    return [by_key[key_of(v)] for v in values]
+
+
+def _client_msg_id(message: tuple, arity: int) -> str:
+    return (message[arity] if len(message) > arity else None) or uuid.uuid4().hex
+
+
+async def _insert_personal_bulk(session, messages: List[tuple]) -> list:
+    from .models import PersonalMessage
+
+    return await _insert_messages(session, PersonalMessage, [
+        {'sender': int(m[0]), 'receiver': int(m[1]), 'content': m[2], 'client_msg_id': _client_msg_id(m, 3)} for m in messages
+    ])
+
+
+async def _insert_group_bulk(session, messages: List[tuple]) -> list:
+    from .models import GroupMessage
+
+    return await _insert_messages(session, GroupMessage, [
+        {'group_name': m[0], 'sender': m[1], 'content': m[2], 'client_msg_id': _client_msg_id(m, 3)} for m in messages
+    ])
+
+
+async def create_personal_messages_bulk(messages: List[Tuple]) -> List[Dict]:
+    """一次事务、一条多行 INSERT 写入一批私信（`(sender_id, receiver_id, content[, client_msg_id])`，均已解析为 id）。
+
+    返回的字典与输入一一对应、顺序相同；同一语句内 id 按 VALUES 顺序分配，同一会话内的先后顺序不变。
+    未提供 client_msg_id 时由服务端生成；已写入过的 client_msg_id 不会重复插入，返回已有的行。
+    """
+    if not messages:
+        return []
+    try:
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                rows = await _insert_personal_bulk(session, messages)
+        return [_personal_message_to_dict(r) for r in rows]
+    except Exception as exc:
+        logger.exception("批量创建 personal message 失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
+async def create_messages_bulk(personal: List[Tuple], group: List[Tuple]) -> Tuple[List[Dict], List[Dict]]:
+    """重试队列排空使用：私信与群消息各一条多行 INSERT，在同一事务中提交（要么全部写入，要么全部回滚）。
+
+    `personal` 为 `(sender_id, receiver_id, content[, client_msg_id])`，`group` 为
+    `(group_name, sender, content[, client_msg_id])`；按发送方 + client_msg_id 去重（ON CONFLICT DO NOTHING），
+    因此同一批消息可以放心地重复提交。返回的两个列表分别与输入顺序一致。
+    """
+    if not personal and not group:
+        return [], []
+    try:
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                p_rows = await _insert_personal_bulk(session, personal) if personal else []
+                g_rows = await _insert_group_bulk(session, group) if group else []
+        return [_personal_message_to_dict(r) for r in p_rows], [_group_message_to_dict(r) for r in g_rows]
+    except Exception as exc:
+        logger.exception("批量写入 %s 条私信 / %s 条群消息失败: %s", len(personal), len(group), exc)
+        raise DatabaseError(exc) from exc
+
+
+async def ping() -> bool:
+    """`SELECT 1` 探测数据库是否可用；失败抛出 DatabaseError。"""
+    try:
+        async with AsyncSessionLocal() as session:
+            await session.execute(text('SELECT 1'))
+        return True
+    except Exception as exc:
+        raise DatabaseError(exc) from exc
+
+
+def _personal_message_to_dict(m) -> Dict:
+    return {
+        'id': m.id,
+        'sender': m.sender,
+        'receiver': m.receiver,
+        'content': m.content,
+        'client_msg_id': m.client_msg_id,
+        'time': _format_dt(m.created_at),
+    }
+
+
+def _group_message_to_dict(m) -> Dict:
+    return {
+        'id': m.id,
+        'group': m.group_name,
+        'sender': m.sender,
+        'content': m.content,
+        'client_msg_id': m.client_msg_id,
+        'time': _format_dt(m.created_at),
+    }
+
+
+def _history_order(model, stmt, limit: int, ascending: bool):
+    if ascending:
+        return stmt.order_by(model.created_at, model.id).limit(limit)
+    return stmt.order_by(model.created_at.desc(), model.id.desc()).limit(limit)
+
+
+def _history_window(model, stmt, limit: int, before_id: Optional[int], after_id: Optional[int]):
+    """对消息查询施加 (created_at, id) 键集条件与排序。
+
+    after_id：取该消息之后的（升序）；否则取 before_id 之前（或最新）的，降序取 limit 条，由调用方反转。
+    游标消息的 created_at 通过标量子查询取得，整个窗口只需一条语句。
+    """
+    key = tuple_(model.created_at, model.id)
+    cursor_row = aliased(model)
+    if after_id is not None:
+        ts = select(cursor_row.created_at).where(cursor_row.id == after_id).scalar_subquery()
+        return _history_order(model, stmt.where(key > tuple_(ts, after_id)), limit, True)
+    if before_id is not None:
+        ts = select(cursor_row.created_at).where(cursor_row.id == before_id).scalar_subquery()
+        stmt = stmt.where(key < tuple_(ts, before_id))
+    return _history_order(model, stmt, limit, False)
+
+
+async def fetch_personal_messages(user_a: int, user_b: int, limit: Optional[int] = None, before_id: Optional[int] = None, after_id: Optional[int] = None) -> List[Dict]:
     """获取两位用户之间的私信历史（按时间升序）。
 
     返回列表，格式与前端现有 `get_personal_messages` 输出兼容：
-    每项包含 'sender','receiver','content','time'
+    每项包含 'id','sender','receiver','content','time'
+
+    传入 `limit` 时按键集分页：
+    - 默认返回最新的 `limit` 条；
+    - `before_id`：返回该消息之前的 `limit` 条（向上翻页）；
+    - `after_id`：返回该消息之后的 `limit` 条（增量同步）。
+    两个方向分别走 (sender, receiver, created_at, id) 索引取前 `limit` 条，再合并截断。
     """
     try:
-        from .models import PersonalMessage
+        from .models import PersonalMessage as PM
 
         async with AsyncSessionLocal() as session:
-            # 查询两方向的消息
-            q = await session.execute(
-                select(PersonalMessage).where(
-                    ((PersonalMessage.sender == user_a) & (PersonalMessage.receiver == user_b))
-                    | ((PersonalMessage.sender == user_b) & (PersonalMessage.receiver == user_a))
-                ).order_by(PersonalMessage.created_at)
-            )
-            msgs = q.scalars().all()
-            out: List[Dict] = []
-            for m in msgs:
-                out.append({
-                    'sender': getattr(m, 'sender', ''),
-                    'receiver': getattr(m, 'receiver', ''),
-                    'content': getattr(m, 'content', ''),
-                    'time': _format_dt(getattr(m, 'created_at', None)),
-                })
-            return out
+            if limit is None:
+                q = await session.execute(
+                    select(PM).where(
+                        ((PM.sender == user_a) & (PM.receiver == user_b))
+                        | ((PM.sender == user_b) & (PM.receiver == user_a))
+                    ).order_by(PM.created_at, PM.id)
+                )
+                return [_personal_message_to_dict(m) for m in q.scalars().all()]
+
+            limit = max(1, int(limit))
+            legs = [
+                _history_window(PM, select(PM.id).where(PM.sender == s, PM.receiver == r), limit, before_id, after_id).subquery()
+                for s, r in ((user_a, user_b), (user_b, user_a))
+            ]
+            ids = union_all(select(legs[0].c.id), select(legs[1].c.id)).subquery()
+            stmt = _history_order(PM, select(PM).where(PM.id.in_(select(ids.c.id))), limit, after_id is not None)
+            msgs = list((await session.execute(stmt)).scalars().all())
+            if after_id is None:
+                msgs.reverse()
+            return [_personal_message_to_dict(m) for m in msgs]
     except Exception as exc:
         logger.exception("从数据库读取 personal messages 失败: %s", exc)
         raise DatabaseError(exc) from exc
 
 
-async def create_group_message(group_name: str, sender: str, content: str, timestamp: Optional[str] = None) -> Dict:
-    """在数据库中创建群消息记录，返回已创建行的字典。"""
+async def fetch_group_messages(group_name: str, limit: int = 50, before_id: Optional[int] = None, after_id: Optional[int] = None) -> List[Dict]:
+    """获取群消息历史（按时间升序），游标语义同 `fetch_personal_messages`。"""
     try:
-        from .models import GroupMessage
+        from .models import GroupMessage as GM
 
+        async with AsyncSessionLocal() as session:
+            stmt = _history_window(GM, select(GM).where(GM.group_name == group_name), max(1, int(limit)), before_id, after_id)
+            msgs = list((await session.execute(stmt)).scalars().all())
+        if after_id is None:
+            msgs.reverse()
+        return [_group_message_to_dict(m) for m in msgs]
+    except Exception as exc:
+        logger.exception("从数据库读取 group messages 失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
+_MARK_READ_SQL = (
+    "INSERT INTO conversation_reads (user_id, peer_id, last_read_id, updated_at) "
+    "VALUES (:user_id, :peer_id, :last_read_id, CURRENT_TIMESTAMP) "
+    "ON CONFLICT (user_id, peer_id) DO UPDATE SET "
+    "last_read_id = CASE WHEN excluded.last_read_id > conversation_reads.last_read_id "
+    "THEN excluded.last_read_id ELSE conversation_reads.last_read_id END, "
+    "updated_at = CURRENT_TIMESTAMP"
+)
+
+CONVERSATION_PREVIEW_CHARS = 80
+
+
+async def mark_conversation_read(user_id: int, peer_id: int, last_read_id: int) -> None:
+    """把 user_id 在与 peer_id 会话中的已读游标推进到 last_read_id（只增不减）。"""
+    try:
         async with AsyncSessionLocal() as session:
             async with session.begin():
-                gm = GroupMessage(group_name=group_name, sender=sender, content=content)
-                session.add(gm)
+                await session.execute(text(_MARK_READ_SQL), {'user_id': int(user_id), 'peer_id': int(peer_id), 'last_read_id': int(last_read_id)})
+    except Exception as exc:
+        logger.exception("更新会话已读游标失败: %s", exc)
+        raise DatabaseError(exc) from exc
 
-            return {
-                'id': gm.id,
-                'group': gm.group_name,
-                'sender': gm.sender,
-                'content': gm.content,
-                'time': _format_dt(gm.created_at),
-            }
+
+async def fetch_conversations(user_id: int, limit: int = 50) -> List[Dict]:
+    """用一条聚合查询返回用户的私聊会话列表（按最后一条消息时间倒序）。
+
+    每项：{'peer_id','peer_username','last_message': {'id','sender','content','time'},'unread'}；
+    content 为截断后的预览，unread 为对方发来、id 大于已读游标的消息数。
+    """
+    try:
+        from .models import ConversationRead as CR, PersonalMessage as PM, User
+
+        peer = case((PM.sender == user_id, PM.receiver), else_=PM.sender)
+        partition = {'partition_by': peer}
+        unread_hit = case(
+            ((PM.receiver == user_id) & (PM.id > func.coalesce(CR.last_read_id, 0)), 1),
+            else_=0,
+        )
+        conv = (
+            select(
+                peer.label('peer_id'),
+                PM.id,
+                PM.sender,
+                func.substr(PM.content, 1, CONVERSATION_PREVIEW_CHARS).label('preview'),
+                PM.created_at,
+                func.row_number().over(order_by=(PM.created_at.desc(), PM.id.desc()), **partition).label('rn'),
+                func.sum(unread_hit).over(**partition).label('unread'),
+            )
+            .outerjoin(CR, (CR.user_id == user_id) & (CR.peer_id == peer))
+            .where(or_(PM.sender == user_id, PM.receiver == user_id))
+            .subquery()
+        )
+        stmt = (
+            select(conv, User.username)
+            .outerjoin(User, User.id == conv.c.peer_id)
+            .where(conv.c.rn == 1)
+            .order_by(conv.c.created_at.desc(), conv.c.id.desc())
+            .limit(max(1, int(limit)))
+        )
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(stmt)).all()
+        return [{
+            'peer_id': r.peer_id,
+            'peer_username': r.username or '',
+            'last_message': {'id': r.id, 'sender': r.sender, 'content': r.preview, 'time': _format_dt(r.created_at)},
+            'unread': int(r.unread or 0),
+        } for r in rows]
+    except Exception as exc:
+        logger.exception("查询会话列表失败: %s", exc)
+        raise DatabaseError(exc) from exc
+
+
+async def create_group_message(group_name: str, sender: str, content: str, timestamp: Optional[str] = None, client_msg_id: Optional[str] = None) -> Dict:
+    """在数据库中创建群消息记录，返回已创建行的字典；`client_msg_id` 相同的消息只写入一次。"""
+    try:
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                rows = await _insert_group_bulk(session, [(group_name, sender, content, client_msg_id)])
+
+            return _group_message_to_dict(rows[0])
     except Exception as exc:
         logger.exception("创建 group message 失败: %s", exc)
         raise DatabaseError(exc) from exc
@@ -826,3 +1545,37 @@ def get_user_by_username_sync(username: str) -> Dict:
             session.close()
         except Exception:
             pass
+
+
+def fetch_posts_rows_sync(section: Optional[str] = None) -> List[Dict]:
+    """`fetch_posts_rows` 的同步版本（供管理后台等脚本使用），同样只需 2 条语句。"""
+    try:
+        from .models import Post
+    except Exception as exc:
+        logger.exception("同步导入模块失败: %s", exc)
+        return []
+
+    try:
+        session = _get_sync_session()
+    except Exception as exc:
+        logger.exception("初始化同步 session 失败: %s", exc)
+        return []
+
+    try:
+        stmt = _posts_with_author_select()
+        if section is not None:
+            stmt = stmt.where(Post.section == section)
+        post_rows = session.execute(stmt).all()
+        post_ids = [p.id for p, _ in post_rows]
+        comments: List[Any] = []
+        for chunk in _chunks(post_ids):
+            comments.extend(session.execute(_comments_select(chunk)).scalars().all())
+        return _assemble_posts(post_rows, comments)
+    except Exception as exc:
+        logger.exception("同步读取 posts 失败: %s", exc)
+        return []
+    finally:
+        try:
+            session.close()
+        except Exception:
+            pass
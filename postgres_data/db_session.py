@@ -43,6 +43,11 @@ engine = _create_engine_with_fallback(DATABASE_URL)
 # 异步会话工厂
 AsyncSessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
 
+
+def asyncpg_dsn() -> str:
+    """与 `engine` 相同数据库的原生 asyncpg DSN，供需要独占连接的组件（如 LISTEN/NOTIFY）使用。"""
+    return engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+
 # 仍然为模型定义保留 Base
 Base = declarative_base()
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, ForeignKey, JSON, Index
 from sqlalchemy.sql import func
 from .db_session import Base
 
@@ -32,6 +32,17 @@ class Post(Base):
     # 保留板块字段以兼容旧 Post 的 `section`
     section = Column(String(64), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # 反范式计数：由 adapter.add_comment 在同一事务内维护，热帖/最近活跃列表无需再聚合 comments
+    comment_count = Column(Integer, nullable=False, default=0, server_default='0')
+    last_activity_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # 列表页按 (created_at, id) 倒序键集分页，可选按板块过滤
+    __table_args__ = (
+        Index('ix_posts_section_created_at_id', 'section', 'created_at', 'id'),
+        Index('ix_posts_created_at_id', 'created_at', 'id'),
+        Index('ix_posts_comment_count_created_at_id', 'comment_count', 'created_at', 'id'),
+        Index('ix_posts_last_activity_at_id', 'last_activity_at', 'id'),
+    )
 
 
 class Comment(Base):
@@ -42,6 +53,11 @@ class Comment(Base):
     content = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index('ix_comments_post_id_id', 'post_id', 'id'),
+        Index('ix_comments_created_at', 'created_at'),
+    )
+
 
 class Group(Base):
     __tablename__ = 'groups'
@@ -93,14 +109,36 @@ class ExampleRelation(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
+class DataVersion(Base):
+    """参考数据（example_relation / example_legal 等）的版本号。
+
+    导入脚本写入数据时递增对应 name 的 version，服务进程据此判断进程内缓存是否过期。
+    """
+    __tablename__ = 'data_versions'
+    name = Column(String(64), primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class PersonalMessage(Base):
     __tablename__ = 'personal_messages'
     id = Column(Integer, primary_key=True, index=True)
     sender = Column(Integer, nullable=False)
     receiver = Column(Integer, nullable=False)
     content = Column(Text, nullable=False)
+    # 客户端（或服务端代为生成）的消息 id：重试 / 重复提交时按它去重
+    client_msg_id = Column(String(64), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        # 历史消息键集分页：按会话方向 + (created_at, id) 顺序扫描
+        Index('ix_personal_messages_pair_created_id', 'sender', 'receiver', 'created_at', 'id'),
+        # 会话列表：按接收方聚合（发送方一侧由上面的索引覆盖）
+        Index('ix_personal_messages_receiver_created_id', 'receiver', 'created_at', 'id'),
+        # 去重按发送方限定：不同用户碰巧用了同一个 client_msg_id 不会互相吞掉消息
+        Index('ux_personal_messages_sender_client_msg_id', 'sender', 'client_msg_id', unique=True),
+    )
+
 
 class GroupMessage(Base):
     __tablename__ = 'group_messages'
@@ -108,4 +146,40 @@ class GroupMessage(Base):
     group_name = Column(String(128), nullable=False)
     sender = Column(Integer, nullable=False)
     content = Column(Text, nullable=False)
+    client_msg_id = Column(String(64), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index('ix_group_messages_group_created_id', 'group_name', 'created_at', 'id'),
+        Index('ux_group_messages_group_sender_client_msg_id', 'group_name', 'sender', 'client_msg_id', unique=True),
+    )
+
+
+class ConversationRead(Base):
+    """私聊已读游标：user_id 在与 peer_id 的会话中已读到的最大消息 id。"""
+    __tablename__ = 'conversation_reads'
+    user_id = Column(Integer, primary_key=True)
+    peer_id = Column(Integer, primary_key=True)
+    last_read_id = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class PresenceConnection(Base):
+    """跨 worker 在线状态：某个 worker 持有该用户至少一个 WebSocket 连接时存在一行。
+
+    users.state 由这张表推导（任一 worker 有行即 online），见 `adapter.sync_presence`。
+    """
+    __tablename__ = 'presence_connections'
+    worker_id = Column(String(64), primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+
+    __table_args__ = (
+        Index('ix_presence_connections_user_id', 'user_id'),
+    )
+
+
+class PresenceWorker(Base):
+    """持有连接的 worker 心跳；超过 PRESENCE_WORKER_TTL 未更新视为已退出，其连接行被回收。"""
+    __tablename__ = 'presence_workers'
+    worker_id = Column(String(64), primary_key=True)
+    seen_at = Column(DateTime(timezone=True), nullable=False)
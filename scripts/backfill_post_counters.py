@@ -0,0 +1,111 @@
+"""
+一次性回填 posts.comment_count / posts.last_activity_at。
+
+这两列由 `adapter.add_comment` 在写评论时事务内维护；本脚本用于为升级前已存在的帖子
+按 comments 表重新计算（可重复执行，结果幂等）。
+
+用法：
+    python scripts/backfill_post_counters.py            # dry-run：只统计需要修正的帖子数
+    python scripts/backfill_post_counters.py --commit   # 执行回填
+"""
+import argparse
+import logging
+import os
+import sys
+
+# Ensure project root is on sys.path so we can import `postgres_data` when running from scripts/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("post_counters_backfill")
+
+# 与 adapter._SCHEMA_UPGRADES 中的列定义保持一致，保证脚本可在服务首次启动前单独运行
+ENSURE_COLUMNS = [
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS comment_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS last_activity_at TIMESTAMPTZ",
+    "ALTER TABLE posts ALTER COLUMN last_activity_at SET DEFAULT now()",
+]
+
+COUNTERS_CTE = """
+WITH agg AS (
+    SELECT p.id,
+           COALESCE(c.cnt, 0) AS cnt,
+           COALESCE(GREATEST(p.created_at, c.last_at), p.created_at) AS last_at
+    FROM posts p
+    LEFT JOIN (
+        SELECT post_id, count(*) AS cnt, max(created_at) AS last_at
+        FROM comments
+        GROUP BY post_id
+    ) c ON c.post_id = p.id
+)
+"""
+
+COUNT_STALE_SQL = COUNTERS_CTE + """
+SELECT count(*)
+FROM posts p JOIN agg ON agg.id = p.id
+WHERE p.comment_count <> agg.cnt OR p.last_activity_at IS DISTINCT FROM agg.last_at
+"""
+
+BACKFILL_SQL = COUNTERS_CTE + """
+UPDATE posts p
+SET comment_count = agg.cnt, last_activity_at = agg.last_at
+FROM agg
+WHERE agg.id = p.id
+  AND (p.comment_count <> agg.cnt OR p.last_activity_at IS DISTINCT FROM agg.last_at)
+"""
+
+
+def backfill_sync(commit: bool) -> int:
+    """同步实现：使用 SQLAlchemy 同步引擎避免 async/loop 问题。"""
+    try:
+        from postgres_data.db_config import get_database_url
+        from sqlalchemy import create_engine, text
+    except Exception as exc:
+        logger.exception("导入模块失败：%s", exc)
+        return 1
+
+    url = get_database_url()
+    # 若 URL 指定了 async 驱动，替换为 sync 可用的 psycopg
+    if '+asyncpg' in url:
+        url = url.replace('+asyncpg', '+psycopg')
+
+    try:
+        engine = create_engine(url, future=True)
+    except Exception as exc:
+        logger.exception("创建同步 engine 失败：%s", exc)
+        return 1
+
+    try:
+        with engine.begin() as conn:
+            for ddl in ENSURE_COLUMNS:
+                conn.execute(text(ddl))
+            stale = int(conn.execute(text(COUNT_STALE_SQL)).scalar_one())
+            logger.info("需要回填的帖子：%d", stale)
+            if not commit:
+                logger.info("未启用 --commit，退出（dry-run）")
+                return 0
+            updated = conn.execute(text(BACKFILL_SQL)).rowcount
+        logger.info("回填完成：%d 个帖子已更新", updated)
+        return 0
+    except Exception as exc:
+        logger.exception("回填帖子计数失败：%s", exc)
+        return 1
+    finally:
+        engine.dispose()
+
+
+def main():
+    p = argparse.ArgumentParser(description='回填 posts.comment_count / last_activity_at')
+    p.add_argument('--commit', action='store_true', help='写入数据库（否则 dry-run）')
+    args = p.parse_args()
+    try:
+        sys.exit(backfill_sync(args.commit))
+    except Exception as exc:
+        logger.exception("回填运行失败：%s", exc)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+登录数据库路径基准：对比旧 /user_login 的三次会话
+（get_user_credentials -> get_user_by_id -> set_user_state_if_offline）与 `adapter.login_user`
+（SELECT 凭据与 UPDATE ... RETURNING 资料各一次短连接借用，校验期间不持有连接）。
+
+用法（需已设置 DATABASE_URL 指向可写的测试库）：
+    python scripts/bench_login.py --users 200 --rounds 5 --concurrency 50
+
+脚本插入 `--users` 个 id 从 BENCH_ID_BASE 开始的明文密码用户（不涉及 argon2，只测数据库开销），
+每轮把它们置为 offline 后并发登录，报告吞吐与延迟分位数，结束时删除这些用户。
+注意：不要在生产库上运行。
+"""
+import argparse
+import asyncio
+import pathlib
+import statistics
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from sqlalchemy import delete, insert, update  # noqa: E402
+
+from postgres_data import adapter  # noqa: E402
+from postgres_data.db_session import AsyncSessionLocal, dispose_db  # noqa: E402
+from postgres_data.models import User  # noqa: E402
+
+BENCH_ID_BASE = 990_000_000
+PASSWORD = 'bench-password'
+
+
+def pct(samples, q):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+async def seed(n: int) -> None:
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(delete(User).where(User.id >= BENCH_ID_BASE))
+            await session.execute(insert(User), [
+                {'id': BENCH_ID_BASE + i, 'username': f'__bench_login_{i}', 'password': PASSWORD, 'state': 'offline'}
+                for i in range(n)
+            ])
+
+
+async def reset_state() -> None:
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(update(User).where(User.id >= BENCH_ID_BASE).values(state='offline'))
+
+
+async def cleanup() -> None:
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(delete(User).where(User.id >= BENCH_ID_BASE))
+
+
+async def legacy_login(uid: int) -> dict:
+    creds = await adapter.get_user_credentials(uid)
+    assert creds and creds['password'] == PASSWORD
+    profile = await adapter.get_user_by_id(uid)
+    assert await adapter.set_user_state_if_offline(user_id=uid)
+    return profile
+
+
+async def adapter_login(uid: int) -> dict:
+    async def verify(creds):
+        return creds['password'] == PASSWORD
+    return await adapter.login_user(uid, verify)
+
+
+async def timeit(label: str, fn, n: int, rounds: int, concurrency: int) -> None:
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    elapsed = 0.0
+
+    async def one(uid):
+        async with sem:
+            t0 = time.perf_counter()
+            await fn(uid)
+            latencies.append(time.perf_counter() - t0)
+
+    for _ in range(rounds):
+        await reset_state()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(BENCH_ID_BASE + i) for i in range(n)))
+        elapsed += time.perf_counter() - t0
+    total = n * rounds
+    print(f'{label:<12} logins={total:<7} throughput={total / elapsed:8.1f}/s  '
+          f'p50={statistics.median(latencies) * 1000:7.2f} ms  p99={pct(latencies, 0.99) * 1000:7.2f} ms')
+
+
+async def main(args) -> None:
+    try:
+        await seed(args.users)
+        await timeit('legacy', legacy_login, args.users, args.rounds, args.concurrency)
+        await timeit('login_user', adapter_login, args.users, args.rounds, args.concurrency)
+    finally:
+        await cleanup()
+        await dispose_db()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='对比旧登录路径（3 次会话）与 adapter.login_user（2 次短连接借用）')
+    p.add_argument('--users', type=int, default=200, help='参与登录的合成用户数')
+    p.add_argument('--rounds', type=int, default=5, help='重复轮数（每轮每个用户登录一次）')
+    p.add_argument('--concurrency', type=int, default=50, help='并发登录数')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,109 @@
+"""
+私信写入基准：对比逐条写入（旧 /ws/private 路径：每条消息 await 一次 create_personal_message 事务）
+与 `PersonalMessageWriter`（后台按批多行 INSERT，提交后回执）的持续吞吐。
+
+用法（需已设置 DATABASE_URL 指向可写的测试库）：
+    python scripts/bench_message_ingest.py --senders 200 --messages 50
+
+模拟 `--senders` 个 WebSocket 连接，每个连接发送 `--messages` 条私信：
+- per_message：每条消息等待自己的事务提交后才处理下一条（与旧接收循环一致）；
+- batched：消息交给批量写入器后立即处理下一条，全部提交（收到 ack）后计时结束。
+报告每秒写入条数与提交延迟分位数；sender id 从 BENCH_ID_BASE 开始，结束时删除这些消息。
+注意：不要在生产库上运行。
+"""
+import argparse
+import asyncio
+import pathlib
+import statistics
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / '聊天和用户后端'))
+
+from sqlalchemy import delete  # noqa: E402
+
+from postgres_data import adapter  # noqa: E402
+from postgres_data.db_session import AsyncSessionLocal, dispose_db  # noqa: E402
+from postgres_data.models import PersonalMessage  # noqa: E402
+from message_pipeline import PersonalMessageWriter  # noqa: E402
+
+BENCH_ID_BASE = 990_000_000
+
+
+def pct(samples, q):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+async def cleanup() -> None:
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(delete(PersonalMessage).where(PersonalMessage.sender >= BENCH_ID_BASE))
+
+
+async def per_message(senders: int, messages: int, latencies: list) -> None:
+    async def conn(i):
+        sender, receiver = BENCH_ID_BASE + i, BENCH_ID_BASE + (i + 1) % senders
+        for n in range(messages):
+            t0 = time.perf_counter()
+            await adapter.create_personal_message(sender, receiver, f'bench {n}')
+            latencies.append(time.perf_counter() - t0)
+
+    await asyncio.gather(*(conn(i) for i in range(senders)))
+
+
+async def batched(senders: int, messages: int, latencies: list, writer: PersonalMessageWriter) -> None:
+    async def ack(fut, t0):
+        await fut
+        latencies.append(time.perf_counter() - t0)
+
+    async def conn(i):
+        sender, receiver = BENCH_ID_BASE + i, BENCH_ID_BASE + (i + 1) % senders
+        acks = []
+        for n in range(messages):
+            t0 = time.perf_counter()
+            acks.append(ack(await writer.submit(sender, receiver, f'bench {n}'), t0))
+        await asyncio.gather(*acks)
+
+    await asyncio.gather(*(conn(i) for i in range(senders)))
+
+
+async def timeit(label: str, run, senders: int, messages: int) -> None:
+    latencies: list = []
+    t0 = time.perf_counter()
+    await run(senders, messages, latencies)
+    elapsed = time.perf_counter() - t0
+    total = senders * messages
+    print(f'{label:<12} messages={total:<7} throughput={total / elapsed:9.1f} msg/s  '
+          f'commit p50={statistics.median(latencies) * 1000:7.2f} ms  p99={pct(latencies, 0.99) * 1000:7.2f} ms')
+
+
+async def main(args) -> None:
+    writer = PersonalMessageWriter(max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+    try:
+        await cleanup()
+        await timeit('per_message', per_message, args.senders, args.messages)
+        await cleanup()
+        await writer.start()
+        await timeit('batched', lambda s, m, lat: batched(s, m, lat, writer), args.senders, args.messages)
+        print('metrics:', writer.metrics())
+    finally:
+        await writer.stop()
+        await cleanup()
+        await dispose_db()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='私信写入：逐条事务 vs 批量写入器')
+    p.add_argument('--senders', type=int, default=200, help='模拟的并发连接数')
+    p.add_argument('--messages', type=int, default=50, help='每个连接发送的消息数')
+    p.add_argument('--max-batch', type=int, default=None, help='每批最多条数（默认 MSG_BATCH_MAX_SIZE）')
+    p.add_argument('--max-wait-ms', type=float, default=None, help='凑批等待毫秒数（默认 MSG_BATCH_MAX_WAIT_MS）')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
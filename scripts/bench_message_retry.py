@@ -0,0 +1,166 @@
+"""
+重试队列持久化基准：对比旧版单文件（每次确认整文件重写）与分段追加日志 `RetryLog`
+排空大量待重试消息的耗时。不需要数据库。
+
+用法：
+    python scripts/bench_message_retry.py --messages 100000 --legacy-messages 5000
+
+流程（两种实现相同）：先逐条入队 `--messages` 条，其中 `--retry-ratio` 比例的消息失败一次、
+追加一次重试更新，然后逐条确认直到排空。旧版实现每次确认都要读写整个文件（O(n²)），
+默认只跑 `--legacy-messages` 条并按平方关系外推到 `--messages`。
+报告每种实现的入队 / 排空耗时、每秒确认数以及排空后残留的磁盘字节数。
+
+另外模拟 DB 故障期间的并发入队：`--concurrency` 个协程共入队 `--enqueue-messages` 条，对比
+旧版每条 `to_thread(open/append/close)` 与组提交写入器 `RetryLogWriter` 在各 fsync 策略下的入队吞吐。
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / '聊天和用户后端'))
+
+from retry_log import RetryLog, RetryLogWriter  # noqa: E402
+
+
+def make_item(n: int) -> dict:
+    return {'id': f'{n:032x}', 'seq': n, 'type': 'personal', 'retries': 0,
+            'payload': {'sender': n % 997, 'receiver': n % 991, 'content': f'bench message {n}', 'ts': None}}
+
+
+def disk_bytes(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(p.stat().st_size for p in pathlib.Path(path).glob('*') if p.is_file())
+
+
+def run_legacy(directory: str, n: int, retry_every: int):
+    path = os.path.join(directory, 'pending_messages.jsonl')
+
+    def append(obj):
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(obj, ensure_ascii=False) + '\n')
+
+    def remove(obj_id):
+        lines = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if json.loads(line).get('id') != obj_id:
+                    lines.append(line)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+
+    t0 = time.perf_counter()
+    items = [make_item(i) for i in range(n)]
+    for it in items:
+        append(it)
+    enq = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i, it in enumerate(items):
+        if retry_every and i % retry_every == 0:
+            append(dict(it, retries=1))
+        remove(it['id'])
+    return enq, time.perf_counter() - t0, disk_bytes(path)
+
+
+def run_segmented(directory: str, n: int, retry_every: int, segment_bytes):
+    path = os.path.join(directory, 'pending_messages.jsonl.d')
+    log = RetryLog(path, segment_bytes=segment_bytes)
+    log.open()
+    t0 = time.perf_counter()
+    items = [make_item(i) for i in range(n)]
+    for it in items:
+        log.put([it])
+    enq = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i, it in enumerate(items):
+        if retry_every and i % retry_every == 0:
+            log.put([dict(it, retries=1)])
+        log.ack([it['id']])
+    log.compact()
+    drain = time.perf_counter() - t0
+    metrics = log.metrics()
+    log.close()
+    return enq, drain, metrics['disk_bytes'], metrics
+
+
+async def run_concurrent_enqueue(directory: str, n: int, concurrency: int, fsync):
+    """`fsync` 为 None 时模拟旧版：每条消息在线程中打开文件、追加一行、关闭。"""
+    items = [make_item(i) for i in range(n)]
+    if fsync is None:
+        path = os.path.join(directory, 'pending_messages.jsonl')
+
+        def append(obj):
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(obj, ensure_ascii=False) + '\n')
+        enqueue = lambda it: asyncio.to_thread(append, it)  # noqa: E731
+        writer = None
+    else:
+        log = RetryLog(os.path.join(directory, f'pending_messages.jsonl.{fsync}.d'))
+        log.open()
+        writer = RetryLogWriter(log, fsync=fsync)
+        await writer.start()
+        enqueue = lambda it: writer.put([it])  # noqa: E731
+
+    async def producer(k):
+        for it in items[k::concurrency]:
+            await enqueue(it)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(producer(k) for k in range(concurrency)))
+    if writer is not None:
+        await writer.stop()
+    elapsed = time.perf_counter() - t0
+    if writer is not None:
+        log.close()
+        return elapsed, {**writer.metrics(), 'fsyncs': log.stats['fsyncs']}
+    return elapsed, {}
+
+
+def report(label: str, n: int, enq: float, drain: float, disk: int, note: str = '') -> None:
+    print(f'{label:<10} messages={n:<7} enqueue={enq:8.2f}s  drain={drain:9.2f}s  '
+          f'acks/s={n / drain if drain else float("inf"):10.0f}  disk_after={disk:>9} B {note}')
+
+
+def main(args) -> None:
+    retry_every = int(1 / args.retry_ratio) if args.retry_ratio > 0 else 0
+    with tempfile.TemporaryDirectory() as tmp:
+        enq, drain, disk, metrics = run_segmented(tmp, args.messages, retry_every, args.segment_bytes)
+        report('segmented', args.messages, enq, drain, disk)
+        print('  log metrics:', metrics)
+    if args.legacy_messages > 0:
+        with tempfile.TemporaryDirectory() as tmp:
+            n = min(args.legacy_messages, args.messages)
+            enq, drain, disk = run_legacy(tmp, n, retry_every)
+            report('legacy', n, enq, drain, disk)
+            if n < args.messages:
+                scale = (args.messages / n) ** 2
+                print(f'  legacy drain extrapolated to {args.messages} messages: ~{drain * scale:,.0f}s (O(n²))')
+    if args.enqueue_messages > 0:
+        print(f'concurrent enqueue: messages={args.enqueue_messages} concurrency={args.concurrency}')
+        for fsync in (None, 'none', 'interval', 'batch'):
+            with tempfile.TemporaryDirectory() as tmp:
+                elapsed, metrics = asyncio.run(run_concurrent_enqueue(tmp, args.enqueue_messages, args.concurrency, fsync))
+            label = 'legacy' if fsync is None else f'fsync={fsync}'
+            extra = f"commits={metrics['commits']} largest={metrics['largest_commit']} fsyncs={metrics['fsyncs']}" if metrics else ''
+            print(f'  {label:<15} {elapsed:7.2f}s  enqueues/s={args.enqueue_messages / elapsed:9.0f}  {extra}')
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='重试队列：整文件重写 vs 分段追加日志')
+    p.add_argument('--messages', type=int, default=100000, help='待重试消息数')
+    p.add_argument('--legacy-messages', type=int, default=5000, help='旧版实现实际运行的消息数（0 表示跳过）')
+    p.add_argument('--retry-ratio', type=float, default=0.1, help='失败一次、追加重试更新的消息比例')
+    p.add_argument('--enqueue-messages', type=int, default=20000, help='并发入队基准的消息数（0 表示跳过）')
+    p.add_argument('--concurrency', type=int, default=64, help='并发入队的协程数')
+    p.add_argument('--segment-bytes', type=int, default=None, help='段大小（默认 MSG_RETRY_SEGMENT_BYTES）')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
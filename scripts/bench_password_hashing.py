@@ -0,0 +1,98 @@
+"""
+登录密码校验基准：对比在事件循环内直接调用 argon2.verify（旧 /user_login 路径）与
+`PasswordHasher`（独立进程池）在突发登录下的吞吐、登录延迟与事件循环延迟。
+
+用法（无需数据库）：
+    python scripts/bench_password_hashing.py --rate 200 --seconds 5 --workers 4
+
+按 `--rate` 次/秒的节奏发起 `--seconds` 秒的校验请求；同时运行一个每 5ms 唤醒一次的探针任务，
+其实际唤醒时间与预期之差即事件循环延迟（阻塞期间 WebSocket 等其它协程同样无法得到调度）。
+"""
+import argparse
+import asyncio
+import pathlib
+import statistics
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / '聊天和用户后端'))
+
+from password_hashing import PasswordHasher, argon2  # noqa: E402
+
+PROBE_INTERVAL = 0.005
+
+
+def pct(samples, q):
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+async def probe(lags, stop):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - t0 - PROBE_INTERVAL))
+
+
+async def run(label, verify, password, stored, rate, seconds):
+    lags, latencies = [], []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+
+    async def one_login():
+        t0 = time.perf_counter()
+        assert await verify(password, stored)
+        latencies.append(time.perf_counter() - t0)
+
+    total = int(rate * seconds)
+    start = time.perf_counter()
+    tasks = []
+    for i in range(total):
+        # 按固定节奏发起（若事件循环被阻塞，发起本身也会落后）
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one_login()))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+
+    print(f'{label:<14} logins={total:<6} throughput={total / elapsed:8.1f}/s  '
+          f'latency p50={statistics.median(latencies) * 1000:8.1f} ms p99={pct(latencies, 0.99) * 1000:8.1f} ms  '
+          f'loop lag p99={pct(lags, 0.99) * 1000:8.1f} ms max={max(lags) * 1000:8.1f} ms')
+
+
+async def main(args):
+    password = 'correct horse battery staple'
+    stored = argon2.hash(password)
+
+    async def inline_verify(p, h):
+        return argon2.verify(p, h)
+
+    await run('inline', inline_verify, password, stored, args.rate, args.seconds)
+
+    hasher = PasswordHasher(max_workers=args.workers)
+    await hasher.start()
+    try:
+        await run('process_pool', hasher.verify, password, stored, args.rate, args.seconds)
+        print('metrics:', hasher.metrics())
+    finally:
+        await hasher.stop()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='argon2 校验：事件循环内联 vs 进程池')
+    p.add_argument('--rate', type=float, default=200.0, help='每秒发起的登录数')
+    p.add_argument('--seconds', type=float, default=5.0, help='突发持续时间（秒）')
+    p.add_argument('--workers', type=int, default=None, help='进程池大小（默认 PASSWORD_HASH_WORKERS）')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    if argon2 is None:
+        sys.exit('需要安装 passlib 与 argon2-cffi')
+    asyncio.run(main(parse_args()))
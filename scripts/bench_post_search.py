@@ -0,0 +1,106 @@
+"""
+帖子搜索基准：对比“全表读取 + Python 子串过滤”（旧 /search_posts 路径）与
+`adapter.search_posts`（pg_trgm GIN 索引 + SQL 分页）。
+
+用法（需已设置 DATABASE_URL 指向可写的测试库）：
+    python scripts/bench_post_search.py --posts 100000 --keyword 物业费 --repeat 5
+
+脚本会向 posts 表插入 `--posts` 条 section=__bench_search__ 的合成帖子，
+执行 ensure_schema_upgrades() 与 ANALYZE 后分别计时，结束时删除这些帖子（--keep 可保留）。
+注意：不要在生产库上运行。
+"""
+import argparse
+import asyncio
+import pathlib
+import random
+import statistics
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from sqlalchemy import delete, insert, text  # noqa: E402
+
+from postgres_data import adapter  # noqa: E402
+from postgres_data.db_session import AsyncSessionLocal, dispose_db  # noqa: E402
+from postgres_data.models import Post  # noqa: E402
+
+BENCH_SECTION = '__bench_search__'
+WORDS = ['物业费', '业主委员会', '维修基金', '租赁合同', '押金', '噪音', '停车位', '电梯', '漏水', '公共收益',
+         '装修', '违约金', '物业服务', '小区', '投诉', '起诉', '证据', '调解', '仲裁', '判决']
+
+
+def _fake_text(rng: random.Random, n_words: int) -> str:
+    return '，'.join(rng.choice(WORDS) + rng.choice(['问题', '纠纷', '怎么办', '咨询', '处理']) for _ in range(n_words))
+
+
+async def seed(n: int) -> None:
+    rng = random.Random(42)
+    batch = 5000
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            for start in range(0, n, batch):
+                rows = [{
+                    'title': _fake_text(rng, 2),
+                    'content': _fake_text(rng, 30),
+                    'section': BENCH_SECTION,
+                } for _ in range(min(batch, n - start))]
+                await session.execute(insert(Post), rows)
+    applied = await adapter.ensure_schema_upgrades()
+    async with AsyncSessionLocal() as session:
+        await session.execute(text('ANALYZE posts'))
+    print(f'seeded {n} posts, schema upgrades applied={applied}')
+
+
+async def cleanup() -> None:
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await session.execute(delete(Post).where(Post.section == BENCH_SECTION))
+
+
+async def legacy_scan(keyword: str) -> int:
+    rows = await adapter.fetch_posts_rows(None)
+    k = keyword.lower().strip()
+    return len([p for p in rows if k in p.get('title', '').lower() or k in p.get('content', '').lower()])
+
+
+async def indexed_search(keyword: str) -> int:
+    result = await adapter.search_posts(keyword, limit=20)
+    return result['total']
+
+
+async def timeit(label: str, fn, keyword: str, repeat: int) -> None:
+    samples = []
+    hits = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        hits = await fn(keyword)
+        samples.append((time.perf_counter() - t0) * 1000)
+    print(f'{label:<16} hits={hits:<8} median={statistics.median(samples):9.1f} ms  max={max(samples):9.1f} ms')
+
+
+async def main(args) -> None:
+    try:
+        if args.posts > 0:
+            await seed(args.posts)
+        await timeit('legacy_scan', legacy_scan, args.keyword, args.repeat)
+        await timeit('search_posts', indexed_search, args.keyword, args.repeat)
+    finally:
+        if args.posts > 0 and not args.keep:
+            await cleanup()
+        await dispose_db()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='对比帖子搜索的全表扫描与 pg_trgm 索引路径')
+    p.add_argument('--posts', type=int, default=100000, help='插入的合成帖子数（0 表示使用现有数据）')
+    p.add_argument('--keyword', default='物业费', help='搜索关键词')
+    p.add_argument('--repeat', type=int, default=5, help='每种路径的重复次数')
+    p.add_argument('--keep', action='store_true', help='结束后保留合成数据')
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -55,8 +55,8 @@ except Exception:
 #   import asyncio
 #   asyncio.set_event_loop_policy(asyncio.SelectorEventLoopPolicy())
 
-from postgres_data import models
-from postgres_data.db_session import AsyncSessionLocal
+from postgres_data import adapter, models
+from postgres_data.db_session import AsyncSessionLocal, engine
 def find_data_files(data_dir: str) -> List[Path]:
     p = Path(data_dir)
     if not p.exists():
@@ -188,6 +188,10 @@ async def import_dir(data_dir: str, commit: bool = False):
         logging.info('未启用 --commit，退出（dry-run）')
         return
 
+    # 服务从未启动过时 data_versions 表可能还不存在：先建表，避免递增版本号失败连带回滚导入的数据
+    async with engine.begin() as conn:
+        await conn.run_sync(models.DataVersion.__table__.create, checkfirst=True)
+
     # 如果要写入，先处理 regions 表（去重插入），再插入 cases 并关联 region_id
     async with AsyncSessionLocal() as session:
         from sqlalchemy import select
@@ -220,6 +224,11 @@ async def import_dir(data_dir: str, commit: bool = False):
             inserted_rel += 1
 
         try:
+            # 与数据写入同一事务递增版本号，运行中的服务据此刷新参考数据缓存
+            if inserted_rel:
+                await adapter.bump_data_version('example_relation', session)
+            if inserted_leg:
+                await adapter.bump_data_version('example_legal', session)
             await session.commit()
             logging.info('已插入 %d 条 ExampleRelation，%d 条 ExampleLegal', inserted_rel, inserted_leg)
         except Exception:
@@ -98,12 +98,28 @@ CREATE TABLE IF NOT EXISTS example_legal (
 );
 """
 
+# Reference-data version counters (models.DataVersion). Running servers poll
+# these to invalidate their in-process caches after an import.
+CREATE_DATA_VERSIONS = """
+CREATE TABLE IF NOT EXISTS data_versions (
+    name        VARCHAR(64) PRIMARY KEY,
+    version     BIGINT NOT NULL DEFAULT 0,
+    updated_at  TIMESTAMPTZ DEFAULT NOW()
+);
+"""
+
+BUMP_DATA_VERSION = (
+    "INSERT INTO data_versions (name, version, updated_at) VALUES (:name, 1, NOW()) "
+    "ON CONFLICT (name) DO UPDATE SET version = data_versions.version + 1, updated_at = NOW()"
+)
+
 
 def create_tables(conn) -> None:
     """Create migration target tables if they do not already exist."""
     log.info("Ensuring tables exist...")
     conn.execute(text(CREATE_EXAMPLE_RELATION))
     conn.execute(text(CREATE_EXAMPLE_LEGAL))
+    conn.execute(text(CREATE_DATA_VERSIONS))
     log.info("Table check complete.")
 
 
@@ -263,8 +279,12 @@ def main() -> int:
     try:
         with engine.begin() as conn:
             create_tables(conn)
-            import_example_relation(conn, case_file)
-            import_example_legal(conn, legal_file)
+            # Bump versions in the same transaction so caches never see
+            # a new version without the rows that produced it.
+            if import_example_relation(conn, case_file):
+                conn.execute(text(BUMP_DATA_VERSION), {"name": "example_relation"})
+            if import_example_legal(conn, legal_file):
+                conn.execute(text(BUMP_DATA_VERSION), {"name": "example_legal"})
         log.info("Migration completed successfully.")
         return 0
     except Exception as exc:
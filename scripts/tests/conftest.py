@@ -0,0 +1,79 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# 在收集阶段绑定真实 adapter（其它测试会用 SimpleNamespace 替换 sys.modules 中的条目）
+from postgres_data import adapter  # noqa: E402
+from postgres_data import models  # noqa: E402
+
+
+class _AsyncTxShim:
+    def __init__(self, session):
+        self._session = session
+
+    async def __aenter__(self):
+        self._tx = self._session.begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self._tx.__exit__(exc_type, exc, tb)
+
+
+class _AsyncSessionShim:
+    """用同步 sqlite session 模拟 AsyncSession，仅覆盖 adapter 用到的接口。"""
+
+    def __init__(self, session):
+        self._session = session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self._session.close()
+        return False
+
+    def begin(self):
+        return _AsyncTxShim(self._session)
+
+    def add(self, obj):
+        self._session.add(obj)
+
+    async def flush(self):
+        self._session.flush()
+
+    async def execute(self, stmt, params=None):
+        return self._session.execute(stmt, params)
+
+    async def commit(self):
+        self._session.commit()
+
+
+@pytest.fixture
+def sqlite_sessionmaker(monkeypatch):
+    """内存 sqlite + 建表，并把 adapter 的 session 工厂指向它；返回 (Session, statements)。"""
+    engine = create_engine('sqlite://')
+    statements = []
+
+    # sqlite 没有 pg_trgm：注册一个粗略的 similarity 以便执行排序表达式
+    @event.listens_for(engine, 'connect')
+    def _register_similarity(dbapi_conn, record):
+        dbapi_conn.create_function('similarity', 2, lambda a, b: 1.0 if b and b in (a or '') else 0.0)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    models.Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+    monkeypatch.setattr(adapter, '_get_sync_session', lambda: Session())
+    monkeypatch.setattr(adapter, 'AsyncSessionLocal', lambda: _AsyncSessionShim(Session()))
+    return Session, statements
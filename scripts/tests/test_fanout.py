@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from 聊天和用户后端.fanout import NOTIFY_PAYLOAD_LIMIT, InProcessBroker, InProcessPubSub, PostgresPubSub, PubSub
+
+
+class Worker:
+    """模拟一个 uvicorn worker：本地连接表 + 扇出层。"""
+    def __init__(self, broker, users):
+        self.users = set(users)
+        self.inbox = []
+        self.pubsub = InProcessPubSub(broker)
+
+    async def deliver(self, user, message):
+        if user not in self.users:
+            return False
+        self.inbox.append((user, message))
+        return True
+
+
+@pytest.mark.asyncio
+async def test_message_reaches_worker_holding_receiver():
+    broker = InProcessBroker()
+    a, b = Worker(broker, ['1']), Worker(broker, ['2'])
+    for w in (a, b):
+        await w.pubsub.start(w.deliver)
+    try:
+        for i in range(3):
+            await a.pubsub.publish('2', {'type': 'message', 'n': i})
+        await a.pubsub.publish('3', {'type': 'message'})
+        await asyncio.sleep(0.01)
+    finally:
+        for w in (a, b):
+            await w.pubsub.stop()
+    # 按发布顺序投递；发布者忽略自己的回声
+    assert b.inbox == [('2', {'type': 'message', 'n': i}) for i in range(3)]
+    assert a.inbox == []
+    assert b.pubsub.stats['delivered'] == 3 and b.pubsub.stats['dropped'] == 1
+    assert a.pubsub.stats['received'] == 0
+
+
+@pytest.mark.asyncio
+async def test_postgres_envelopes_are_chunked_and_reassembled():
+    sender, receiver = PostgresPubSub('postgresql://unused'), PostgresPubSub('postgresql://unused')
+    got = []
+
+    async def deliver(user, message):
+        got.append((user, message))
+        return True
+
+    # 不连接数据库：只启动接收端的投递任务，手工把通知喂给 _on_notify
+    await PubSub.start(receiver, deliver)
+    try:
+        big = {'type': 'message', 'content': '长' * 10000}
+        payloads = sender._encode({'o': sender.origin, 'u': '2', 'm': big})
+        assert len(payloads) > 1 and all(len(p.encode('utf-8')) <= NOTIFY_PAYLOAD_LIMIT for p in payloads)
+        for p in reversed(payloads):
+            receiver._on_notify(None, 0, receiver.channel, p)
+        small = sender._encode({'o': sender.origin, 'u': '2', 'm': {'type': 'ack'}})
+        assert len(small) == 1
+        receiver._on_notify(None, 0, receiver.channel, small[0])
+        # 自己发布的通知被忽略
+        receiver._on_notify(None, 0, receiver.channel, receiver._encode({'o': receiver.origin, 'u': '2', 'm': {}})[0])
+        await asyncio.sleep(0.01)
+    finally:
+        await PubSub.stop(receiver)
+    assert got == [('2', big), ('2', {'type': 'ack'})]
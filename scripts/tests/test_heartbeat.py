@@ -0,0 +1,74 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from 聊天和用户后端.heartbeat import HEARTBEAT_TIMEOUT_CLOSE_CODE, IDLE_TIMEOUT_CLOSE_CODE, HeartbeatReaper
+from 聊天和用户后端.outbound import ClientConnection
+from 聊天和用户后端.presence import PresenceRegistry
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+@pytest.mark.asyncio
+async def test_sweep_pings_live_and_reaps_dead_connections():
+    presence = PresenceRegistry(flush_interval=60)
+    conns = {}
+
+    def on_close(conn):
+        conns.pop(conn.id, None)
+        presence.disconnected(conn.presence_id)
+
+    for uid in (1, 2, 3):
+        c = ClientConnection(str(uid), FakeSocket(), presence_id=uid, on_close=on_close)
+        c.start()
+        conns[c.id] = c
+        presence.connected(uid)
+    live, dead, idle = list(conns.values())
+    reaper = HeartbeatReaper(lambda: conns.values(), ping_interval=20, pong_timeout=10, idle_timeout=300)
+
+    now = live.last_seen + 35
+    live.last_seen = live.last_activity = now - 5
+    idle.last_seen = now - 5
+    idle.last_activity = now - 301
+    counts = reaper.sweep(now)
+    await asyncio.sleep(0.01)
+
+    assert counts == {'pings_sent': 1, 'reaped_dead': 1, 'reaped_idle': 1}
+    assert list(conns.values()) == [live]
+    assert json.loads(live.websocket.sent[0])['type'] == 'ping'
+    assert dead.websocket.closed_with == HEARTBEAT_TIMEOUT_CLOSE_CODE
+    assert idle.websocket.closed_with == IDLE_TIMEOUT_CLOSE_CODE
+    # 回收触发 offline 转换
+    assert presence.lookup([1, 2, 3]) == {1: 'online', 2: 'offline', 3: 'offline'}
+    assert reaper.metrics()['reaped_dead'] == 1
+    live.close()
+
+
+@pytest.mark.asyncio
+async def test_idle_timeout_disabled_by_default_and_pong_keeps_alive():
+    conn = ClientConnection('1', FakeSocket())
+    conn.start()
+    reaper = HeartbeatReaper(lambda: [conn], ping_interval=20, pong_timeout=10, idle_timeout=0)
+    start = conn.last_seen
+    conn.last_seen = start + 1000
+    assert reaper.sweep(start + 1010) == {'pings_sent': 1, 'reaped_dead': 0, 'reaped_idle': 0}
+    assert not conn.closed
+    conn.close()
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from 聊天和用户后端.identity_cache import IdentityCache
+
+
+class FakeUsers:
+    def __init__(self, users):
+        self.users = {u['id']: u for u in users}
+        self.calls = []
+
+    async def by_id(self, uid):
+        self.calls.append(('id', uid))
+        await asyncio.sleep(0)
+        return dict(self.users.get(uid, {}))
+
+    async def by_username(self, name):
+        self.calls.append(('name', name))
+        await asyncio.sleep(0)
+        for u in self.users.values():
+            if u['username'] == name:
+                return dict(u)
+        return {}
+
+
+def _cache(db, **kw):
+    return IdentityCache(db.by_id, db.by_username, **kw)
+
+
+ALICE = {'id': 1, 'username': 'alice', 'identity': 'owner', 'role': 'user', 'location': '北京', 'state': 'online', 'friends': [2]}
+
+
+@pytest.mark.asyncio
+async def test_hits_share_entry_between_id_and_username():
+    db = FakeUsers([ALICE])
+    cache = _cache(db)
+    profile = await cache.get_by_username('alice')
+    assert profile == {'id': 1, 'username': 'alice', 'identity': 'owner', 'role': 'user', 'location': '北京'}
+    # 按 id 查询命中同一条目，且返回副本
+    profile['username'] = 'mutated'
+    assert (await cache.get_by_id(1))['username'] == 'alice'
+    assert await cache.resolve('alice') and await cache.resolve(1)
+    assert db.calls == [('name', 'alice')]
+    m = cache.metrics()
+    assert m['hits'] == 3 and m['misses'] == 1 and m['hit_rate'] == 0.75
+
+
+@pytest.mark.asyncio
+async def test_negative_caching_and_put_on_register():
+    db = FakeUsers([ALICE])
+    cache = _cache(db)
+    assert await cache.get_by_username('bob') is None
+    assert await cache.get_by_username('bob') is None
+    assert db.calls == [('name', 'bob')] and cache.stats['negative_hits'] == 1
+
+    bob = {'id': 2, 'username': 'bob', 'identity': None, 'role': 'user', 'location': None}
+    db.users[2] = bob
+    cache.put(bob)
+    assert (await cache.get_by_username('bob'))['id'] == 2
+    assert (await cache.get_by_id(2))['username'] == 'bob'
+    assert db.calls == [('name', 'bob')]
+
+
+@pytest.mark.asyncio
+async def test_resolve_numeric_falls_back_to_id():
+    db = FakeUsers([ALICE])
+    cache = _cache(db)
+    assert (await cache.resolve('1'))['username'] == 'alice'
+    assert db.calls == [('name', '1'), ('id', 1)]
+    assert (await cache.resolve('1'))['id'] == 1
+    assert len(db.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_ttl_lru_and_invalidate(monkeypatch):
+    db = FakeUsers([ALICE, {'id': 2, 'username': 'bob'}, {'id': 3, 'username': 'carol'}])
+    cache = _cache(db, max_size=4, ttl=10, negative_ttl=1)
+    await cache.get_by_id(1)
+    await cache.get_by_id(2)
+    await cache.get_by_id(1)  # alice 最近使用
+    await cache.get_by_id(3)
+    assert cache.stats['evictions'] == 2
+    assert cache.metrics()['size'] == 4
+    await cache.get_by_id(1)
+    assert db.calls.count(('id', 1)) == 1
+
+    cache.invalidate(username='alice')
+    await cache.get_by_id(1)
+    assert db.calls.count(('id', 1)) == 2
+
+    import 聊天和用户后端.identity_cache as mod
+    now = mod.time.monotonic()
+    monkeypatch.setattr(mod.time, 'monotonic', lambda: now + 11)
+    await cache.get_by_id(1)
+    assert db.calls.count(('id', 1)) == 3 and cache.stats['expirations'] >= 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_load_once_and_errors_not_cached():
+    db = FakeUsers([ALICE])
+    cache = _cache(db)
+    results = await asyncio.gather(*(cache.get_by_id(1) for _ in range(10)))
+    assert all(r['username'] == 'alice' for r in results)
+    assert db.calls == [('id', 1)] and cache.stats['coalesced'] == 9
+
+    async def boom(uid):
+        raise RuntimeError('db down')
+
+    failing = IdentityCache(boom, db.by_username)
+    with pytest.raises(RuntimeError):
+        await failing.get_by_id(5)
+    with pytest.raises(RuntimeError):
+        await failing.get_by_id(5)
+    assert failing.stats['load_errors'] == 2
+
+
+@pytest.mark.asyncio
+async def test_invalidation_reaches_other_workers():
+    from 聊天和用户后端.fanout import InProcessBroker, InProcessPubSub
+
+    db = FakeUsers([ALICE])
+    broker = InProcessBroker()
+    caches = []
+    for _ in range(2):
+        pubsub = InProcessPubSub(broker)
+        cache = _cache(db, publish=lambda m, p=pubsub: p.publish('identity', m))
+
+        async def deliver(key, message, cache=cache):
+            cache.apply_remote(message)
+            return True
+
+        await pubsub.start(deliver)
+        caches.append((cache, pubsub))
+    a, b = caches[0][0], caches[1][0]
+    try:
+        # b 缓存了“查无此人”，a 上注册后 b 立即可见
+        assert await b.get_by_username('bob') is None
+        db.users[2] = {'id': 2, 'username': 'bob', 'identity': 'x', 'role': 'user', 'location': '上海'}
+        a.put(db.users[2])
+        await asyncio.sleep(0.01)
+        assert (await b.get_by_username('bob'))['id'] == 2
+
+        assert (await b.get_by_id(1))['username'] == 'alice'
+        a.clear()
+        await asyncio.sleep(0.01)
+        assert b.metrics()['size'] == 0 and b.stats['remote_invalidations'] == 2
+    finally:
+        for _, pubsub in caches:
+            await pubsub.stop()
@@ -0,0 +1,94 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from postgres_data import adapter
+from postgres_data import models
+
+
+@pytest.fixture
+def chat_db(sqlite_sessionmaker):
+    Session, statements = sqlite_sessionmaker
+    base = datetime.datetime(2026, 3, 1, 9, 0)
+    with Session() as s:
+        s.add_all([models.User(id=i, username=f'u{i}') for i in (1, 2, 3)])
+        for i in range(1, 31):
+            # 每两条共享时间戳（覆盖按 id 断开的情况）；其间夹杂与第三人的消息
+            sender, receiver = (1, 2) if i % 3 else (2, 1)
+            if i % 7 == 0:
+                sender, receiver = 1, 3
+            s.add(models.PersonalMessage(id=i, sender=sender, receiver=receiver, content=f'm{i}',
+                                         created_at=base + datetime.timedelta(seconds=i // 2)))
+            s.add(models.GroupMessage(id=i, group_name='g1' if i % 2 else 'g2', sender=1, content=f'g{i}',
+                                      created_at=base + datetime.timedelta(seconds=i // 2)))
+        s.commit()
+    statements.clear()
+    return statements
+
+
+def _pair_ids():
+    return [i for i in range(1, 31) if i % 7]
+
+
+@pytest.mark.asyncio
+async def test_personal_history_pages_backwards_and_syncs_forwards(chat_db):
+    full = await adapter.fetch_personal_messages(1, 2)
+    assert [m['id'] for m in full] == _pair_ids()
+
+    chat_db.clear()
+    latest = await adapter.fetch_personal_messages(2, 1, limit=5)
+    assert len(chat_db) == 1
+    assert [m['id'] for m in latest] == _pair_ids()[-5:]
+
+    collected, before = [m['id'] for m in latest], latest[0]['id']
+    while True:
+        page = await adapter.fetch_personal_messages(1, 2, limit=5, before_id=before)
+        if not page:
+            break
+        collected = [m['id'] for m in page] + collected
+        before = page[0]['id']
+    assert collected == _pair_ids()
+
+    newer = await adapter.fetch_personal_messages(1, 2, limit=4, after_id=13)
+    assert [m['id'] for m in newer] == [15, 16, 17, 18]
+    assert await adapter.fetch_personal_messages(1, 2, limit=4, after_id=30) == []
+
+
+@pytest.mark.asyncio
+async def test_group_history_cursor_window(chat_db):
+    latest = await adapter.fetch_group_messages('g1', limit=3)
+    assert [m['id'] for m in latest] == [25, 27, 29]
+    assert latest[0]['group'] == 'g1'
+    older = await adapter.fetch_group_messages('g1', limit=3, before_id=25)
+    assert [m['id'] for m in older] == [19, 21, 23]
+    newer = await adapter.fetch_group_messages('g2', limit=10, after_id=26)
+    assert [m['id'] for m in newer] == [28, 30]
+
+
+@pytest.mark.asyncio
+async def test_conversations_aggregate_with_read_cursor(chat_db):
+    chat_db.clear()
+    convs = await adapter.fetch_conversations(1)
+    assert len(chat_db) == 1
+    assert [c['peer_id'] for c in convs] == [2, 3]
+    assert convs[0]['peer_username'] == 'u2'
+    assert convs[0]['last_message']['id'] == 30 and convs[0]['last_message']['content'] == 'm30'
+    # 2 -> 1 的消息：i % 3 == 0 且 i % 7 != 0
+    from_2 = [i for i in range(1, 31) if i % 3 == 0 and i % 7]
+    assert convs[0]['unread'] == len(from_2)
+    assert convs[1]['unread'] == 0
+
+    await adapter.mark_conversation_read(1, 2, 18)
+    await adapter.mark_conversation_read(1, 2, 9)   # 游标不会回退
+    convs = await adapter.fetch_conversations(1)
+    assert convs[0]['unread'] == len([i for i in from_2 if i > 18])
+
+    other_side = await adapter.fetch_conversations(3)
+    assert [(c['peer_id'], c['unread']) for c in other_side] == [(1, 4)]
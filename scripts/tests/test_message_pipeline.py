@@ -0,0 +1,147 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from postgres_data import adapter
+from 聊天和用户后端.message_pipeline import PersonalMessageWriter
+from 聊天和用户后端.message_retry import MessageRetryManager
+
+
+@pytest.mark.asyncio
+async def test_bulk_insert_single_statement_keeps_order(sqlite_sessionmaker):
+    _, statements = sqlite_sessionmaker
+    rows = await adapter.create_personal_messages_bulk([(1, 2, 'a'), (2, 1, 'b'), (1, 2, 'c')])
+    assert [(r['sender'], r['receiver'], r['content']) for r in rows] == [(1, 2, 'a'), (2, 1, 'b'), (1, 2, 'c')]
+    assert [r['id'] for r in rows] == sorted(r['id'] for r in rows)
+    assert len([q for q in statements if q.lstrip().upper().startswith('INSERT')]) == 1
+    assert [m['content'] for m in await adapter.fetch_personal_messages(1, 2)] == ['a', 'b', 'c']
+
+
+@pytest.mark.asyncio
+async def test_messages_bulk_writes_personal_and_group_in_one_transaction(sqlite_sessionmaker):
+    _, statements = sqlite_sessionmaker
+    personal, group = await adapter.create_messages_bulk([(1, 2, 'a'), (2, 1, 'b')], [('g', 1, 'x'), ('g', 2, 'y')])
+    assert [r['content'] for r in personal] == ['a', 'b']
+    assert [(r['group'], r['content']) for r in group] == [('g', 'x'), ('g', 'y')]
+    assert len([q for q in statements if q.lstrip().upper().startswith('INSERT')]) == 2
+    assert await adapter.create_messages_bulk([], []) == ([], [])
+
+
+@pytest.mark.asyncio
+async def test_client_msg_id_makes_writes_idempotent(sqlite_sessionmaker):
+    first = await adapter.create_personal_messages_bulk([(1, 2, 'a', 'c-1'), (1, 2, 'b', 'c-2')])
+    # 超时后整批重试：已提交的不会重复插入，返回已有的行且顺序与输入一致
+    again = await adapter.create_personal_messages_bulk([(1, 2, 'b', 'c-2'), (1, 2, 'c', 'c-3'), (1, 2, 'a', 'c-1')])
+    assert [r['id'] for r in again] == [first[1]['id'], again[1]['id'], first[0]['id']]
+    single = await adapter.create_personal_message(1, 2, 'a', client_msg_id='c-1')
+    assert single['id'] == first[0]['id'] and single['client_msg_id'] == 'c-1'
+    assert [m['content'] for m in await adapter.fetch_personal_messages(1, 2)] == ['a', 'b', 'c']
+
+    g1 = await adapter.create_group_message('g', 1, 'x', client_msg_id='g-1')
+    _, g2 = await adapter.create_messages_bulk([], [('g', 1, 'x', 'g-1'), ('g', 1, 'y')])
+    assert g2[0]['id'] == g1['id'] and g2[1]['client_msg_id']
+    assert [m['content'] for m in await adapter.fetch_group_messages('g')] == ['x', 'y']
+
+
+@pytest.mark.asyncio
+async def test_client_msg_id_is_scoped_to_the_sender(sqlite_sessionmaker):
+    mine = await adapter.create_personal_message(1, 2, 'mine', client_msg_id='same')
+    # 另一个用户复用同一个 id：照常写入，也不会拿到别人的消息
+    theirs = await adapter.create_personal_message(3, 2, 'theirs', client_msg_id='same')
+    assert theirs['id'] != mine['id'] and (theirs['sender'], theirs['content']) == (3, 'theirs')
+    _, group = await adapter.create_messages_bulk([], [('g', 1, 'a', 'same'), ('g', 3, 'b', 'same'), ('h', 1, 'c', 'same')])
+    assert [(r['sender'], r['content']) for r in group] == [(1, 'a'), (3, 'b'), (1, 'c')]
+    assert len({r['id'] for r in group}) == 3
+
+
+@pytest.mark.asyncio
+async def test_writer_batches_and_acks_in_order(sqlite_sessionmaker):
+    _, statements = sqlite_sessionmaker
+    writer = PersonalMessageWriter(max_batch=4, max_wait_ms=20)
+    await writer.start()
+    try:
+        futures = [await writer.submit(1, 2, f'm{i}') for i in range(10)]
+        rows = await asyncio.gather(*futures)
+    finally:
+        await writer.stop()
+    assert [r['content'] for r in rows] == [f'm{i}' for i in range(10)]
+    assert [r['id'] for r in rows] == sorted(r['id'] for r in rows)
+    m = writer.metrics()
+    assert m['messages'] == 10 and m['largest_batch'] == 4 and m['batches'] == 3
+    assert len([q for q in statements if q.lstrip().upper().startswith('INSERT')]) == 3
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_fails_every_message_and_stop_drains():
+    calls = []
+
+    async def flaky(rows):
+        calls.append(len(rows))
+        if len(calls) == 1:
+            raise RuntimeError('db down')
+        return [{'id': i, 'content': c} for i, (_, _, c, _) in enumerate(rows)]
+
+    writer = PersonalMessageWriter(write=flaky, max_batch=100, max_wait_ms=50)
+    await writer.start()
+    first = [await writer.submit(1, 2, 'x'), await writer.submit(1, 2, 'y')]
+    for f in first:
+        with pytest.raises(RuntimeError):
+            await f
+    later = await writer.submit(1, 2, 'z')
+    await writer.stop()
+    assert later.done() and later.result()['content'] == 'z'
+    assert writer.metrics()['failed_messages'] == 2 and calls == [2, 1]
+    # 停止后直接单条写入
+    assert (await writer.write(1, 2, 'w'))['content'] == 'w'
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_holds_its_conversation_until_retry_drains(tmp_path):
+    committed = []
+    release = asyncio.Event()
+
+    async def direct(rows):
+        if not committed and rows[0][2] == 'a':
+            raise RuntimeError('db blip')
+        committed.extend((s, r, c) for s, r, c, _ in rows)
+        return [{'id': len(committed), 'content': c} for _, _, c, _ in rows]
+
+    async def retried(personal, group):
+        await release.wait()
+        committed.extend(m[:3] for m in personal)
+        return [], []
+
+    async def ping():
+        return True
+
+    retry = MessageRetryManager(filepath=str(tmp_path / 'pending.jsonl'), retry_interval=60, write=retried, ping=ping)
+
+    async def divert(sender, receiver, content, client_msg_id, ts):
+        await retry.enqueue_personal(sender, receiver, content, ts, client_msg_id=client_msg_id)
+
+    writer = PersonalMessageWriter(write=direct, max_wait_ms=0, held=retry.has_pending_personal, divert=divert)
+    await retry.start()
+    await writer.start()
+    try:
+        assert await writer.write(1, 2, 'a') is None
+        # 'a' 仍在重试：同会话的 'b' 排到它后面，其它会话照常直接写入
+        assert await writer.write(2, 1, 'b') is None
+        assert (await writer.write(3, 4, 'c'))['content'] == 'c'
+        release.set()
+        for _ in range(50):
+            if not retry.has_pending_personal(1, 2):
+                break
+            await asyncio.sleep(0.01)
+        assert (await writer.write(1, 2, 'd'))['content'] == 'd'
+    finally:
+        await writer.stop()
+        await retry.stop()
+    assert [c for s, r, c in committed if {s, r} == {1, 2}] == ['a', 'b', 'd']
+    assert writer.metrics()['diverted'] == 2
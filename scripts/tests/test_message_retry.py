@@ -1,10 +1,7 @@
 import asyncio
 import os
 import json
-import tempfile
 import sys
-import types
-import time
 import pytest
 
 # Ensure project root on sys.path so imports work
@@ -16,58 +13,61 @@ from 聊天和用户后端.message_retry import MessageRetryManager
 
 
 class DummyAdapter:
-    def __init__(self, fail_times=0):
+    def __init__(self, fail_times=0, db_up=True, poison=None):
         self.calls = 0
         self.fail_times = fail_times
+        self.db_up = db_up
+        self.poison = poison
+        self.batches = []
+        self.client_ids = []
 
-    async def create_personal_message(self, sender, receiver, content, ts=None):
+    async def create_messages_bulk(self, personal, group):
         self.calls += 1
-        if self.calls <= self.fail_times:
+        if self.calls <= self.fail_times or not self.db_up:
             raise RuntimeError("simulated transient db error")
-        return {'ok': True}
+        if self.poison is not None and any(m[2] == self.poison for m in personal + group):
+            raise RuntimeError("simulated bad row")
+        # 只记录 (sender/group, receiver/sender, content)，client_msg_id 另行断言
+        self.batches.append(([m[:3] for m in personal], [m[:3] for m in group]))
+        self.client_ids.extend(m[3] for m in personal + group)
+        return [{'ok': True}] * len(personal), [{'ok': True}] * len(group)
+
+    async def ping(self):
+        if not self.db_up:
+            raise RuntimeError("db down")
+        return True
 
-    async def create_group_message(self, group, sender, content, ts=None):
-        self.calls += 1
-        if self.calls <= self.fail_times:
-            raise RuntimeError("simulated transient db error")
-        return {'ok': True}
+
+def _manager(tmp_path, dummy, **kw):
+    return MessageRetryManager(filepath=str(tmp_path / "pending.jsonl"), write=dummy.create_messages_bulk, ping=dummy.ping, **kw)
 
 
 @pytest.mark.asyncio
 async def test_personal_message_retry_success(tmp_path, monkeypatch):
-    retry_file = tmp_path / "pending.jsonl"
-    # Monkeypatch postgres_data.adapter
     dummy = DummyAdapter(fail_times=1)
-    mod = types.SimpleNamespace(create_personal_message=dummy.create_personal_message, create_group_message=dummy.create_group_message)
-    sys.modules['postgres_data.adapter'] = mod
-
-    mgr = MessageRetryManager(filepath=str(retry_file), retry_interval=0.2, max_retries=3, max_queue_size=10)
+    mgr = _manager(tmp_path, dummy, retry_interval=0.2, max_retries=3, max_queue_size=10)
     await mgr.start()
-    await mgr.enqueue_personal('alice', 'bob', 'hello', 'ts1')
+    await mgr.enqueue_personal(1, 2, 'hello', 'ts1')
 
     # Wait enough time for one retry and eventual success
     await asyncio.sleep(1.0)
 
-    # Ensure file cleaned up (message should be removed on success)
-    contents = retry_file.read_text(encoding='utf-8') if retry_file.exists() else ''
-    assert contents.strip() == '' or contents.strip() == ''
+    # 成功写入后日志中不再有待重试消息
+    assert dummy.batches == [([(1, 2, 'hello')], [])]
+    assert mgr.metrics()['pending'] == 0 and mgr.metrics()['retried'] == 1
 
     await mgr.stop()
 
 
 @pytest.mark.asyncio
 async def test_dead_letter_on_max_retries(tmp_path, monkeypatch):
-    retry_file = tmp_path / "pending.jsonl"
     dead_file = tmp_path / "pending.jsonl.dead"
 
-    # Adapter always fails
+    # Adapter always fails while the DB itself is reachable
     dummy = DummyAdapter(fail_times=1000)
-    mod = types.SimpleNamespace(create_personal_message=dummy.create_personal_message, create_group_message=dummy.create_group_message)
-    sys.modules['postgres_data.adapter'] = mod
-
-    mgr = MessageRetryManager(filepath=str(retry_file), retry_interval=0.1, max_retries=2, max_queue_size=10, dead_letter=str(dead_file))
+    mgr = _manager(tmp_path, dummy, retry_interval=0.1, max_retries=2, max_queue_size=10, dead_letter=str(dead_file))
     await mgr.start()
-    await mgr.enqueue_personal('alice', 'bob', 'will fail', 'ts2')
+    await mgr.enqueue_personal(1, 2, 'will fail', 'ts2')
 
     # Wait longer than retries*interval
     await asyncio.sleep(1.0)
@@ -78,5 +78,114 @@ async def test_dead_letter_on_max_retries(tmp_path, monkeypatch):
     j = json.loads(dead_contents.strip().splitlines()[-1])
     assert j.get('type') == 'personal'
     assert j.get('payload', {}).get('content') == 'will fail'
+    assert mgr.metrics()['pending'] == 0
+
+    await mgr.stop()
+
 
-    await mgr.stop()
\ No newline at end of file
+@pytest.mark.asyncio
+async def test_drains_backlog_in_one_batch_on_enqueue(tmp_path):
+    dummy = DummyAdapter(db_up=False)
+    mgr = _manager(tmp_path, dummy, retry_interval=60, max_queue_size=100)
+    await mgr.start()
+    for n in range(5):
+        await mgr.enqueue_personal(1, 2, f'p{n}')
+    await mgr.enqueue_group('g', '7', 'hi')
+    await asyncio.sleep(0.05)
+    # DB 不可用不计入消息重试次数
+    assert mgr.metrics()['retried'] == 0 and mgr.metrics()['pending'] == 6
+    await mgr.stop()
+
+    # 重启后重放日志，一个事务写完全部积压，且会话内顺序不变
+    dummy.db_up = True
+    mgr = _manager(tmp_path, dummy, retry_interval=60, workers=1)
+    await mgr.start()
+    await asyncio.sleep(0.05)
+    assert dummy.batches == [([(1, 2, f'p{n}') for n in range(5)], [('g', '7', 'hi')])]
+    await mgr.stop()
+
+
+@pytest.mark.asyncio
+async def test_client_msg_id_is_carried_to_the_write(tmp_path):
+    dummy = DummyAdapter()
+    mgr = _manager(tmp_path, dummy, retry_interval=60)
+    await mgr.start()
+    await mgr.enqueue_personal(1, 2, 'a', client_msg_id='client-1')
+    await mgr.enqueue_group('g', '7', 'b')
+    await asyncio.sleep(0.05)
+    await mgr.stop()
+    # 未提供时使用队列项自身的 id，重放 / 重试都保持不变
+    assert dummy.client_ids[0] == 'client-1'
+    assert len(dummy.client_ids) == 2 and dummy.client_ids[1]
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_opens_while_db_is_down(tmp_path, monkeypatch):
+    monkeypatch.setenv('MSG_RETRY_BREAKER_THRESHOLD', '2')
+    monkeypatch.setenv('MSG_RETRY_BREAKER_COOLDOWN', '0.5')
+    dummy = DummyAdapter(db_up=False)
+    mgr = _manager(tmp_path, dummy, retry_interval=0.01)
+    await mgr.start()
+    await mgr.enqueue_personal(1, 2, 'x')
+    await asyncio.sleep(0.15)
+    # 连续两次失败后熔断，冷却期内不再尝试
+    assert mgr.metrics()['breaker']['state'] == 'open'
+    assert dummy.calls == 2
+    dummy.db_up = True
+    await asyncio.sleep(0.6)
+    assert mgr.metrics()['breaker']['state'] == 'closed'
+    assert dummy.batches == [([(1, 2, 'x')], [])]
+    await mgr.stop()
+
+
+@pytest.mark.asyncio
+async def test_bad_message_is_isolated_from_batch(tmp_path):
+    dummy = DummyAdapter(poison='bad')
+    mgr = _manager(tmp_path, dummy, retry_interval=60, max_queue_size=100)
+    await mgr.start()
+    for a, b, c in [(1, 2, 'a1'), (3, 4, 'bad'), (3, 4, 'after-bad'), (5, 6, 'c1')]:
+        await mgr.enqueue_personal(a, b, c)
+    await asyncio.sleep(0.05)
+    written = [c for p, _ in dummy.batches for _, _, c in p]
+    # 出错消息所在会话中排在它后面的消息继续等待，其它会话照常写入
+    assert sorted(written) == ['a1', 'c1']
+    assert mgr.metrics()['pending'] == 2 and mgr.metrics()['retried'] == 1
+    await mgr.stop()
+
+
+@pytest.mark.asyncio
+async def test_slow_conversation_does_not_block_other_partitions(tmp_path):
+    release = asyncio.Event()
+    written = []
+
+    async def write(personal, group):
+        if any(m[2].startswith('slow') for m in personal):
+            await release.wait()
+        written.extend(m[2] for m in personal)
+        return [], []
+
+    async def ping():
+        return True
+
+    mgr = MessageRetryManager(filepath=str(tmp_path / "pending.jsonl"), retry_interval=60, workers=4, write=write, ping=ping)
+    # 找两个落在不同分区的会话
+    slow = (1, 2)
+    fast = next((1, n) for n in range(3, 100) if mgr._partition(f'p:1:{n}') is not mgr._partition('p:1:2'))
+    await mgr.start()
+    await mgr.enqueue_personal(*slow, 'slow0')
+    await asyncio.sleep(0.01)
+    await mgr.enqueue_personal(*slow, 'slow1')
+    for n in range(3):
+        await mgr.enqueue_personal(*fast, f'fast{n}')
+    await asyncio.sleep(0.05)
+    assert written == ['fast0', 'fast1', 'fast2']
+    m = mgr.metrics()
+    busy = [p for p in m['partitions'] if p['in_flight']]
+    assert len(busy) == 1 and busy[0]['pending'] == 2 and busy[0]['lag_seconds'] > 0
+
+    release.set()
+    await asyncio.sleep(0.05)
+    # 同一会话内仍按入队顺序写入
+    assert written[3:] == ['slow0', 'slow1']
+    assert mgr.metrics()['pending'] == 0
+    await mgr.stop()
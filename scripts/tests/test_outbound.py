@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from 聊天和用户后端.outbound import DROP_OLDEST, SLOW_CONSUMER_CLOSE_CODE, ClientConnection
+
+
+class FakeSocket:
+    def __init__(self, blocked=False):
+        self.sent = []
+        self.closed_with = None
+        self.gate = asyncio.Event()
+        if not blocked:
+            self.gate.set()
+
+    async def send_text(self, text):
+        await self.gate.wait()
+        self.sent.append(text)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+@pytest.mark.asyncio
+async def test_messages_sent_in_order_by_writer_task():
+    ws = FakeSocket()
+    conn = ClientConnection('1', ws, max_queue=8)
+    conn.start()
+    for i in range(5):
+        assert conn.enqueue(f'm{i}')
+    await asyncio.sleep(0.01)
+    assert ws.sent == [f'm{i}' for i in range(5)] and conn.depth == 0
+    conn.close()
+    assert not conn.enqueue('late')
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_is_disconnected_without_blocking_sender():
+    ws = FakeSocket(blocked=True)
+    removed = []
+    conn = ClientConnection('1', ws, max_queue=3, on_close=removed.append)
+    conn.start()
+    # 第一条被写任务取走后阻塞在 send_text，其余进入队列
+    results = []
+    for i in range(6):
+        results.append(conn.enqueue(f'm{i}'))
+        await asyncio.sleep(0)
+    assert results == [True, True, True, True, False, False]
+    assert conn.closed and conn.slow_consumer and removed == [conn]
+    await asyncio.sleep(0)
+    assert ws.closed_with == SLOW_CONSUMER_CLOSE_CODE
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_policy_keeps_connection():
+    ws = FakeSocket(blocked=True)
+    conn = ClientConnection('1', ws, max_queue=2, policy=DROP_OLDEST)
+    conn.start()
+    conn.enqueue('m0')
+    await asyncio.sleep(0)
+    for i in range(1, 5):
+        assert conn.enqueue(f'm{i}')
+    ws.gate.set()
+    await asyncio.sleep(0.01)
+    assert ws.sent == ['m0', 'm3', 'm4'] and conn.stats['dropped'] == 2 and not conn.closed
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_send_failure_closes_connection():
+    class Broken(FakeSocket):
+        async def send_text(self, text):
+            raise RuntimeError('reset by peer')
+
+    removed = []
+    conn = ClientConnection('1', Broken(), on_close=removed.append)
+    conn.start()
+    conn.enqueue('x')
+    await asyncio.sleep(0.01)
+    assert conn.closed and removed == [conn]
@@ -0,0 +1,82 @@
+import asyncio
+import concurrent.futures
+import os
+import sys
+import time
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from 聊天和用户后端.password_hashing import PasswordHasher, PasswordHasherBusy, PasswordHasherUnavailable, argon2
+
+pytestmark = pytest.mark.skipif(argon2 is None, reason='需要 passlib + argon2-cffi')
+
+
+@pytest.mark.asyncio
+async def test_hash_and_verify_in_process_pool():
+    hasher = PasswordHasher(max_workers=1, max_queue=1)
+    await hasher.start()
+    try:
+        stored = await hasher.hash('s3cret')
+        assert stored.startswith('$argon2')
+        assert await hasher.verify('s3cret', stored)
+        assert not await hasher.verify('wrong', stored)
+
+        # 2 个执行槽位 + 1 个排队名额：第 4 个并发请求被拒绝
+        results = await asyncio.gather(*(hasher.verify('s3cret', stored) for _ in range(4)), return_exceptions=True)
+        assert sum(isinstance(r, PasswordHasherBusy) for r in results) == 1
+        m = hasher.metrics()
+        assert m['completed'] == 6 and m['rejected'] == 1 and m['waiting'] == 0 and m['in_flight'] == 0
+    finally:
+        await hasher.stop()
+
+
+@pytest.mark.asyncio
+async def test_broken_pool_is_shut_down_and_replaced():
+    hasher = PasswordHasher(max_workers=1)
+    await hasher.start()
+    try:
+        stored = await hasher.hash('s3cret')
+        broken = hasher._pool
+        shutdowns = []
+        shutdown = broken.shutdown
+        broken.shutdown = lambda *a, **kw: (shutdowns.append(kw), shutdown(*a, **kw))
+        for proc in list(broken._processes.values()):
+            proc.kill()
+            proc.join()
+        # 被杀后首个请求触发重建并成功；旧池已 shutdown，不再保留管理线程
+        assert await hasher.verify('s3cret', stored)
+        assert hasher._pool is not broken and hasher.metrics()['pool_restarts'] == 1
+        assert shutdowns == [{'wait': False, 'cancel_futures': True}]
+    finally:
+        await hasher.stop()
+
+
+class _AlwaysBroken(concurrent.futures.Executor):
+    def submit(self, fn, *args, **kwargs):
+        raise concurrent.futures.process.BrokenProcessPool('worker died')
+
+
+@pytest.mark.asyncio
+async def test_pool_failures_raise_unavailable():
+    hasher = PasswordHasher(max_workers=1)
+    # 重建后仍损坏：不把 BrokenProcessPool 原样抛给调用方
+    hasher._ensure_pool = _AlwaysBroken
+    with pytest.raises(PasswordHasherUnavailable):
+        await hasher.verify('s3cret', '$argon2id$x')
+
+    # 执行超时同样视为不可用，槽位照常释放
+    threads = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    hasher = PasswordHasher(max_workers=1, timeout=0.05)
+    hasher._ensure_pool = lambda: threads
+    try:
+        with pytest.raises(PasswordHasherUnavailable):
+            await hasher._run(time.sleep, 0.5)
+        m = hasher.metrics()
+        assert m['errors'] == 1 and m['in_flight'] == 0
+    finally:
+        threads.shutdown(wait=True)
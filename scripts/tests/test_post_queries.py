@@ -0,0 +1,157 @@
+import datetime
+import os
+import sys
+
+import pytest
+from sqlalchemy import text
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from postgres_data import adapter
+from postgres_data import models
+
+
+@pytest.fixture
+def sqlite_db(sqlite_sessionmaker):
+    Session, statements = sqlite_sessionmaker
+
+    with Session() as s:
+        s.add_all([models.User(id=1, username='alice'), models.User(id=2, username='bob')])
+        for i in range(1, 21):
+            # 每 3 帖共享同一时间戳，覆盖键集分页中 created_at 相同时按 id 断开的情况
+            created = datetime.datetime(2026, 1, 1) + datetime.timedelta(minutes=i // 3)
+            s.add(models.Post(id=i, title=f't{i}', content=f'c{i} 物业费' if i % 5 == 0 else f'c{i}', author_id=1 + i % 2,
+                              section='contract' if i % 2 else 'owners', created_at=created, last_activity_at=created))
+        s.flush()
+        for i in range(1, 21):
+            for j in range(i % 4):
+                s.add(models.Comment(post_id=i, author_name='bob', content=f'p{i}-c{j}'))
+        s.commit()
+
+    statements.clear()
+    return statements
+
+
+@pytest.mark.asyncio
+async def test_fetch_posts_rows_uses_two_statements(sqlite_db):
+    rows = await adapter.fetch_posts_rows()
+    assert len(rows) == 20
+    assert len(sqlite_db) == 2
+
+    by_id = {r['id']: r for r in rows}
+    assert by_id[3]['author'] == 'bob'
+    assert by_id[4]['author'] == 'alice'
+    assert [c['content'] for c in by_id[3]['comments']] == ['p3-c0', 'p3-c1', 'p3-c2']
+    assert by_id[4]['comments'] == []
+
+
+@pytest.mark.asyncio
+async def test_fetch_posts_rows_section_and_detail(sqlite_db):
+    rows = await adapter.fetch_posts_rows('owners')
+    assert {r['section'] for r in rows} == {'owners'}
+    assert len(rows) == 10
+
+    sqlite_db.clear()
+    post = await adapter.get_post_by_id(7)
+    assert post['title'] == 't7'
+    assert len(post['comments']) == 3
+    assert len(sqlite_db) == 2
+
+    assert await adapter.get_post_by_id(999) == {}
+
+
+def test_fetch_posts_rows_sync_matches_async(sqlite_db):
+    rows = adapter.fetch_posts_rows_sync()
+    assert len(rows) == 20
+    assert len(sqlite_db) == 2
+    assert sum(len(r['comments']) for r in rows) == sum(i % 4 for i in range(1, 21))
+
+
+@pytest.mark.asyncio
+async def test_fetch_posts_page_walks_all_posts_in_order(sqlite_db):
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        sqlite_db.clear()
+        page = await adapter.fetch_posts_page(limit=6, cursor=cursor)
+        assert len(sqlite_db) == 2
+        seen.extend(p['id'] for p in page['posts'])
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert pages == 4
+    # created_at 倒序、同一时间戳内 id 倒序，且无重复/遗漏
+    assert seen == sorted(range(1, 21), key=lambda i: (i // 3, i), reverse=True)
+
+
+@pytest.mark.asyncio
+async def test_fetch_posts_page_filters_in_sql(sqlite_db):
+    page = await adapter.fetch_posts_page(section='owners', keyword='物业', limit=50)
+    assert [p['id'] for p in page['posts']] == [20, 10]
+    assert page['next_cursor'] is None
+
+    with pytest.raises(adapter.InvalidCursorError):
+        await adapter.fetch_posts_page(cursor='not-a-cursor')
+
+
+@pytest.mark.asyncio
+async def test_search_posts_ranks_and_paginates(sqlite_db):
+    result = await adapter.search_posts('物业', limit=2, offset=2)
+    assert result['total'] == 4
+    assert [p['id'] for p in result['posts']] == [10, 5]
+
+    result = await adapter.search_posts('t1', limit=3)
+    assert result['total'] == 11
+    assert [p['id'] for p in result['posts']][0] == 19
+    assert all('t1' in p['title'] for p in result['posts'])
+
+    assert await adapter.search_posts('  ') == {'posts': [], 'total': 0}
+
+
+@pytest.mark.asyncio
+async def test_search_posts_without_pg_trgm(sqlite_db, monkeypatch):
+    # 没有 pg_trgm 时退化为“标题命中优先 + 时间倒序”，不调用 similarity()
+    monkeypatch.setattr(adapter, '_PG_TRGM_AVAILABLE', False)
+    sqlite_db.clear()
+    result = await adapter.search_posts('物业', limit=10)
+    assert result['total'] == 4 and len(result['posts']) == 4
+    assert not any('similarity' in q for q in sqlite_db)
+
+
+@pytest.mark.asyncio
+async def test_add_comment_maintains_counters_for_hot_listing(sqlite_db):
+    for _ in range(3):
+        assert (await adapter.add_comment(4, 'bob', 'hot'))['post_id'] == 4
+    assert (await adapter.add_comment(9, 'alice', 'warm'))['author'] == 'alice'
+    assert await adapter.add_comment(999, 'bob', 'missing') == {}
+
+    sqlite_db.clear()
+    hot = await adapter.fetch_hot_posts(limit=2)
+    assert len(sqlite_db) == 2
+    assert [(p['id'], p['comment_count']) for p in hot] == [(4, 3), (9, 1)]
+
+    active = await adapter.fetch_hot_posts(limit=1, order='active')
+    assert active[0]['id'] == 9
+
+
+@pytest.mark.asyncio
+async def test_schema_upgrade_fills_missing_last_activity(sqlite_sessionmaker, sqlite_db):
+    Session, _ = sqlite_sessionmaker
+    backfill = next(ddl for ddl in adapter._SCHEMA_UPGRADES if ddl.startswith('UPDATE posts SET last_activity_at'))
+    # 模拟升级前的帖子：新加的列全部为 NULL
+    with Session() as s:
+        s.execute(text("UPDATE posts SET last_activity_at = NULL"))
+        s.execute(text("DELETE FROM comments WHERE post_id != 7"))
+        s.execute(text("UPDATE comments SET created_at = '2026-02-01 00:00:00'"))
+        s.execute(text(backfill))
+        s.commit()
+        assert s.execute(text("SELECT count(*) FROM posts WHERE last_activity_at IS NULL")).scalar() == 0
+
+    active = await adapter.fetch_hot_posts(limit=2, order='active')
+    # 有评论的帖子取最后评论时间，其余取发帖时间：旧帖不会因 NULL 排到最前
+    assert [p['id'] for p in active] == [7, 20]
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from postgres_data import adapter
+from postgres_data import models
+from 聊天和用户后端.presence import PresenceRegistry
+
+
+@pytest.fixture
+def users_db(sqlite_sessionmaker):
+    Session, statements = sqlite_sessionmaker
+    with Session() as s:
+        s.add_all([models.User(id=i, username=f'u{i}', password='pw', state='offline') for i in range(1, 5)])
+        s.commit()
+    statements.clear()
+    return statements
+
+
+async def _db_state(uid):
+    return (await adapter.get_user_by_id(uid))['state']
+
+
+@pytest.mark.asyncio
+async def test_reconnect_flap_is_coalesced(users_db):
+    reg = PresenceRegistry(flush_interval=60)
+    reg.connected(1)
+    reg.disconnected(1)
+    reg.connected(1)
+    # 第二个连接不产生状态变化
+    reg.connected(1)
+    assert reg.is_online(1)
+    assert reg.metrics()['pending'] == 1 and reg.stats['coalesced'] == 2
+
+    assert await reg.flush() == 1
+    assert await _db_state(1) == 'online'
+    # 关闭一个连接仍在线，全部关闭才离线
+    reg.disconnected(1)
+    assert reg.is_online(1) and await reg.flush() == 0
+    reg.disconnected(1)
+    assert reg.lookup([1, 2]) == {1: 'offline', 2: 'offline'}
+    await reg.flush()
+    assert await _db_state(1) == 'offline'
+
+
+@pytest.mark.asyncio
+async def test_flush_writes_all_users_in_one_statement(users_db):
+    reg = PresenceRegistry(flush_interval=60)
+    for uid in (1, 2, 3):
+        reg.connected(uid)
+    users_db.clear()
+    assert await reg.flush() == 3
+    assert len([q for q in users_db if q.lstrip().upper().startswith(('WITH', 'UPDATE'))]) == 1
+    assert [await _db_state(i) for i in (1, 2, 3, 4)] == ['online', 'online', 'online', 'offline']
+    # 状态未变的用户不重写
+    reg.disconnected(3)
+    reg.connected(3)
+    assert await reg.flush() == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_pending(users_db, monkeypatch):
+    reg = PresenceRegistry(flush_interval=60)
+    reg.connected(1)
+
+    async def boom(*args, **kwargs):
+        raise RuntimeError('db down')
+
+    monkeypatch.setattr(adapter, 'sync_presence', boom)
+    with pytest.raises(RuntimeError):
+        await reg.flush()
+    assert reg.state_for(1, 'offline') == 'online'
+    assert reg.metrics()['pending'] == 1 and reg.stats['flush_errors'] == 1
+
+
+@pytest.mark.asyncio
+async def test_presence_is_shared_across_workers(users_db):
+    a = PresenceRegistry(flush_interval=60, worker_id='a')
+    b = PresenceRegistry(flush_interval=60, worker_id='b')
+    a.connected(1)
+    b.connected(1)
+    b.connected(2)
+    await a.flush()
+    await b.flush()
+    # 另一个 worker 上的连接：本进程没有条目时以数据库为准
+    assert await a.resolve([1, 2, 3]) == {1: 'online', 2: 'online', 3: 'offline'}
+
+    # 一个 worker 上断开，另一个 worker 仍持有连接：保持 online
+    a.disconnected(1)
+    await a.flush()
+    assert await _db_state(1) == 'online'
+    b.disconnected(1)
+    await b.flush()
+    assert await _db_state(1) == 'offline'
+
+    # 正常退出时回收本 worker 的连接
+    await b.flush(retire=True)
+    assert await _db_state(2) == 'offline'
+
+
+@pytest.mark.asyncio
+async def test_connections_of_dead_worker_are_reaped(users_db):
+    dead = PresenceRegistry(flush_interval=60, worker_id='dead', worker_ttl=0.05)
+    live = PresenceRegistry(flush_interval=60, worker_id='live', worker_ttl=0.05)
+    dead.connected(1)
+    live.connected(2)
+    await dead.flush()
+    await live.flush()
+    assert await _db_state(1) == 'online'
+    await asyncio.sleep(0.1)
+    # dead 不再刷新心跳；live 的下一次同步回收它的连接
+    live.connected(3)
+    await live.flush()
+    assert [await _db_state(i) for i in (1, 2, 3)] == ['offline', 'online', 'online']
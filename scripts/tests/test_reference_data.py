@@ -0,0 +1,190 @@
+import os
+import sys
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from postgres_data import adapter
+from postgres_data import models
+from 聊天和用户后端.reference_cache import VersionedCache, etag_matches
+
+
+@pytest.fixture
+def ref_db(sqlite_sessionmaker, monkeypatch):
+    Session, statements = sqlite_sessionmaker
+    with Session() as s:
+        s.add_all([
+            models.ExampleRelation(case_number='(2024)京01民终1号', summary='物业费纠纷', keyword1='物业费', keyword2=' 违约金 ', keyword3=''),
+            models.ExampleRelation(case_number='(2024)沪02民终2号', summary='租赁押金', keyword1='押金', keyword2='物业费', keyword3=None),
+            models.ExampleRelation(case_number='(2023)粤03民初3号', summary='重复关键词', keyword1='物业费', keyword2='物业费', keyword3='押金'),
+        ])
+        s.commit()
+    statements.clear()
+    return Session, statements
+
+
+@pytest.mark.asyncio
+async def test_keyword_facets_aggregate_in_one_statement(ref_db):
+    _, statements = ref_db
+    facets = await adapter.fetch_keyword_facets()
+    assert len(statements) == 1
+    # 同一案例内重复的关键词只计一次；空串 / NULL 被过滤；两端空白被去除
+    assert facets == [
+        {'keyword': '物业费', 'count': 3},
+        {'keyword': '押金', 'count': 2},
+        {'keyword': '违约金', 'count': 1},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_versioned_cache_rebuilds_only_after_bump(ref_db):
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        return await adapter.fetch_keyword_facets()
+
+    cache = VersionedCache('keywords', loader, version_name='example_relation', check_interval=0)
+    first = await cache.get()
+    assert first.version == 0
+    assert (await cache.get()).etag == first.etag
+    assert len(loads) == 1
+
+    Session, _ = ref_db
+    with Session() as s:
+        s.add(models.ExampleRelation(case_number='(2025)新号', keyword1='违约金', keyword2='违约金'))
+        s.commit()
+    await adapter.bump_data_version('example_relation')
+
+    second = await cache.get()
+    assert second.version == 1 and len(loads) == 2
+    assert second.etag != first.etag
+    assert {'keyword': '违约金', 'count': 2} in second.value
+
+    assert etag_matches(f'"x", {second.etag}', second.etag)
+    assert etag_matches('*', second.etag)
+    assert not etag_matches(first.etag, second.etag)
+
+
+def test_case_index_intersections_and_pagination():
+    from 聊天和用户后端.case_index import CaseIndex
+
+    rows = [{'案号': f'(2024)京01民终{i}号', '摘要': '物业费纠纷' if i % 3 == 0 else '租赁合同', '链接': '',
+             '关键词1': '物业费' if i % 2 == 0 else '押金', '关键词2': ' 违约金 ' if i % 5 == 0 else '', '关键词3': ''}
+            for i in range(1, 31)]
+    rows.append({'案号': '(2023)沪02民初7号', '摘要': 'ABC 公司', '关键词1': '押金'})
+    index = CaseIndex(rows)
+
+    def brute(keyword='', search=''):
+        out = [r for r in rows if not keyword or keyword in [(r.get(k) or '').strip() for k in ('关键词1', '关键词2', '关键词3')]]
+        return [r for r in out if not search or search.lower() in (r['案号'] + '\x01' + r['摘要']).lower()]
+
+    for kw, s in [('', ''), ('物业费', ''), ('', '物业'), ('物业费', '物业'), ('违约金', '京01民终1'), ('押金', 'abc'), ('无', '')]:
+        page, total = index.search(kw, s)
+        assert page == brute(kw, s) and total == len(page)
+
+    page, total = index.search('物业费', offset=5, limit=4)
+    assert total == 15
+    assert page == brute('物业费')[5:9]
+
+    page, total = index.search(case_prefix='(2024)京01民终2')
+    assert total == 11 and all(r['案号'].startswith('(2024)京01民终2') for r in page)
+    assert index.search(keyword='押金', case_prefix='(2023)')[1] == 1
+
+
+@pytest.mark.asyncio
+async def test_versioned_cache_single_flight_and_last_good_fallback():
+    import asyncio
+    from 聊天和用户后端.reference_cache import DerivedCache
+
+    state = {'version': 1, 'down': False, 'loads': 0}
+    gate = asyncio.Event()
+
+    async def loader():
+        state['loads'] += 1
+        await gate.wait()
+        if state['down']:
+            raise ConnectionError('db down')
+        return ('row',) * state['version']
+
+    cache = VersionedCache('legal', loader, check_interval=0, ttl=3600, etag_source=len)
+
+    async def version():
+        if state['down']:
+            raise ConnectionError('db down')
+        return state['version']
+
+    cache._current_version = version
+
+    # 冷启动：并发请求只触发一次加载
+    tasks = [asyncio.create_task(cache.get()) for _ in range(10)]
+    await asyncio.sleep(0)
+    gate.set()
+    snaps = await asyncio.gather(*tasks)
+    assert state['loads'] == 1 and all(s is snaps[0] for s in snaps)
+
+    derived = DerivedCache(cache, len)
+    assert await derived.get() == 1
+
+    state['version'] = 3
+    assert (await cache.get()).value == ('row',) * 3
+    assert await derived.get() == 3
+
+    # 数据库不可用：继续返回上一份快照
+    state['down'] = True
+    cache.invalidate()
+    assert (await cache.get()).version == 3
+    assert cache.stats['stale_served'] == 1
+
+    state['down'] = False
+    cache.invalidate()
+    assert (await cache.get()) is not snaps[0]
+    assert state['loads'] == 3
+
+
+def test_legal_index_matches_linear_scan():
+    import random
+    from 聊天和用户后端.legal_index import LegalIndex
+
+    rng = random.Random(7)
+    regions = ['北京市', '上海市', '广东省深圳市', '浙江省杭州市', '', 'National']
+    words = ['物业', '管理', '条例', '住房', '租赁', '办法', '规定', 'Housing', 'Act']
+    rows = [{'region': rng.choice(regions), 'url': f'u{i}', 'name': ''.join(rng.sample(words, 3))} for i in range(400)]
+    index = LegalIndex(rows)
+
+    def linear(k):
+        k = k.lower()
+        return [i for i, r in enumerate(rows) if k in r['name'].lower() or k in r['region'].lower()]
+
+    for q in ['物', '物业', '物业管理', '管理条例住房', '深圳', '省杭', 'housing', 'ACT', '条例办法规定', '不存在的词', '市物']:
+        expected = linear(q)
+        page, total = index.search(q, offset=3, limit=5)
+        assert total == len(expected)
+        assert [p['url'] for p in page] == [rows[i]['url'] for i in expected[3:8]]
+    assert index.search('物业', 0, 1)[0][0]['desc'].startswith('地区: ')
+
+
+def test_region_recommendations_fall_back_city_province_national():
+    from 聊天和用户后端.legal_index import RegionRecommender, normalize_region, region_keys
+
+    assert normalize_region('广西壮族自治区') == '广西'
+    assert region_keys('广东省深圳市') == ['广东省深圳', '广东', '深圳']
+
+    rows = [{'region': '全国', 'name': '民法典', 'url': 'n1'}, {'region': '', 'name': '物业管理条例', 'url': 'n2'}]
+    rows += [{'region': '广东省', 'name': f'广东规定{i}', 'url': f'g{i}'} for i in range(4)]
+    rows += [{'region': '广东省深圳市', 'name': f'深圳规定{i}', 'url': f's{i}'} for i in range(3)]
+    rows += [{'region': '广东省深圳市', 'name': '深圳规定0', 'url': 's0'}]
+    rec = RegionRecommender(rows)
+
+    titles = [r['title'] for r in rec.recommend({'province': '广东省', 'city': '深圳市'})]
+    assert titles == ['深圳规定0', '深圳规定1', '深圳规定2', '广东规定0', '广东规定1', '广东规定2']
+    # 城市无数据 -> 省份
+    assert [r['title'] for r in rec.recommend({'province': '广东', 'city': '珠海'})][:2] == ['广东规定0', '广东规定1']
+    # 省份也无数据 / 全国 -> 全国列表（全国级法规优先）
+    national = [r['title'] for r in rec.recommend({'province': '西藏', 'city': '拉萨'})]
+    assert national[:2] == ['民法典', '物业管理条例'] and len(national) == 6
+    assert rec.recommend({'province': '全国', 'city': '全国'}) == rec.recommend({'province': '西藏', 'city': '拉萨'})
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from 聊天和用户后端.message_retry import MessageRetryManager  # noqa: E402
+from 聊天和用户后端.retry_log import RetryLog, RetryLogWriter  # noqa: E402
+
+
+def _item(n, retries=0):
+    return {'id': f'm{n}', 'seq': n, 'type': 'personal', 'retries': retries, 'payload': {'sender': 1, 'receiver': 2, 'content': 'x' * 64}}
+
+
+def _segments(path):
+    return sorted(n for n in os.listdir(path) if n.startswith('seg-'))
+
+
+def test_replay_applies_updates_and_tombstones(tmp_path):
+    log = RetryLog(str(tmp_path), segment_bytes=1024)
+    assert log.open() == []
+    log.put([_item(n) for n in range(1, 6)])
+    log.put([_item(2, retries=3)])
+    log.ack(['m1', 'm4', 'unknown'])
+    log.close()
+
+    replayed = RetryLog(str(tmp_path), segment_bytes=1024).open()
+    assert [it['id'] for it in replayed] == ['m2', 'm3', 'm5']
+    assert replayed[0]['retries'] == 3
+
+
+def test_fully_acked_head_segments_are_deleted(tmp_path):
+    log = RetryLog(str(tmp_path), segment_bytes=1024)
+    log.open()
+    for n in range(1, 101):
+        log.put([_item(n)])
+    assert len(_segments(tmp_path)) > 5
+    log.ack([f'm{n}' for n in range(1, 100)])
+    # 只剩 m100 与墓碑所在的段；被删段中的墓碑不会让旧 put 复活
+    assert len(_segments(tmp_path)) <= 3
+    log.close()
+    assert [it['id'] for it in RetryLog(str(tmp_path)).open()] == ['m100']
+
+
+def test_compact_moves_stragglers_out_of_old_segments(tmp_path):
+    log = RetryLog(str(tmp_path), segment_bytes=1024, compact_ratio=0.5)
+    log.open()
+    for n in range(1, 101):
+        log.put([_item(n)])
+    # 每段只留下一条长期重试的消息，拖住全部旧段
+    log.ack([f'm{n}' for n in range(1, 101) if n % 10 != 1])
+    before = len(_segments(tmp_path))
+    assert log.compact() > 0
+    assert len(_segments(tmp_path)) < before
+    log.close()
+    replayed = RetryLog(str(tmp_path)).open()
+    assert [it['id'] for it in replayed] == [f'm{n}' for n in range(1, 101) if n % 10 == 1]
+
+
+def test_torn_tail_record_is_skipped(tmp_path):
+    log = RetryLog(str(tmp_path))
+    log.open()
+    log.put([_item(1), _item(2)])
+    log.close()
+    seg = os.path.join(tmp_path, _segments(tmp_path)[-1])
+    with open(seg, 'a', encoding='utf-8') as f:
+        f.write('{"op": "put", "item": {"id": "m9"')
+    log = RetryLog(str(tmp_path))
+    assert [it['id'] for it in log.open()] == ['m1', 'm2']
+    # 重新打开后追加的记录不能接在半行后面
+    log.put([_item(3)])
+    log.close()
+    assert [it['id'] for it in RetryLog(str(tmp_path)).open()] == ['m1', 'm2', 'm3']
+
+
+@pytest.mark.asyncio
+async def test_writer_groups_concurrent_appends(tmp_path):
+    log = RetryLog(str(tmp_path))
+    log.open()
+    writer = RetryLogWriter(log, fsync='batch')
+    await writer.start()
+    await asyncio.gather(*(writer.put([_item(n)]) for n in range(1, 201)))
+    await asyncio.gather(*(writer.ack([f'm{n}']) for n in range(1, 101)))
+    await writer.stop()
+    # 并发的 300 次调用合并成少数几次 write + fsync
+    assert writer.stats['ops'] == 300
+    assert writer.stats['largest_commit'] > 1
+    assert log.stats['writes'] == writer.stats['commits'] < 300
+    assert log.stats['fsyncs'] >= writer.stats['commits']
+    log.close()
+    assert [it['id'] for it in RetryLog(str(tmp_path)).open()] == [f'm{n}' for n in range(101, 201)]
+
+
+@pytest.mark.asyncio
+async def test_manager_migrates_legacy_file(tmp_path):
+    legacy = tmp_path / 'pending.jsonl'
+    a, b = _item(1), _item(2)
+    with open(legacy, 'w', encoding='utf-8') as f:
+        for obj in (a, b, dict(a, retries=2)):
+            f.write(json.dumps(obj) + '\n')
+
+    mgr = MessageRetryManager(filepath=str(legacy), retry_interval=60)
+    objs = await asyncio.to_thread(mgr._open_log)
+    assert sorted((o['id'], o['retries']) for o in objs) == [('m1', 2), ('m2', 0)]
+    assert not legacy.exists()
+    assert (tmp_path / 'pending.jsonl.migrated').exists()
+    mgr._log.close()
+    assert len(RetryLog(mgr.log_dir).open()) == 2
@@ -0,0 +1,95 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from postgres_data import adapter
+from postgres_data import models
+from 聊天和用户后端.hot_ranking import TrendingRanker, TrendingService
+
+HOUR = 3600.0
+
+
+def test_recent_activity_outranks_older_bursts():
+    now = 1_000_000.0
+    r = TrendingRanker(half_life_hours=1.0, top_k=10)
+    r.refresh(now - 10 * HOUR)
+    r.record_post(1, now - 3 * HOUR)
+    for _ in range(6):
+        r.record_comment(1, now - 3 * HOUR)   # 7 分，衰减 3 个半衰期 -> 0.875
+    r.record_post(2, now - 0.5 * HOUR)
+    r.record_comment(2, now - 0.5 * HOUR)     # 2 分，衰减半个半衰期 -> ~1.414
+
+    top = r.refresh(now)
+    assert [pid for pid, _ in top] == [2, 1]
+    assert top[0][1] == pytest.approx(2 * 2 ** -0.5)
+    assert top[1][1] == pytest.approx(7 / 8)
+
+
+def test_refresh_keeps_scores_stable_across_rebases():
+    now = 5_000_000.0
+    a = TrendingRanker(half_life_hours=2.0)
+    b = TrendingRanker(half_life_hours=2.0)
+    for r in (a, b):
+        r.refresh(now)
+        r.record_post(7, now)
+    # 多次中间刷新（改变参考时间）不应影响最终得分
+    for step in range(1, 5):
+        a.refresh(now + step * HOUR)
+    a.record_comment(7, now + 4 * HOUR)
+    b.record_comment(7, now + 4 * HOUR)
+    assert a.refresh(now + 6 * HOUR)[0][1] == pytest.approx(b.refresh(now + 6 * HOUR)[0][1])
+
+
+def test_top_k_ties_and_pruning():
+    now = 2_000_000.0
+    r = TrendingRanker(half_life_hours=1.0, top_k=3, min_score=0.01, capacity=2)
+    r.refresh(now)
+    for pid in range(1, 6):
+        r.record_post(pid, now + pid)
+    top = r.refresh(now + 10)
+    # 得分近似，按得分再按发帖时间降序
+    assert [pid for pid, _ in top] == [5, 4, 3]
+    assert len(r) == 5
+
+    r.refresh(now + 20 * HOUR)
+    assert len(r) == 0
+    assert r.top(5) == []
+
+
+@pytest.mark.asyncio
+async def test_services_follow_db_activity_and_agree(sqlite_sessionmaker):
+    Session, _ = sqlite_sessionmaker
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=3)
+    with Session() as s:
+        s.add(models.User(id=1, username='alice'))
+        s.add(models.Post(id=1, title='old', content='c', author_id=1, created_at=old, last_activity_at=old))
+        s.commit()
+
+    # 两个 worker 各自一份服务，写入只经过 DB，不经过任一服务
+    workers = [TrendingService(TrendingRanker(half_life_hours=1.0)) for _ in range(2)]
+    for w in workers:
+        await w.refresh()
+        assert w.top_posts(10) == []
+
+    post = await adapter.create_post(1, 'new', 'c', None)
+    await adapter.add_comment(1, 'alice', 'bump')
+    await adapter.add_comment(1, 'alice', 'bump again')
+    for w in workers:
+        await w.refresh()
+        # 重叠窗口内重复读到的行不应重复计分
+        await w.refresh()
+
+    tops = [[(p['id'], p['trending_score']) for p in w.top_posts(10)] for w in workers]
+    assert tops[0] == tops[1]
+    assert [pid for pid, _ in tops[0]] == [1, post['id']]
+    assert tops[0][0][1] == pytest.approx(2.0, abs=0.01)
+    # 旧帖保留真实发帖时间，而不是首条评论的时间
+    r = workers[0].ranker
+    assert r._created[r._index[1]] == pytest.approx(old.replace(tzinfo=datetime.timezone.utc).timestamp(), abs=1)
@@ -0,0 +1,83 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import event
+
+# Ensure project root on sys.path so imports work
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from postgres_data import adapter
+from postgres_data import models
+
+
+@pytest.fixture
+def users_db(sqlite_sessionmaker):
+    Session, statements = sqlite_sessionmaker
+    with Session() as s:
+        s.add_all([
+            models.User(id=1, username='alice', password='pw', identity='owner', location='北京', state='offline', friends=[2]),
+            models.User(id=2, username='bob', password='pw', state='online'),
+            models.User(id=3, username='carol', password_hash='h', state=None),
+        ])
+        s.commit()
+    statements.clear()
+    return statements
+
+
+async def _check_pw(creds):
+    return creds['password'] == 'pw' or creds['password_hash'] == 'h'
+
+
+@pytest.mark.asyncio
+async def test_login_user_two_statements_and_returns_profile(users_db):
+    profile = await adapter.login_user(1, _check_pw)
+    assert profile == {'id': 1, 'username': 'alice', 'identity': 'owner', 'role': 'user', 'location': '北京', 'state': 'online', 'friends': [2]}
+    assert len([q for q in users_db if q.lstrip().upper().startswith(('SELECT', 'UPDATE'))]) == 2
+    assert (await adapter.get_user_by_id(1))['state'] == 'online'
+
+    # state 为 NULL 的用户同样可以登录
+    assert (await adapter.login_user(3, _check_pw))['state'] == 'online'
+
+
+@pytest.mark.asyncio
+async def test_login_user_failures(users_db):
+    with pytest.raises(adapter.UserNotFoundError):
+        await adapter.login_user(99, _check_pw)
+    with pytest.raises(adapter.UserAlreadyOnlineError):
+        await adapter.login_user(2, _check_pw)
+
+    async def reject(creds):
+        return False
+
+    with pytest.raises(adapter.InvalidCredentialsError):
+        await adapter.login_user(1, reject)
+    assert (await adapter.get_user_by_id(1))['state'] == 'offline'
+
+    async def boom(creds):
+        raise TimeoutError('hasher busy')
+
+    # 校验回调的异常原样抛出，不被包装成 DatabaseError
+    with pytest.raises(TimeoutError):
+        await adapter.login_user(1, boom)
+
+
+@pytest.mark.asyncio
+async def test_login_user_holds_no_connection_during_verify(sqlite_sessionmaker, users_db):
+    Session, _ = sqlite_sessionmaker
+    engine = Session.kw['bind']
+    checked_out = []
+    event.listen(engine, 'checkout', lambda *a: checked_out.append(1))
+    event.listen(engine, 'checkin', lambda *a: checked_out.pop())
+    during = []
+
+    async def slow_check(creds):
+        # 模拟在进程池中排队的 argon2 校验：此时不应借用任何连接
+        during.append(len(checked_out))
+        return await _check_pw(creds)
+
+    assert (await adapter.login_user(1, slow_check))['state'] == 'online'
+    assert during == [0]
+    assert checked_out == []
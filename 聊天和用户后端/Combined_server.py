@@ -1,23 +1,24 @@
 from contextlib import asynccontextmanager
 import threading
 import asyncio
+import hashlib
 import json
 import logging
 import os
 import sys
 from logging.handlers import RotatingFileHandler
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 import requests
 import datetime
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 import uuid
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, PlainTextResponse, FileResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from openpyxl import load_workbook
 import pandas as pd
-from typing import List, Dict, Optional, Any, cast, Union
+from typing import List, Dict, Optional, Any, Sequence, Set, cast, Union
 from openai import AsyncOpenAI
 from openai.types.chat import (
     ChatCompletionSystemMessageParam,
@@ -27,11 +28,6 @@ from openai.types.chat import (
 from dotenv import load_dotenv
 load_dotenv()
 
-try:
-    from passlib.hash import argon2
-except Exception:
-    argon2 = None
-
 # On Windows, psycopg async requires a selector-based event loop policy.
 # The actual policy will be set after logger is configured to allow logging.
 
@@ -79,6 +75,17 @@ from post import PostManage  # noqa: E402
 from user import user as UserClass  # noqa: E402
 from user import userManage as UserMgr  # noqa: E402
 from message_retry import MessageRetryManager  # noqa: E402
+from hot_ranking import TrendingService  # noqa: E402
+from password_hashing import PasswordHasher, PasswordHasherBusy, PasswordHasherUnavailable  # noqa: E402
+from presence import PresenceRegistry  # noqa: E402
+from identity_cache import IdentityCache  # noqa: E402
+from message_pipeline import PersonalMessageWriter  # noqa: E402
+from fanout import InProcessPubSub, PubSub, create_pubsub  # noqa: E402
+from outbound import ClientConnection  # noqa: E402
+from heartbeat import HeartbeatReaper  # noqa: E402
+from reference_cache import DerivedCache, VersionedCache, etag_matches  # noqa: E402
+from case_index import CaseIndex  # noqa: E402
+from legal_index import LegalIndex, RegionRecommender  # noqa: E402
 
 # ===================== 日志配置 =====================
 LOG_DIR = os.path.join(BASE_DIR, "logs")
@@ -117,6 +124,12 @@ CASES_FILE = os.path.join(BASE_DIR, "数据", "案号.xlsx")
 DB_ONLY = os.environ.get("DB_ONLY", "1") in ("1", "true", "True")
 # 配置：是否启用内存读取缓存（默认关闭）。若关闭，所有读写操作均直接访问 DB。
 USE_CACHE = os.environ.get("USE_CACHE", "0") in ("1", "true", "True")
+# 配置：帖子列表分页的默认/最大每页条数
+POSTS_PAGE_SIZE = int(os.environ.get("POSTS_PAGE_SIZE", "20"))
+POSTS_PAGE_MAX = int(os.environ.get("POSTS_PAGE_MAX", "100"))
+# 配置：私信/群聊历史每次拉取的默认/最大条数
+MESSAGES_PAGE_SIZE = int(os.environ.get("MESSAGES_PAGE_SIZE", "50"))
+MESSAGES_PAGE_MAX = int(os.environ.get("MESSAGES_PAGE_MAX", "200"))
 
 
 # 日志目录也指向主目录
@@ -153,7 +166,9 @@ async def lifespan(app: FastAPI):
             # 异步创建所有表
             async with engine.begin() as conn:
                 await conn.run_sync(models.Base.metadata.create_all)
-            logger.info("数据库表结构创建/检查完成")
+            # 为已存在的表补齐索引/列（create_all 不会修改已有表）
+            applied = await pg_adapter.ensure_schema_upgrades()
+            logger.info("数据库表结构创建/检查完成（结构升级语句 %s 条）", applied)
         except Exception as e:
             logger.exception("创建数据库表失败: %s", e)
             raise RuntimeError("无法创建数据库表，停止启动")
@@ -189,18 +204,83 @@ async def lifespan(app: FastAPI):
         await message_retry_manager.start()
     except Exception:
         logger.exception("启动 MessageRetryManager 失败")
+    # 启动热度排行引擎：预热近期活动并定时刷新 trending 列表
+    try:
+        global trending_service
+        trending_service = TrendingService()
+        await trending_service.start()
+    except Exception:
+        logger.exception("启动 TrendingService 失败")
+    try:
+        await password_hasher.start()
+    except Exception:
+        logger.exception("启动 PasswordHasher 失败，将在首次使用时重试")
+    try:
+        await presence_registry.start()
+    except Exception:
+        logger.exception("启动 PresenceRegistry 失败")
+    try:
+        await message_writer.start()
+    except Exception:
+        logger.exception("启动 PersonalMessageWriter 失败，私信将逐条写入")
+    try:
+        await heartbeat_reaper.start()
+    except Exception:
+        logger.exception("启动 HeartbeatReaper 失败")
+    # 跨 worker 扇出：默认 Postgres LISTEN/NOTIFY；失败时退回单进程（仅本 worker 内可达）
+    try:
+        await manager.start_fanout(create_pubsub())
+    except Exception:
+        logger.exception("启动跨 worker 扇出失败，退回单进程投递（多 worker 部署时跨进程消息将无法送达）")
+        await manager.start_fanout(InProcessPubSub())
+    # 预建案例 / 法规索引，避免首个请求承担构建开销
+    try:
+        idx = await case_index_cache.get()
+        legal_idx = await legal_index_cache.get()
+        await region_recommender_cache.get()
+        logger.info("Startup: 检索索引构建完成 cases=%s regulations=%s", len(idx), len(legal_idx))
+    except Exception:
+        logger.exception("Startup: 构建检索索引失败，将在首次请求时重试")
     try:
         yield
     finally:
         try:
             pid = os.getpid()
             logger.info("Shutdown: PID=%s 开始保存数据", pid)
+            try:
+                await heartbeat_reaper.stop()
+            except Exception:
+                logger.exception("停止 HeartbeatReaper 失败")
+            try:
+                await manager.stop_fanout()
+            except Exception:
+                logger.exception("停止跨 worker 扇出失败")
+            # 先写完批量写入器中剩余的私信（失败的会转入重试队列），再停止重试管理器
+            try:
+                await message_writer.stop()
+                if _ack_tasks:
+                    await asyncio.gather(*_ack_tasks, return_exceptions=True)
+            except Exception:
+                logger.exception("停止 PersonalMessageWriter 失败")
             # 停止消息重试管理器
             try:
                 if message_retry_manager is not None:
                     await message_retry_manager.stop()
             except Exception:
                 logger.exception("停止 MessageRetryManager 失败")
+            try:
+                if trending_service is not None:
+                    await trending_service.stop()
+            except Exception:
+                logger.exception("停止 TrendingService 失败")
+            try:
+                await password_hasher.stop()
+            except Exception:
+                logger.exception("停止 PasswordHasher 失败")
+            try:
+                await presence_registry.stop()
+            except Exception:
+                logger.exception("停止 PresenceRegistry 失败")
 
             # 不再进行本地 pkl 的保存；所有持久化以 Postgres 为准
             logger.info("Shutdown: 跳过本地 pkl 保存，Postgres 为唯一持久化层")
@@ -229,6 +309,52 @@ post_manager = PostManage()
 cases_df = pd.DataFrame() # 全局存储案例数据
 
 message_retry_manager: Optional[MessageRetryManager] = None
+trending_service: Optional[TrendingService] = None
+# argon2 哈希 / 校验在独立进程池中执行（lifespan 中启动）
+password_hasher = PasswordHasher()
+
+
+def _personal_conversation_held(sender: int, receiver: int) -> bool:
+    return message_retry_manager is not None and message_retry_manager.has_pending_personal(sender, receiver)
+
+
+async def _divert_personal_to_retry(sender: int, receiver: int, content: str, client_msg_id: str, timestamp: Optional[str]) -> None:
+    if message_retry_manager is None:
+        raise RuntimeError("重试队列不可用")
+    await message_retry_manager.enqueue_personal(sender, receiver, content, timestamp, client_msg_id=client_msg_id)
+
+
+# 私信批量写入器：后台按批落库，提交后回执发送方（lifespan 中启动）；
+# 写入失败的批次及同会话的后续消息转入重试队列，保持会话内顺序
+message_writer = PersonalMessageWriter(held=_personal_conversation_held, divert=_divert_personal_to_retry)
+
+
+async def _load_legal_rows():
+    return tuple(await pg_adapter.fetch_example_legal_rows())
+
+
+async def _load_relation_rows():
+    return tuple(await pg_adapter.fetch_relations_rows())
+
+
+async def _load_keyword_facets():
+    return await pg_adapter.fetch_keyword_facets()
+
+
+# 参考数据快照：按 data_versions 中的版本号 + TTL 失效，刷新失败时继续使用上一份快照
+legal_rows_cache = VersionedCache('example_legal', _load_legal_rows, etag_source=len)
+relation_rows_cache = VersionedCache('example_relation', _load_relation_rows, etag_source=len)
+
+# 关键词分面：按 example_relation 的数据版本失效，导入脚本写入后自动重建
+keyword_facets_cache = VersionedCache('keywords', _load_keyword_facets, version_name='example_relation')
+REFERENCE_CACHES = (legal_rows_cache, relation_rows_cache, keyword_facets_cache)
+
+# 案例检索索引：由 example_relation 快照派生，快照更新时整体重建并原子替换
+case_index_cache = DerivedCache(relation_rows_cache, CaseIndex)
+# 法规检索 n-gram 倒排索引：由 example_legal 快照派生
+legal_index_cache = DerivedCache(legal_rows_cache, LegalIndex)
+# 按省 / 市预计算的推荐列表：同样随 example_legal 快照重建
+region_recommender_cache = DerivedCache(legal_rows_cache, RegionRecommender)
 
 # 全局写入锁，防止并发写文件
 write_lock = threading.Lock()
@@ -282,8 +408,6 @@ async def preflight_handler(path: str, request: Request):
 _DATA_CACHE: List[Dict[str, str]] = []
 _DATA_MTIME: float = -1.0
 _save_exit_called = False
-# 用于保护数据缓存的异步锁
-_data_cache_lock = asyncio.Lock()
 def ensure_file_exists(filename: str) -> None:
     """
     确保指定路径的文件存在；如果不存在则创建一个空文件。
@@ -568,28 +692,29 @@ def _load_excel_rows() -> List[Dict[str, str]]:
     return rows
 
 
-async def get_data_rows() -> List[Dict[str, str]]:
-    global _DATA_CACHE, _DATA_MTIME
-    async with _data_cache_lock:
-        # 若 Postgres 适配器可用，则直接从数据库读取并返回（不使用文件缓存）
-        if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
-            try:
-                rows = await pg_adapter.fetch_example_legal_rows()
-                logger.info("从 Postgres 加载法规数据，共 %s 条", len(rows))
-                return rows
-            except Exception:
-                logger.exception("调用 pg_adapter.fetch_example_legal_rows 失败，退回到本地 Excel")
+async def get_data_rows() -> Sequence[Dict[str, str]]:
+    """返回法规参考数据（只读快照，调用方不得修改）。
 
+    Postgres 可用时读取 `legal_rows_cache`：快照新鲜时不访问数据库、也不加锁；
+    仅在从未成功加载过且数据库不可用时退回到本地 Excel。
+    """
+    global _DATA_CACHE, _DATA_MTIME
+    if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
         try:
-            mtime = os.path.getmtime(DATA_PATH)
-        except OSError:
-            mtime = -1.0
+            return (await legal_rows_cache.get()).value
+        except Exception:
+            logger.exception("加载法规参考数据失败且无可用快照，退回到本地 Excel")
+
+    try:
+        mtime = os.path.getmtime(DATA_PATH)
+    except OSError:
+        mtime = -1.0
 
-        if mtime != _DATA_MTIME:
-            _DATA_CACHE = _load_excel_rows()
-            _DATA_MTIME = mtime
-            logger.info("已加载数据: %s 条", len(_DATA_CACHE))
-        return _DATA_CACHE
+    if mtime != _DATA_MTIME:
+        _DATA_CACHE = _load_excel_rows()
+        _DATA_MTIME = mtime
+        logger.info("已加载数据: %s 条", len(_DATA_CACHE))
+    return _DATA_CACHE
 
 
 def resolve_location(payload: Dict) -> Dict[str, str]:
@@ -612,7 +737,7 @@ def resolve_location(payload: Dict) -> Dict[str, str]:
     return {"province": province, "city": city or province}
 
 
-def build_results(rows: List[Dict[str, str]], keyword: str) -> List[Dict[str, str]]:
+def build_results(rows: Sequence[Dict[str, str]], keyword: str) -> List[Dict[str, str]]:
     """
     按关键字过滤 `rows`，关键字可匹配 'name' 或 'region' 字段（不区分大小写），
     返回供 API 使用的标准化结果列表。
@@ -649,7 +774,7 @@ def paginate_results(results: List[Dict[str, str]], page: int, page_size: int) -
     }
 
 
-def build_recommended(rows: List[Dict[str, str]], location: Dict[str, str]) -> List[Dict[str, str]]: 
+def build_recommended(rows: Sequence[Dict[str, str]], location: Dict[str, str]) -> List[Dict[str, str]]: 
     """
     根据 `location` 构建简短的推荐列表。
 
@@ -683,10 +808,23 @@ def build_recommended(rows: List[Dict[str, str]], location: Dict[str, str]) -> L
 
     return recommended
 # 用户标识解析函数：支持 ID 或用户名，优先尝试 ID 查询，失败后回退到用户名查询。    
+async def _load_user_by_id(user_id: int) -> Dict:
+    return await pg_adapter.get_user_by_id(user_id)
+
+
+async def _load_user_by_username(username: str) -> Dict:
+    return await pg_adapter.get_user_by_username(username)
+
+
+# 用户身份缓存（id <-> username <-> 最小资料）：聊天 / 发帖路径上的存在性校验与 id 解析走这里，
+# 活跃用户不再产生身份查询；注册时写入，/load_all_data 时清空（均会通知其它 worker，见 IDENTITY_CONTROL_KEY）
+identity_cache = IdentityCache(_load_user_by_id, _load_user_by_username)
+
+
 async def resolve_user_identifier(identifier: str | int) -> tuple[int | None, dict | None]:
     """
-    根据用户标识（可以是数字ID或用户名字符串）从数据库查询用户。
-    返回 (user_id, user_dict) ，若不存在则返回 (None, None)
+    根据用户标识（可以是数字ID或用户名字符串）解析用户（经 `identity_cache`）。
+    返回 (user_id, user_dict) ，若不存在则返回 (None, None)；user_dict 只含身份字段，不含 state / friends。
     """
     if not identifier:
         return None, None
@@ -696,23 +834,20 @@ async def resolve_user_identifier(identifier: str | int) -> tuple[int | None, di
         logger.error("resolve_user_identifier: 数据库适配器不可用")
         return None, None
 
-    try:
-        # 尝试当作用户名查询
-        user = await pg_adapter.get_user_by_username(str(identifier))
-        if user:
-            uid = user.get('id')
-            if uid is not None:
-                return int(uid), user
-    except (ValueError, TypeError):
-        pass
-
-    # 当作ID
-    uid = int(identifier)  
-    user = await pg_adapter.get_user_by_id(uid)
+    user = await identity_cache.resolve(identifier)
     if user:
-            return int(uid), user
+        return int(user['id']), user
     return None, None
 
+async def _lookup_identity(identifier) -> Optional[Dict]:
+    """数字按 id、其余按用户名查询身份缓存（与各接口原先的 get_user_by_id / get_user_by_username 分支一致）。"""
+    try:
+        uid = int(str(identifier))
+    except Exception:
+        return await identity_cache.get_by_username(str(identifier))
+    return await identity_cache.get_by_id(uid)
+
+
 async def send_personal_message_logic(sender_name: int, receiver_name: int, content: str, timestamp: str) -> Tuple[bool, str]:
     """
     校验发送者和接收者是否存在，创建 `personalChatMessage` 并添加到
@@ -724,27 +859,9 @@ async def send_personal_message_logic(sender_name: int, receiver_name: int, cont
         return False, "数据库不可用"
 
     try:
-        # 支持 id 或 username
-        s_id = None
-        r_id = None
-        try:
-            s_id = int(str(sender_name))
-        except Exception:
-            s_id = None
-        try:
-            r_id = int(str(receiver_name))
-        except Exception:
-            r_id = None
-
-        if s_id is not None:
-            s_info = await pg_adapter.get_user_by_id(s_id)
-        else:
-            s_info = await pg_adapter.get_user_by_username(str(sender_name))
-
-        if r_id is not None:
-            r_info = await pg_adapter.get_user_by_id(r_id)
-        else:
-            r_info = await pg_adapter.get_user_by_username(str(receiver_name))
+        # 支持 id 或 username（经身份缓存）
+        s_info = await _lookup_identity(sender_name)
+        r_info = await _lookup_identity(receiver_name)
 
         if not s_info:
             return False, f"发送方「{sender_name}」不存在"
@@ -761,38 +878,122 @@ async def send_personal_message_logic(sender_name: int, receiver_name: int, cont
 
 
 class ConnectionManager:
-    def __init__(self) -> None:
-        """管理按 `user_id` 索引的活动 WebSocket 连接。
-
-        说明：此管理器为轻量实现，直接保存 `WebSocket` 对象；当应用
-        水平扩展到多进程或多容器时，应替换为共享的 pub/sub 或实时层。
+    def __init__(self, presence: Optional[PresenceRegistry] = None) -> None:
+        """管理按 `user_id` 索引的活动 WebSocket 连接，同一用户可同时持有多条连接（多个标签页 / 设备）。
+
+        每条连接是一个 `ClientConnection`（见 outbound.py），拥有自己的有界出站队列与写任务：
+        `send_to_user` 只序列化一次并放入各连接的队列，不等待网络写入；队列溢出的慢消费者被断开。
+        `active_connections` 只包含本进程持有的连接；多 worker 部署时 `send_to_user` 先投递本地连接，
+        再经 `pubsub`（见 fanout.py，默认 Postgres LISTEN/NOTIFY）发布，由持有接收方连接的 worker 投递。
+        连接 / 断开同时驱动 `presence`（在线状态表），由其批量写入 users.state。
+        `control_handlers` 登记进程间控制消息（如身份缓存失效）：其键含 '/'，不会与 WebSocket
+        路径中的用户键冲突，收到后交给对应的处理函数而不是投递给连接。
         """
-        self.active_connections: Dict[str, WebSocket] = {}
+        self.active_connections: Dict[str, Dict[int, ClientConnection]] = {}
+        self.presence = presence
+        self.pubsub: Optional[PubSub] = None
+        self.control_handlers: Dict[str, Callable[[Dict], Any]] = {}
+        self.stats = {'connected': 0, 'disconnected': 0, 'slow_consumer_disconnects': 0}
+
+    async def start_fanout(self, pubsub: PubSub) -> None:
+        await pubsub.start(self.deliver_local)
+        self.pubsub = pubsub
+
+    async def stop_fanout(self) -> None:
+        pubsub, self.pubsub = self.pubsub, None
+        if pubsub is not None:
+            await pubsub.stop()
 
-    async def connect(self, user_id: str, websocket: WebSocket) -> None:
+    def iter_connections(self):
+        for conns in self.active_connections.values():
+            yield from conns.values()
+
+    def connection_count(self) -> int:
+        return sum(len(conns) for conns in self.active_connections.values())
+
+    async def connect(self, user_id: str, websocket: WebSocket, presence_id: Optional[int] = None) -> ClientConnection:
         # 接受来自客户端的 WebSocket 连接，并注册以便后续发送消息。
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        logger.info("用户 %s 建立WebSocket连接，当前活跃连接数：%s", user_id, len(self.active_connections))
-
-    def disconnect(self, user_id: str) -> None:
-        # 从活动连接表中移除用户的 WebSocket。该方法为同步调用，便于在
-        # 清理路径中直接调用。
-        if user_id in self.active_connections:
-            self.active_connections.pop(user_id, None)
-            logger.info("用户 %s 断开WebSocket连接，当前活跃连接数：%s", user_id, len(self.active_connections))
+        conn = ClientConnection(user_id, websocket, presence_id, on_close=self._remove)
+        conn.start()
+        self.active_connections.setdefault(user_id, {})[conn.id] = conn
+        self.stats['connected'] += 1
+        if self.presence is not None and presence_id is not None:
+            self.presence.connected(presence_id)
+        logger.info("用户 %s 建立WebSocket连接 #%s，当前活跃连接数：%s", user_id, conn.id, self.connection_count())
+        return conn
+
+    def disconnect(self, conn: ClientConnection) -> None:
+        # 关闭连接的写任务并从活动连接表中移除。该方法为同步调用，可重复调用，便于在清理路径中直接调用。
+        conn.close()
+
+    def _remove(self, conn: ClientConnection) -> None:
+        conns = self.active_connections.get(conn.user_id)
+        if conns is None or conns.pop(conn.id, None) is None:
+            return
+        if not conns:
+            del self.active_connections[conn.user_id]
+        self.stats['disconnected'] += 1
+        if conn.slow_consumer:
+            self.stats['slow_consumer_disconnects'] += 1
+        if self.presence is not None and conn.presence_id is not None:
+            self.presence.disconnected(conn.presence_id)
+        logger.info("用户 %s 断开WebSocket连接 #%s，当前活跃连接数：%s", conn.user_id, conn.id, self.connection_count())
+
+    async def deliver_local(self, user_id: str, message: Dict) -> bool:
+        # 仅投递给本进程持有的连接（放入各连接的出站队列）；返回是否有连接接收。
+        handler = self.control_handlers.get(user_id)
+        if handler is not None:
+            handler(message)
+            return True
+        conns = self.active_connections.get(user_id)
+        if not conns:
+            return False
+        text = json.dumps(message, ensure_ascii=False)
+        accepted = False
+        for conn in list(conns.values()):
+            accepted = conn.enqueue(text) or accepted
+        logger.info("向用户 %s 发送消息：%s", user_id, message)
+        return accepted
 
     async def send_to_user(self, user_id: str, message: Dict) -> None:
-        # 向已连接的用户发送可序列化为 JSON 的消息；若连接不存在则记录日志并返回。
-        websocket = self.active_connections.get(user_id)
-        if not websocket:
+        # 向用户发送可序列化为 JSON 的消息：先投递本进程的连接，再发布给其它 worker
+        # （同一用户可能在多个 worker 上各有连接）；未启用扇出且本地无连接时记录日志并返回。
+        delivered = await self.deliver_local(user_id, message)
+        if self.pubsub is not None:
+            await self.pubsub.publish(user_id, message)
+        elif not delivered:
             logger.warning("用户 %s 无活跃WebSocket连接，消息发送失败：%s", user_id, message)
-            return
-        await websocket.send_text(json.dumps(message, ensure_ascii=False))
-        logger.info("向用户 %s 发送消息：%s", user_id, message)
 
+    async def publish_control(self, key: str, message: Dict) -> None:
+        # 把控制消息发给其它 worker（未启用扇出时为空操作）
+        if self.pubsub is not None:
+            await self.pubsub.publish(key, message)
+
+    def metrics(self) -> Dict[str, Any]:
+        depths = [c.depth for conns in self.active_connections.values() for c in conns.values()]
+        per_conn = [c.stats for conns in self.active_connections.values() for c in conns.values()]
+        return {
+            'users': len(self.active_connections),
+            'connections': len(depths),
+            'queue_depth_total': sum(depths),
+            'queue_depth_max': max(depths, default=0),
+            'connections_half_full': sum(1 for c in self.active_connections.values() for x in c.values() if x.depth * 2 >= x.max_queue),
+            'dropped': sum(st['dropped'] for st in per_conn),
+            **self.stats,
+        }
+
+
+# 在线状态：内存中维护，定期批量落库（lifespan 中启动刷新任务）
+presence_registry = PresenceRegistry()
+manager = ConnectionManager(presence=presence_registry)
 
-manager = ConnectionManager()
+# 身份缓存失效经扇出层广播：某个 worker 上的注册 / 清空不会让其它 worker 继续使用过期条目
+IDENTITY_CONTROL_KEY = 'control/identity_cache'
+manager.control_handlers[IDENTITY_CONTROL_KEY] = identity_cache.apply_remote
+identity_cache.publish = lambda message: manager.publish_control(IDENTITY_CONTROL_KEY, message)
+# 心跳与失效连接回收：回收时经 ConnectionManager 触发 offline 转换（lifespan 中启动）
+heartbeat_reaper = HeartbeatReaper(manager.iter_connections)
 
 
 async def _get_payload(request: Request) -> Optional[Dict]:
@@ -813,6 +1014,18 @@ async def _get_payload(request: Request) -> Optional[Dict]:
             return None
     except Exception:
         return None
+
+
+def _client_msg_id(data: Dict) -> str:
+    """消息的去重键：客户端提供的 `client_msg_id`（超过 64 字符时取其 sha1），未提供时由服务端生成。
+
+    同一条消息的重发 / 重试沿用同一个 id，数据库按它去重（ON CONFLICT DO NOTHING）。
+    """
+    raw = data.get("client_msg_id")
+    if raw is None or not str(raw).strip():
+        return uuid.uuid4().hex
+    raw = str(raw).strip()
+    return raw if len(raw) <= 64 else hashlib.sha1(raw.encode("utf-8")).hexdigest()
 #用户名映射函数
 
 
@@ -854,18 +1067,21 @@ async def handle_global_exception(request: Request, exc: Exception):
     )
 # ------------------- API: 获取所有关键词（去重）-------------------
 @app.get('/api/keywords')
-async def get_keywords():
-    # 优先使用 DB 适配器；回退到本地 DataFrame
+async def get_keywords(request: Request, with_counts: int = 0):
+    """返回去重后的关键词列表（按案例数降序）；`with_counts=1` 时返回 [{keyword, count}]。
+
+    结果带强 ETag，客户端携带 If-None-Match 且数据未变化时返回 304。
+    """
     try:
         if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
-            rows = await pg_adapter.fetch_relations_rows()
-            kws = set()
-            for r in rows:
-                for k in ('关键词1', '关键词2', '关键词3'):
-                    v = (r.get(k) or '').strip()
-                    if v:
-                        kws.add(v)
-            return list(kws)
+            snap = await keyword_facets_cache.get()
+            # 两种表示使用不同的 ETag
+            etag = snap.etag[:-1] + ('-c"' if with_counts else '"')
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            if etag_matches(request.headers.get('if-none-match'), etag):
+                return Response(status_code=304, headers=headers)
+            body = snap.value if with_counts else [f['keyword'] for f in snap.value]
+            return JSONResponse(content=body, headers=headers)
 
         if cases_df.empty:
             return []
@@ -878,31 +1094,28 @@ async def get_keywords():
 
 # ------------------- API: 获取案例（支持筛选）-------------------
 @app.get('/api/cases')
-async def get_cases(search: str = "", keyword: str = ""):
-    # 优先使用 DB 适配器，返回与原来 DataFrame.to_dict(orient='records') 相同格式的列表
+async def get_cases(search: str = "", keyword: str = "", case_prefix: str = "", page: Optional[int] = None, page_size: int = 20):
+    """按关键词（精确）、搜索词（案号/摘要子串）与案号前缀筛选案例。
+
+    不传 `page` 时保持旧行为，直接返回全部命中行的列表（总数放在 X-Total-Count 头）；
+    传入 `page` 时返回 {cases, total, page, page_size}。
+    """
     try:
-        rows = []
         if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
-            rows = await pg_adapter.fetch_relations_rows()
+            index: CaseIndex = await case_index_cache.get()
         else:
             if cases_df.empty:
                 return []
-            rows = [r for r in cases_df.to_dict(orient='records')]
-
-        # 1. 按关键词筛选（精确匹配任意一个关键词列）
-        if keyword:
-            rows = [r for r in rows if (r.get('关键词1') == keyword or r.get('关键词2') == keyword or r.get('关键词3') == keyword)]
-
-        # 2. 按搜索词筛选（在案号或摘要中模糊匹配，大小写不敏感）
-        if search:
-            s = search.lower()
-            def matches(r):
-                an = (r.get('案号') or '').lower()
-                summary = (r.get('摘要') or '').lower()
-                return s in an or s in summary
-            rows = [r for r in rows if matches(r)]
-
-        return rows
+            index = CaseIndex(cases_df.to_dict(orient='records'))
+
+        if page is None:
+            rows, total = index.search(keyword, search, case_prefix)
+            return JSONResponse(content=rows, headers={'X-Total-Count': str(total)})
+
+        page = max(1, page)
+        page_size = max(1, min(page_size, POSTS_PAGE_MAX))
+        rows, total = index.search(keyword, search, case_prefix, offset=(page - 1) * page_size, limit=page_size)
+        return {"cases": rows, "total": total, "page": page, "page_size": page_size}
     except Exception as e:
         logger.exception("Error getting cases: %s", e)
         return []
@@ -928,6 +1141,10 @@ async def get_config():
 async def load_all_data():
     try:
         await load_all_data_on_start()
+        # 参考数据缓存：下次访问时重新加载
+        for cache in REFERENCE_CACHES:
+            cache.invalidate()
+        identity_cache.clear()
         return return_success(message="所有数据加载成功")
     except Exception as exc:
         return return_error(f"数据加载失败：{exc}", 500)
@@ -981,15 +1198,22 @@ async def user_register(request: Request):
         userid_int = int(str(userid))
         # 计算 password_hash（若 argon2 可用）以便写入 DB
         password_hash = None
-        if argon2 is not None and password:
+        if password_hasher.available and password:
             try:
-                password_hash = argon2.hash(password)
+                password_hash = await password_hasher.hash(password)
+            except PasswordHasherBusy:
+                return return_error("注册失败：服务繁忙，请稍后重试", 503)
+            except PasswordHasherUnavailable:
+                logger.exception("密码哈希服务不可用")
+                return return_error("注册失败：密码哈希服务暂不可用，请稍后重试", 503)
             except Exception:
                 logger.exception("生成 password_hash 失败，继续使用明文写入")
 
         created = await pg_adapter.create_user(userid_int, username_str, password, identity, location, role, friends=[], password_hash=password_hash)
         if created and created.get('id'):
             logger.info("用户已写入 DB：%s", username_str)
+            # 覆盖此前可能缓存的“查无此人”（并通知其它 worker 丢弃各自的条目）
+            identity_cache.put(created)
             # 异步尝试更新内存缓存（若启用），不依赖其成功
             try:
                 asyncio.create_task(_async_update_user_cache(created))
@@ -1033,67 +1257,48 @@ async def user_login(request: Request):
     except Exception:
         return return_error("登录失败：用户ID无效", 400)
 
-    try:
-        # 先尝试从 DB 获取凭据（password / password_hash）并验证
-        creds = await pg_adapter.get_user_credentials(userid_int)
-        if not creds:
-            return return_error(f"登录失败：用户ID「{userid}」不存在", 401)
-
+    async def _verify(creds: Dict) -> bool:
         db_pass = creds.get('password')
         db_hash = creds.get('password_hash')
-        db_state = creds.get('state')
-        # if db_state == 'online':
-        #     return return_error(f"登录失败：用户ID「{userid}」已在线", 403)
         if db_hash:
-            if argon2 is None or not hasattr(argon2, 'verify'):
-                logger.exception("服务器缺少 argon2，无法验证存储的密码哈希")
-                return return_error("登录失败：服务器配置错误，无法验证密码", 500)
+            if not password_hasher.available:
+                raise PasswordHasherUnavailable("服务器缺少 argon2，无法验证存储的密码哈希")
             try:
-                if not argon2.verify(password, db_hash):
-                    return return_error(f"登录失败：用户ID「{userid}」的密码错误", 401)
+                return await password_hasher.verify(password, db_hash)
+            except PasswordHasherUnavailable:
+                # 进程池故障 / 超时 / 过载不是密码错误：交给下面映射为 503
+                raise
             except Exception:
                 logger.exception("argon2 验证异常")
-                return return_error(f"登录失败：用户ID「{userid}」的密码错误", 401)
-        elif db_pass is not None:
-            if str(db_pass) != str(password):
-                return return_error(f"登录失败：用户ID「{userid}」的密码错误", 401)
-    except Exception:
-        logger.exception("登录验证过程中发生错误")
-        return return_error("登录失败：验证过程中发生错误，请稍后重试", 500)
+                return False
+        if db_pass is not None:
+            return str(db_pass) == str(password)
+        return True
 
-    # 如果到达这里，表示凭据验证通过（未抛出异常），返回用户信息并设置在线状态
+    # 读取凭据、校验、原子置为在线并返回资料：两次短连接借用，校验期间不占用连接；
+    # 校验回调的异常由 adapter 原样抛出，密码哈希服务故障在这里映射为 503
     try:
-        uinfo = await pg_adapter.get_user_by_id(userid_int)
-        if not uinfo:
-            return return_error(f"登录失败：用户ID「{userid}」不存在", 401)
-
-        # 原子化设置在线状态以避免并发竞态：优先调用 adapter 中的 set_user_state_if_offline
-        try:
-            if getattr(pg_adapter, 'set_user_state_if_offline', None):
-                ok = await pg_adapter.set_user_state_if_offline(user_id=userid_int)
-            else:
-                # 退回到非原子写法（兼容旧适配器）
-                await pg_adapter.set_user_state(user_id=userid_int, state='online')
-                ok = True
-            if not ok:
-                return return_error(f"登录失败：用户ID「{userid}」已在线", 403)
-        except Exception:
-            logger.exception('登录后同步 DB 状态失败')
-            return return_error("登录失败：内部错误，请稍后重试", 500)
-
-        profile = uinfo
-        profile.pop('password', None)
+        # 先落库该用户尚未写入的在线状态（例如刚断开的连接），避免误判“已在线”
+        await presence_registry.settle(userid_int)
+        profile = await pg_adapter.login_user(userid_int, _verify)
         return return_success(data={"user": profile}, message="用户登录成功")
-    except Exception as exc:
-        try:
-            from postgres_data.adapter import DatabaseError
-            if isinstance(exc, DatabaseError):
-                logger.exception("数据库错误：%s", exc)
-                return return_error("登录失败：数据库内部错误，请稍后重试", 500)
-        except Exception:
-            pass
-        logger.exception("获取登录用户信息失败")
-        return return_error("登录失败：内部错误，请稍后重试", 500)
+    except pg_adapter.UserNotFoundError:
+        return return_error(f"登录失败：用户ID「{userid}」不存在", 401)
+    except pg_adapter.InvalidCredentialsError:
+        return return_error(f"登录失败：用户ID「{userid}」的密码错误", 401)
+    except pg_adapter.UserAlreadyOnlineError:
+        return return_error(f"登录失败：用户ID「{userid}」已在线", 403)
+    except PasswordHasherBusy:
+        return return_error("登录失败：服务繁忙，请稍后重试", 503)
+    except PasswordHasherUnavailable:
+        logger.exception("密码校验服务不可用")
+        return return_error("登录失败：密码校验服务暂不可用，请稍后重试", 503)
+    except pg_adapter.DatabaseError as exc:
+        logger.exception("数据库错误：%s", exc)
+        return return_error("登录失败：数据库内部错误，请稍后重试", 500)
+    except Exception:
+        logger.exception("登录验证过程中发生错误")
+        return return_error("登录失败：验证过程中发生错误，请稍后重试", 500)
 
 @app.post("/user_logout")
 async def user_logout(request: Request):
@@ -1147,6 +1352,8 @@ async def user_logout(request: Request):
             except Exception:
                 uid = None
             if uid is not None:
+                # 先落库尚未写入的在线状态，保证登出的 offline 最后写入
+                await presence_registry.settle(uid)
                 await pg_adapter.set_user_state(user_id=uid, state='offline')
             else:
                 await pg_adapter.set_user_state(username=str(userid), state='offline')
@@ -1253,6 +1460,7 @@ async def user_state_search(request: Request):
             db_user = await pg_adapter.get_user_by_username(username)
             if not db_user:
                 return return_error(f"查询失败：用户名「{username}」不存在", 404)
+            db_user['state'] = presence_registry.state_for(int(db_user['id']), db_user.get('state'))
             return return_success(data={"users": [db_user]}, message="查询到用户的状态信息")
 
         if userid is not None:
@@ -1265,10 +1473,39 @@ async def user_state_search(request: Request):
             db_user = await pg_adapter.get_user_by_id(uid_int)
             if not db_user:
                 return return_error(f"查询失败：用户ID「{userid}」不存在", 404)
+            db_user['state'] = presence_registry.state_for(uid_int, db_user.get('state'))
             return return_success(data={"users": [db_user]}, message="查询到用户的状态信息")
     except Exception:
         logger.exception("查询用户状态失败")
         return return_error("查询失败：内部错误，请稍后重试", 500)
+
+
+PRESENCE_LOOKUP_MAX = 500
+
+
+@app.post("/user_presence")
+async def user_presence(request: Request):
+    """批量查询在线状态：{"ids": [1, 2, ...]} -> {"presence": {"1": "online", ...}}。
+
+    本 worker 持有连接的用户直接判为 online，其余一条语句读取 users.state（由各 worker 汇总，
+    见 presence.py）；单次最多 PRESENCE_LOOKUP_MAX 个 id。
+    """
+    data = await _get_payload(request)
+    ids = (data or {}).get("ids")
+    if not isinstance(ids, list) or not ids:
+        return return_error("查询失败：ids 必须为非空数组")
+    if len(ids) > PRESENCE_LOOKUP_MAX:
+        return return_error(f"查询失败：单次最多查询 {PRESENCE_LOOKUP_MAX} 个用户", 400)
+    try:
+        uids = [int(i) for i in ids]
+    except Exception:
+        return return_error("查询失败：用户ID格式不正确", 400)
+    try:
+        states = await presence_registry.resolve(uids)
+    except Exception:
+        logger.exception("批量查询在线状态失败")
+        return return_error("查询失败：数据库内部错误，请稍后重试", 500)
+    return return_success(data={"presence": {str(k): v for k, v in states.items()}}, message="查询到用户的在线状态")
 @app.post("/search_users")
 async def search_users(request: Request):
     data = await _get_payload(request)
@@ -1303,6 +1540,7 @@ async def send_personal_message(request: Request):
     receiver = data.get("receiver")
     content = data.get("content")
     timestamp = data.get("timestamp")
+    client_msg_id = _client_msg_id(data)
 
     missing_fields = []
     if sender is None:
@@ -1327,20 +1565,18 @@ async def send_personal_message(request: Request):
     if not ok:
         return return_error(f"发送私信失败：{message}", 404)
 
-    # 若 DB 可用则优先写入 DB；写入失败时尝试入队重试，否则返回 503
+    # 先经批量写入器落库（或转入重试队列），成功后再投递给在线的接收方；
+    # 两者都失败时返回 503，接收方不会看到一条发送方被告知失败的消息
     if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
         try:
-            db_row = await pg_adapter.create_personal_message(sender, receiver, content, timestamp)
-            return return_success(data={"message": db_row}, message=f"私信发送成功（存储于DB）：从「{sender}」到「{receiver}」")
+            db_row = await message_writer.write(sender, receiver, content, client_msg_id, timestamp)
         except Exception:
-            logger.exception("调用 pg_adapter.create_personal_message 失败")
-            # 将消息持久化到重试队列，优先使用 message_retry_manager
-            try:
-                if message_retry_manager is not None:
-                    await message_retry_manager.enqueue_personal(sender, receiver, content, timestamp)
-                    return return_success(message=f"私信已入队，稍后重试写入DB：从「{sender}」到「{receiver}」")
-            except Exception:
-                logger.exception("将私信加入重试队列失败")
+            logger.exception("私信写入 DB 且转入重试队列均失败：%s -> %s", sender, receiver)
+        else:
+            await manager.send_to_user(str(receiver), {"type": "message", "from": sender, "to": receiver, "content": content, "ts": timestamp, "client_msg_id": client_msg_id})
+            if db_row is None:
+                return return_success(data={"client_msg_id": client_msg_id}, message=f"私信已入队，稍后重试写入DB：从「{sender}」到「{receiver}」")
+            return return_success(data={"message": db_row}, message=f"私信发送成功（存储于DB）：从「{sender}」到「{receiver}」")
 
     # 若执行到此处，表示 DB 不可用或入队失败，返回错误（不再做本地 pkl 保存）
     return return_error("发送私信失败：数据库不可用且无法入队重试，请稍后重试", 503)
@@ -1356,6 +1592,7 @@ async def send_group_message(request: Request):
     group_name = data.get("group")
     content = data.get("content")
     timestamp = data.get("timestamp")
+    client_msg_id = _client_msg_id(data)
 
     missing_fields = []
     if not sender_name:
@@ -1388,11 +1625,11 @@ async def send_group_message(request: Request):
     try:
         if str(sender_name).isdigit():
             try:
-                ucheck = await pg_adapter.get_user_by_id(int(sender_name))
+                ucheck = await identity_cache.get_by_id(int(sender_name))
             except Exception:
                 ucheck = None
         else:
-            ucheck = await pg_adapter.get_user_by_username(sender_name)
+            ucheck = await identity_cache.get_by_username(sender_name)
     except Exception:
         logger.exception('发送群消息: 校验发送者时 DB 查询失败')
         return return_error('发送群消息失败：无法校验发送者，请稍后重试', 500)
@@ -1405,7 +1642,7 @@ async def send_group_message(request: Request):
     # 若 DB 可用则写入 DB（优先）；写入失败时尝试入队重试，否则返回 503
     if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
         try:
-            db_row = await pg_adapter.create_group_message(group_name, sender_name, content, timestamp)
+            db_row = await pg_adapter.create_group_message(group_name, sender_name, content, timestamp, client_msg_id=client_msg_id)
             # 将消息加入本地内存缓存以便即时广播（不再写本地 pkl）
             try:
                 msg = groupChatMessage(sender_name, group_name, content, timestamp)
@@ -1417,8 +1654,8 @@ async def send_group_message(request: Request):
             logger.exception("调用 pg_adapter.create_group_message 失败")
             try:
                 if message_retry_manager is not None:
-                    await message_retry_manager.enqueue_group(group_name, sender_name, content, timestamp)
-                    return return_success(message=f"群消息已入队，稍后重试写入DB：由「{sender_name}」发送到群「{group_name}」")
+                    await message_retry_manager.enqueue_group(group_name, sender_name, content, timestamp, client_msg_id=client_msg_id)
+                    return return_success(data={"client_msg_id": client_msg_id}, message=f"群消息已入队，稍后重试写入DB：由「{sender_name}」发送到群「{group_name}」")
             except Exception:
                 logger.exception("将群消息加入重试队列失败")
 
@@ -1426,8 +1663,64 @@ async def send_group_message(request: Request):
     return return_error("发送群消息失败：数据库不可用且无法入队重试，请稍后重试", 503)
 
 
+def _parse_history_window(params) -> Tuple[int, Optional[int], Optional[int]]:
+    """从请求参数解析 (limit, before_id, after_id)；格式错误抛出 ValueError。"""
+    limit = int(params.get("limit") or MESSAGES_PAGE_SIZE)
+    before_id = params.get("before_id")
+    after_id = params.get("after_id")
+    before_id = int(before_id) if before_id not in (None, "") else None
+    after_id = int(after_id) if after_id not in (None, "") else None
+    if before_id is not None and after_id is not None:
+        raise ValueError("before_id 与 after_id 不能同时指定")
+    return max(1, min(limit, MESSAGES_PAGE_MAX)), before_id, after_id
+
+
+def _trim_history(rows: List[Dict], limit: int, after_id: Optional[int]) -> Tuple[List[Dict], bool]:
+    """adapter 按 limit + 1 条查询：多出的一条说明该方向还有更多消息。"""
+    if len(rows) <= limit:
+        return rows, False
+    # 升序结果中，向后同步多出的是最后一条，向前翻页多出的是最早一条
+    return (rows[:limit] if after_id is not None else rows[-limit:]), True
+
+
+async def _personal_history_response(user1, user2, params):
+    # 仅使用 DB 查询私信记录，不再回退到内存历史（内存仅用于实时广播）
+    if not (_PG_ADAPTER_AVAILABLE and pg_adapter is not None):
+        return return_error("查询失败：数据库不可用，请稍后重试", 503)
+
+    # 确保传递给 adapter 的为整数 id
+    try:
+        uid1 = int(user1) if not isinstance(user1, int) else user1
+        uid2 = int(user2) if not isinstance(user2, int) else user2
+    except Exception:
+        return return_error("查询失败：user1 或 user2 格式不正确，应为用户 ID", 400)
+    try:
+        limit, before_id, after_id = _parse_history_window(params)
+    except (TypeError, ValueError) as exc:
+        return return_error(f"查询失败：分页参数不正确（{exc}）", 400)
+
+    try:
+        rows = await pg_adapter.fetch_personal_messages(uid1, uid2, limit=limit + 1, before_id=before_id, after_id=after_id)
+    except Exception:
+        logger.exception("使用 pg_adapter.fetch_personal_messages 查询失败")
+        return return_error("查询失败：数据库内部错误，请稍后重试", 500)
+    rows, has_more = _trim_history(rows, limit, after_id)
+    # user1 为查看方：拉取到最新消息时推进其已读游标（向上翻页不影响）
+    if rows and before_id is None:
+        try:
+            await pg_adapter.mark_conversation_read(uid1, uid2, max(r['id'] for r in rows))
+        except Exception:
+            logger.warning("更新已读游标失败（不影响历史查询）: %s -> %s", uid1, uid2)
+    return return_success(data={"messages": rows, "has_more": has_more}, message=f"查询到{uid1}与{uid2}的历史私聊消息，共{len(rows)}条")
+
+
 @app.post("/get_personal_messages")
 async def get_personal_messages(request: Request):
+    """查询两位用户的私聊历史（升序），默认返回最新 MESSAGES_PAGE_SIZE 条。
+
+    可选参数：`limit`；`before_id` 向上翻页；`after_id` 只拉取该消息之后的新消息。
+    返回 data.has_more 表示该方向是否还有更多消息。
+    """
     data = await _get_payload(request)
     if data is None:
         return return_error("请求参数不能为空，请传入JSON格式数据")
@@ -1435,113 +1728,119 @@ async def get_personal_messages(request: Request):
     user2 = data.get("user2")
     if user1 is None or user2 is None:
         return return_error("查询失败：缺少 user1 或 user2 参数")
+    return await _personal_history_response(user1, user2, data)
 
-    # 仅使用 DB 查询私信记录，不再回退到内存历史（内存仅用于实时广播）
+
+@app.get("/get_personal_messages")
+async def get_personal_messages_get(request: Request, user1: Optional[int] = None, user2: Optional[int] = None):
+    """支持 GET 查询的兼容接口，接受 query 参数 `user1`、`user2` 及分页参数。"""
+    if user1 is None or user2 is None:
+        return return_error("查询失败：缺少 user1 或 user2 参数")
+    return await _personal_history_response(user1, user2, request.query_params)
+
+
+@app.get("/get_group_messages")
+async def get_group_messages(request: Request, group_name: str = ""):
+    """查询群聊历史（升序），分页参数同 /get_personal_messages。"""
+    group_name = group_name.strip()
+    if not group_name:
+        return return_error("查询失败：缺少 group_name 参数")
     if not (_PG_ADAPTER_AVAILABLE and pg_adapter is not None):
         return return_error("查询失败：数据库不可用，请稍后重试", 503)
-
     try:
-        # 确保传递给 adapter 的为整数 id
-        try:
-            uid1 = int(user1) if not isinstance(user1, int) else user1
-            uid2 = int(user2) if not isinstance(user2, int) else user2
-        except Exception:
-            return return_error("查询失败：user1 或 user2 格式不正确，应为用户 ID", 400)
-
-        rows = await pg_adapter.fetch_personal_messages(uid1, uid2)
-        return return_success(data={"messages": rows}, message=f"查询到{uid1}与{uid2}的历史私聊消息，共{len(rows)}条")
+        limit, before_id, after_id = _parse_history_window(request.query_params)
+    except (TypeError, ValueError) as exc:
+        return return_error(f"查询失败：分页参数不正确（{exc}）", 400)
+    try:
+        rows = await pg_adapter.fetch_group_messages(group_name, limit=limit + 1, before_id=before_id, after_id=after_id)
     except Exception:
-        logger.exception("使用 pg_adapter.fetch_personal_messages 查询失败")
+        logger.exception("使用 pg_adapter.fetch_group_messages 查询失败")
         return return_error("查询失败：数据库内部错误，请稍后重试", 500)
+    rows, has_more = _trim_history(rows, limit, after_id)
+    return return_success(data={"messages": rows, "has_more": has_more}, message=f"查询到群 {group_name} 的历史消息，共{len(rows)}条")
 
 
-@app.get("/get_personal_messages")
-async def get_personal_messages_get(user1: Optional[int] = None, user2: Optional[int] = None):
-    """支持 GET 查询的兼容接口，接受 query 参数 `user1` 和 `user2`。"""
-    if user1 is None or user2 is None:
-        return return_error("查询失败：缺少 user1 或 user2 参数")
+@app.get("/conversations")
+async def get_conversations(user_id: Optional[int] = None, limit: int = 50):
+    """会话列表：每个私聊对象的最后一条消息预览、时间与未读数（单条聚合查询）。
 
+    未读数以已读游标为准，游标在 /get_personal_messages 拉取最新消息时推进。
+    """
+    if user_id is None:
+        return return_error("查询失败：缺少 user_id 参数")
     if not (_PG_ADAPTER_AVAILABLE and pg_adapter is not None):
         return return_error("查询失败：数据库不可用，请稍后重试", 503)
-
     try:
-        rows = await pg_adapter.fetch_personal_messages(int(user1), int(user2))
-        return return_success(data={"messages": rows}, message=f"查询到{int(user1)}与{int(user2)}的历史私聊消息，共{len(rows)}条")
+        rows = await pg_adapter.fetch_conversations(int(user_id), limit=max(1, min(limit, MESSAGES_PAGE_MAX)))
     except Exception:
-        logger.exception("使用 pg_adapter.fetch_personal_messages 查询失败（GET）")
+        logger.exception("使用 pg_adapter.fetch_conversations 查询失败")
         return return_error("查询失败：数据库内部错误，请稍后重试", 500)
+    return return_success(data={"conversations": rows}, message=f"查询到{user_id}的会话，共{len(rows)}个")
 
 
 @app.get("/get_posts")
 async def get_posts(request: Request):
     """
-    获取帖子列表，支持按板块(section)筛选和按关键词(keyword)搜索。
+    获取帖子列表（键集分页），支持按板块(section)筛选和按关键词(keyword)搜索。
     :param section: 板块名称（可选，如 'contract', 'owners', 'security', 'public_use'）
     :param keyword: 搜索关键词（可选）
+    :param limit: 每页条数（可选，默认 POSTS_PAGE_SIZE，最大 POSTS_PAGE_MAX）
+    :param cursor: 上一页返回的 next_cursor（可选，不透明字符串）
     """
     section = request.query_params.get("section")
     keyword = request.query_params.get("keyword")
+    cursor = request.query_params.get("cursor") or None
+    try:
+        limit = int(request.query_params.get("limit") or POSTS_PAGE_SIZE)
+    except ValueError:
+        return return_error("查询帖子失败：limit 必须为整数", 400, request_data=dict(request.query_params))
+    limit = max(1, min(limit, POSTS_PAGE_MAX))
 
     # 强制使用 Postgres 查询帖子列表（不再回退到内存缓存）
     if not (_PG_ADAPTER_AVAILABLE and pg_adapter is not None):
         return return_error("查询帖子失败：数据库不可用，请稍后重试", 503)
 
     try:
-        posts_rows = await pg_adapter.fetch_posts_rows(section)
-
-        # 关键词过滤（基于 title/content）
-        if keyword:
-            k = str(keyword).lower().strip()
-            posts_rows = [p for p in posts_rows if k in p.get('title', '').lower() or k in p.get('content', '').lower()]
-
-        # 时间排序（字符串时间解析）
-        def _parse_time_dict(pdict):
-            t = pd.to_datetime(pdict.get('time', ''), errors='coerce')
-            if pd.isna(t):
-                return pd.Timestamp.min
-            return t
-
-        posts_rows.sort(key=_parse_time_dict, reverse=True)
-        posts_dict = posts_rows
-
-        msg = f"查询成功"
-        if section:
-            msg += f"，板块「{section}」"
-        if keyword:
-            msg += f"，关键词「{keyword}」"
-        msg += f"，共{len(posts_dict)}条数据"
-
-        return return_success(data={"posts": posts_dict}, message=msg)
+        page = await pg_adapter.fetch_posts_page(section=section, keyword=keyword, limit=limit, cursor=cursor)
+    except pg_adapter.InvalidCursorError:
+        return return_error("查询帖子失败：分页游标无效", 400, request_data=dict(request.query_params))
     except Exception as exc:
         logger.exception("查询帖子失败：%s", exc)
         return return_error("查询帖子失败：数据库内部错误，请稍后重试", 500)
 
+    posts_dict = page['posts']
+    msg = f"查询成功"
+    if section:
+        msg += f"，板块「{section}」"
+    if keyword:
+        msg += f"，关键词「{keyword}」"
+    msg += f"，本页{len(posts_dict)}条数据"
+
+    return return_success(data={"posts": posts_dict, "next_cursor": page['next_cursor'], "limit": limit}, message=msg)
+
 
 @app.get("/get_hot_posts")
-async def get_hot_posts(limit: int = 8):
+async def get_hot_posts(limit: int = 8, mode: str = "hot"):
     """返回按热度排序的帖子（默认 top N=8）。
-    当前热度计算：以评论数为主，时间为次要排序键（评论数降序，时间降序）。
+    - mode=hot：评论数降序、发帖时间降序（基于 posts.comment_count 索引）。
+    - mode=active：最近活动（发帖或最新评论）时间降序（基于 posts.last_activity_at 索引）。
+    - mode=trending：按时间衰减热度排序，直接读取 TrendingService 定时刷新的缓存（不访问 DB）。
     """
-    # 热帖计算仅基于 DB 数据，不回退到内存缓存
+    if mode not in ("hot", "active", "trending"):
+        return return_error(f"查询热帖失败：不支持的排序模式「{mode}」", 400)
+    limit = max(1, min(int(limit), POSTS_PAGE_MAX))
+    if mode == "trending" and trending_service is not None and trending_service.ready:
+        posts_dict = trending_service.top_posts(limit)
+        return return_success(data={"posts": posts_dict}, message=f"查询到趋势帖 top {len(posts_dict)}")
+
+    # 热帖计算仅基于 DB 数据，不回退到内存缓存；trending 未就绪时退回评论数排序
     if not (_PG_ADAPTER_AVAILABLE and pg_adapter is not None):
         return return_error("查询热帖失败：数据库不可用，请稍后重试", 503)
+    if mode == "trending":
+        mode = "hot"
 
     try:
-        posts_rows = await pg_adapter.fetch_posts_rows(None)
-
-        def _parse_time(p):
-            t = pd.to_datetime(p.get('time', ''), errors='coerce')
-            if pd.isna(t):
-                return pd.Timestamp.min
-            return t
-
-        posts_sorted = sorted(
-            posts_rows,
-            key=lambda p: (len(p.get('comments', [])), _parse_time(p)),
-            reverse=True,
-        )
-        top = posts_sorted[: max(1, int(limit))]
-        posts_dict = top
+        posts_dict = await pg_adapter.fetch_hot_posts(limit, order=mode)
         return return_success(data={"posts": posts_dict}, message=f"查询到热帖 top {len(posts_dict)}")
     except Exception as exc:
         logger.exception("获取热帖失败：%s", exc)
@@ -1582,7 +1881,7 @@ async def create_post(request: Request):
     try:
         if author_name_str:
             try:
-                u = await pg_adapter.get_user_by_username(author_name_str)
+                u = await identity_cache.get_by_username(author_name_str)
             except Exception:
                 u = None
     except Exception:
@@ -1687,7 +1986,7 @@ async def add_comment(request: Request):
         if comment_author_name_str:
             try:
                 cid = comment_author_name_str
-                u = await pg_adapter.get_user_by_username(cid)
+                u = await identity_cache.get_by_username(cid)
             except Exception:
                 u = None
         
@@ -1699,7 +1998,7 @@ async def add_comment(request: Request):
         return return_error(f"添加评论失败：作者「{author}」不存在", 404)
 
     try:
-        db_comment = await pg_adapter.add_comment(post_id, author, content)
+        db_comment = await pg_adapter.add_comment(post_id, author, content, author_name=u.get('username'))
         if db_comment and db_comment.get('id'):
             # 异步更新内存缓存（若启用），不阻塞请求
             try:
@@ -1784,11 +2083,7 @@ async def api_search(request: Request):
     if not keyword:
         return return_error("请提供搜索关键字", 400)
 
-    rows = await get_data_rows()
     location = resolve_location(payload)
-    all_results = build_results(rows, keyword)
-    recommended = build_recommended(rows, location)
-
     try:
         page = int(payload.get("page", 1))
     except (TypeError, ValueError):
@@ -1798,7 +2093,24 @@ async def api_search(request: Request):
     except (TypeError, ValueError):
         page_size = 5
 
-    page_data = paginate_results(all_results, page, page_size)
+    index: Optional[LegalIndex] = None
+    recommender: Optional[RegionRecommender] = None
+    if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
+        try:
+            index = await legal_index_cache.get()
+            recommender = await region_recommender_cache.get()
+        except Exception:
+            logger.exception("法规索引不可用，退回线性扫描")
+    if index is not None and recommender is not None:
+        recommended = recommender.recommend(location)
+        page = max(page, 1)
+        page_size = max(min(page_size, 50), 1)
+        results, total = index.search(keyword, (page - 1) * page_size, page_size)
+        page_data = {"page": page, "page_size": page_size, "total": total, "results": results}
+    else:
+        rows = await get_data_rows()
+        recommended = build_recommended(rows, location)
+        page_data = paginate_results(build_results(rows, keyword), page, page_size)
 
     return JSONResponse(
         content={
@@ -1820,12 +2132,22 @@ async def search_posts(request: Request):
         return return_error("请提供搜索关键字", 400)
 
     try:
-        # 仅使用 Postgres 进行全文（关键词）过滤，不再回退到本地内存列表
+        page = max(int(data.get("page", 1)), 1)
+    except (TypeError, ValueError):
+        page = 1
+    try:
+        page_size = max(min(int(data.get("page_size", POSTS_PAGE_SIZE)), POSTS_PAGE_MAX), 1)
+    except (TypeError, ValueError):
+        page_size = POSTS_PAGE_SIZE
+
+    try:
+        # 仅使用 Postgres 进行关键词检索（pg_trgm 索引），只返回命中且按相关度排序的一页
         if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
-            posts_rows = await pg_adapter.fetch_posts_rows(None)
-            k = str(keyword).lower().strip()
-            filtered = [p for p in posts_rows if k in p.get('title', '').lower() or k in p.get('content', '').lower()]
-            return return_success(data={"posts": filtered}, message=f"找到{len(filtered)}条相关帖子")
+            result = await pg_adapter.search_posts(keyword, limit=page_size, offset=(page - 1) * page_size)
+            return return_success(
+                data={"posts": result['posts'], "total": result['total'], "page": page, "page_size": page_size},
+                message=f"找到{result['total']}条相关帖子",
+            )
         else:
             return return_error("搜索失败：数据库不可用", 503)
     except Exception as exc:
@@ -1979,6 +2301,54 @@ async def legal_chat(request: Request):
         return return_error(f"服务器内部错误：{exc}", 500)
 
 
+@app.get("/health/password_hasher")
+async def health_password_hasher():
+    """密码哈希进程池指标：排队数、执行中任务数、排队 / 执行耗时分位数等。"""
+    return JSONResponse(status_code=200 if password_hasher.available else 503, content={"available": password_hasher.available, **password_hasher.metrics()})
+
+
+@app.get("/health/presence")
+async def health_presence():
+    """在线状态表指标：在线用户数、待落库条数、合并次数、批量写入次数 / 行数等。"""
+    return JSONResponse(status_code=200, content=presence_registry.metrics())
+
+
+@app.get("/health/message_writer")
+async def health_message_writer():
+    """私信批量写入器指标：排队数、已写入条数 / 批次数、平均批大小、提交延迟分位数等。"""
+    return JSONResponse(status_code=200, content={"running": message_writer.running, **message_writer.metrics()})
+
+
+@app.get("/health/message_retry")
+async def health_message_retry():
+    """消息重试队列指标：待重试条数、会话数、退避中的条数、熔断器状态、已写入 / 重试 / 死信条数，
+    每个分区的积压与 lag（最旧消息等待秒数），以及日志段数与磁盘占用。"""
+    if message_retry_manager is None:
+        return JSONResponse(status_code=200, content={"running": False})
+    return JSONResponse(status_code=200, content={"running": True, **message_retry_manager.metrics()})
+
+
+@app.get("/health/connections")
+async def health_connections():
+    """本进程 WebSocket 连接指标：用户数、连接数、出站队列深度（合计 / 最大）、丢弃条数、慢消费者断开次数，
+    以及心跳发送与回收（心跳超时 / 空闲）计数。"""
+    return JSONResponse(status_code=200, content={**manager.metrics(), "heartbeat": heartbeat_reaper.metrics()})
+
+
+@app.get("/health/fanout")
+async def health_fanout():
+    """跨 worker 扇出指标：后端类型、本进程连接数、发布 / 收到 / 投递 / 丢弃条数等。"""
+    pubsub = manager.pubsub
+    content = {"connections": manager.connection_count(), **(pubsub.metrics() if pubsub is not None else {"backend": None})}
+    return JSONResponse(status_code=200, content=content)
+
+
+@app.get("/health/identity_cache")
+async def health_identity_cache():
+    """身份缓存指标：条目数、命中 / 否定命中 / 未命中次数、淘汰与失效次数、命中率。"""
+    return JSONResponse(status_code=200, content=identity_cache.metrics())
+
+
 @app.get("/health/db")
 async def health_db():
     """数据库健康检查：尝试调用 adapter 的 ensure_seed_data（轻量查询）。
@@ -1995,6 +2365,45 @@ async def health_db():
         return JSONResponse(status_code=503, content={"code": 503, "db_ok": False, "error": str(exc)})
 
 
+_ack_tasks: Set[asyncio.Task] = set()
+
+
+async def _persist_via_retry(sender: int, receiver: int, content: str, timestamp: Optional[str], client_msg_id: Optional[str] = None) -> bool:
+    """写入器不可用时把私信交给重试管理器（沿用同一个 client_msg_id，已提交的不会重复写入），并告知发送者结果。"""
+    try:
+        if message_retry_manager is not None:
+            await message_retry_manager.enqueue_personal(sender, receiver, content, timestamp, client_msg_id=client_msg_id)
+            await manager.send_to_user(str(sender), {"type": "info", "client_msg_id": client_msg_id, "message": "消息已入队，稍后重试写入DB"})
+            return True
+        await manager.send_to_user(str(sender), {"type": "error", "client_msg_id": client_msg_id, "message": "消息发送失败：数据库不可用且无重试队列"})
+        logger.warning("WebSocket: 数据库写失败且无重试队列，消息无法持久化")
+    except Exception:
+        logger.exception("WebSocket: 将消息加入重试队列失败，无法持久化")
+        await manager.send_to_user(str(sender), {"type": "error", "client_msg_id": client_msg_id, "message": "消息发送失败：无法将消息入队重试"})
+    return False
+
+
+async def _ack_after_commit(committed: asyncio.Future, sender: int, receiver: int, client_msg_id: str, timestamp: Optional[str]) -> None:
+    """等待批量写入提交：成功后向发送方回执 ack（含数据库 id）；已转入重试队列时告知发送方。
+
+    写入器在批次失败时已把消息转入重试队列；future 仍抛异常说明入队也失败了。
+    消息此时已投递给接收方，因此只告知发送方未能保存，而不是发送失败。
+    """
+    try:
+        row = await committed
+    except Exception:
+        logger.warning("WebSocket: 私信写入 DB 且转入重试队列均失败：%s -> %s", sender, receiver)
+        await manager.send_to_user(str(sender), {"type": "error", "client_msg_id": client_msg_id, "message": "消息已送达，但未能保存到数据库"})
+        return
+    try:
+        if row is None:
+            await manager.send_to_user(str(sender), {"type": "info", "client_msg_id": client_msg_id, "message": "消息已入队，稍后重试写入DB"})
+            return
+        await manager.send_to_user(str(sender), {"type": "ack", "id": row.get('id'), "client_msg_id": client_msg_id, "to": receiver, "ts": timestamp, "time": row.get('time')})
+    except Exception:
+        logger.debug("WebSocket: 向发送方回执 ack 失败（连接可能已关闭）", exc_info=True)
+
+
 @app.websocket("/ws/private")
 async def websocket_private_chat(websocket: WebSocket):
     user_id = websocket.query_params.get("user_id")
@@ -2003,63 +2412,27 @@ async def websocket_private_chat(websocket: WebSocket):
         await websocket.close(code=1008)
         return
 
-    await manager.connect(user_id, websocket)
-    # WebSocket 建立后将用户状态设为 online（内存与 DB）
+    # 解析出数据库 id 后由在线状态表标记 online（批量落库，不在连接路径上写 DB）
+    presence_id: Optional[int] = None
     try:
-        # 优先使用 DB 查询用户并尽量在内存中找到对应对象以设置状态
-        mem_user = None
+        presence_id = int(user_id)
+    except Exception:
         if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
             try:
-                try:
-                    uid = int(user_id)
-                except Exception:
-                    uid = None
-
-                if uid is not None:
-                    db_user = await pg_adapter.get_user_by_id(uid)
-                else:
-                    db_user = await pg_adapter.get_user_by_username(user_id)
-
+                db_user = await identity_cache.get_by_username(user_id)
                 if db_user:
-                    # 尝试在内存中找到对应用户对象以更新其状态（非必需）
-                    try:
-                        mem_user = user_manager.find_user(db_user.get('username'))
-                    except Exception:
-                        mem_user = None
-                # 无论是否找到内存对象，都在 DB 中设置 online
-                try:
-                    if uid is not None:
-                        await pg_adapter.set_user_state(user_id=uid, state='online')
-                    else:
-                        await pg_adapter.set_user_state(username=user_id, state='online')
-                except Exception:
-                    logger.exception('WebSocket connect: 同步 DB 状态失败')
-            except Exception:
-                logger.exception('WebSocket connect: DB 查询失败，跳过内存查找')
-
-        # 仅在 DB 可用时设置 online 状态（不回退到内存用户列表）
-        if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
-            try:
-                try:
-                    uid = int(user_id)
-                except Exception:
-                    uid = None
-
-                if uid is not None:
-                    await pg_adapter.set_user_state(user_id=uid, state='online')
-                else:
-                    await pg_adapter.set_user_state(username=user_id, state='online')
+                    presence_id = int(db_user['id'])
             except Exception:
-                logger.exception('WebSocket connect: 同步 DB 状态失败')
-        else:
-            logger.warning('WebSocket connect: Postgres 不可用，无法设置用户在线状态')
-    except Exception:
-        logger.exception('WebSocket connect: 更新在线状态失败')
+                logger.exception('WebSocket connect: DB 查询失败，无法解析用户 id')
+    conn = await manager.connect(user_id, websocket, presence_id)
+    if presence_id is None:
+        logger.warning('WebSocket connect: 无法解析用户 %s 的 id，不记录在线状态', user_id)
 
     try:
         while True:
             data = await websocket.receive_text()
-            logger.info("收到用户 %s 发送的原始数据：%s", user_id, data)
+            # 收到任意帧即视为连接存活（见 HeartbeatReaper）
+            conn.touch(activity=False)
 
             try:
                 payload = json.loads(data)
@@ -2068,10 +2441,19 @@ async def websocket_private_chat(websocket: WebSocket):
                 await manager.send_to_user(user_id, {"type": "error", "message": "Invalid JSON payload."})
                 continue
 
+            # 心跳帧：只更新存活时间，不计入空闲判定
+            if isinstance(payload, dict) and payload.get("type") in ("pong", "ping"):
+                if payload.get("type") == "ping":
+                    conn.enqueue(json.dumps({"type": "pong", "ts": payload.get("ts")}))
+                continue
+            conn.touch()
+            logger.info("收到用户 %s 发送的原始数据：%s", user_id, data)
+
             sender_raw = payload.get("from")
             receiver_raw = payload.get("to")
             content = payload.get("content")
             timestamp = payload.get("ts")
+            client_msg_id = _client_msg_id(payload)
 
             # 1. 解析发送者和接收者的真实数据库 ID
             sender, sender_info = await resolve_user_identifier(sender_raw)
@@ -2097,142 +2479,40 @@ async def websocket_private_chat(websocket: WebSocket):
                 logger.error("用户 %s %s，payload：%s", user_id, error_msg, payload)
                 await manager.send_to_user(user_id, {"type": "error", "message": "Missing fields: from/to/content."})
                 continue
-            # 当存在 Postgres 适配器时，优先使用 DB 完成存在性校验与持久化写入，避免依赖内存用户对象
-            if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
-                try:
-                    # 校验发送者和接收者在 DB 中是否存在（支持 id 或 username）
-                    s_exists = False
-                    r_exists = False
-                    try:
-                        s_id = sender if isinstance(sender, int) else int(str(sender))
-                    except Exception:
-                        s_id = None
-                    try:
-                        r_id = receiver if isinstance(receiver, int) else int(str(receiver))
-                    except Exception:
-                        r_id = None
-
-                    if s_id is not None:
-                        s_info = await pg_adapter.get_user_by_id(s_id)
-                    else:
-                        s_info = await pg_adapter.get_user_by_username(str(sender))
-                    if s_info:
-                        s_exists = True
-
-                    if r_id is not None:
-                        r_info = await pg_adapter.get_user_by_id(r_id)
-                    else:
-                        r_info = await pg_adapter.get_user_by_username(str(receiver))
-                    if r_info:
-                        r_exists = True
-
-                    if not (s_exists and r_exists):
-                        await manager.send_to_user(str(sender), {"type": "error", "message": "发送失败：发送方或接收方在数据库中不存在"})
-                        logger.warning("WebSocket: 发送失败，DB 中缺少用户：%s -> %s", sender, receiver)
-                        continue
-
-                    # DB 写入私信记录
-                    try:
-                        await pg_adapter.create_personal_message(sender, receiver, content, timestamp)
-                    except Exception:
-                        logger.exception("WebSocket: 调用 pg_adapter.create_personal_message 失败")
-                        try:
-                            # 优先入队重试管理器
-                            if message_retry_manager is not None:
-                                await message_retry_manager.enqueue_personal(sender, receiver, content, timestamp)
-                                await manager.send_to_user(str(sender), {"type": "info", "message": "消息已入队，稍后重试写入DB"})
-                            else:
-                                # 无本地 pkl 回退，告知发送者失败
-                                await manager.send_to_user(str(sender), {"type": "error", "message": "消息发送失败：数据库不可用且无重试队列"})
-                                logger.warning("WebSocket: 数据库写失败且无重试队列，消息丢失")
-                                continue
-                        except Exception:
-                            logger.exception("WebSocket: 将消息加入重试队列失败，无法持久化")
-                            await manager.send_to_user(str(sender), {"type": "error", "message": "消息发送失败：无法将消息入队重试"})
-                            continue
-
-                except Exception:
-                    logger.exception("WebSocket: DB 路径处理消息出错，尝试入队重试")
-                    try:
-                        if message_retry_manager is not None:
-                            await message_retry_manager.enqueue_personal(sender, receiver, content, timestamp)
-                            await manager.send_to_user(str(sender), {"type": "info", "message": "消息已入队，稍后重试写入DB"})
-                        else:
-                            await manager.send_to_user(str(sender), {"type": "error", "message": "消息发送失败：数据库错误且无重试队列"})
-                            logger.warning("WebSocket: DB 写失败且无重试队列，消息无法持久化")
-                        continue
-                    except Exception:
-                        logger.exception("WebSocket: 将消息加入重试队列失败")
-                        await manager.send_to_user(str(sender), {"type": "error", "message": "消息发送失败：无法将消息入队重试"})
-                        continue
-
-            # 若 Postgres 不可用，尝试将消息入队至重试管理器；若也不可用则通知发送者错误
-            if not (_PG_ADAPTER_AVAILABLE and pg_adapter is not None):
-                try:
-                    if message_retry_manager is not None:
-                        await message_retry_manager.enqueue_personal(sender, receiver, content, timestamp)
-                        await manager.send_to_user(str(sender), {"type": "info", "message": "消息已入队，稍后重试写入DB"})
-                    else:
-                        await manager.send_to_user(str(sender), {"type": "error", "message": "消息发送失败：数据库不可用且无重试队列"})
-                        logger.warning("WebSocket: 数据库不可用且无重试队列，消息无法持久化")
-                        continue
-                except Exception:
-                    logger.exception("WebSocket: 将消息加入重试队列失败，无法持久化")
-                    await manager.send_to_user(str(sender), {"type": "error", "message": "消息发送失败：无法将消息入队重试"})
-                    continue
-
+            # sender / receiver 已由 resolve_user_identifier 解析为存在的用户 id：
+            # 交给批量写入器后立即投递给在线的接收方，提交后向发送方回执 ack（不阻塞接收循环）；
+            # 写入器不可用时先入重试队列，入队成功才投递
             send_msg = {
                 "type": "message",
                 "from": sender,
                 "to": receiver,
                 "content": content,
                 "ts": timestamp,
+                "client_msg_id": client_msg_id,
             }
-            await manager.send_to_user(str(receiver), send_msg)
 
-    except WebSocketDisconnect:
-        logger.info("用户 %s 主动断开WebSocket连接", user_id)
-        manager.disconnect(user_id)
-        # 断开时同步状态为 offline
-        try:
-            # 仅在 DB 可用时设置 offline（不回退到内存 user_manager）
+            committed = None
             if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
                 try:
-                    try:
-                        uid = int(user_id)
-                    except Exception:
-                        uid = None
-                    if uid is not None:
-                        await pg_adapter.set_user_state(user_id=uid, state='offline')
-                    else:
-                        await pg_adapter.set_user_state(username=user_id, state='offline')
+                    committed = await message_writer.submit(sender, receiver, content, client_msg_id, timestamp)
                 except Exception:
-                    logger.exception('WebSocketDisconnect: 同步 DB 状态失败')
-            else:
-                logger.warning('WebSocketDisconnect: Postgres 不可用，无法设置用户离线状态')
-        except Exception:
-            logger.exception('WebSocketDisconnect: 更新离线状态失败')
+                    logger.exception("WebSocket: 提交私信到批量写入器失败，尝试入队重试")
+            if committed is None:
+                # Postgres 或写入器不可用：入队至重试管理器；若也不可用则通知发送者错误，不投递
+                if await _persist_via_retry(sender, receiver, content, timestamp, client_msg_id):
+                    await manager.send_to_user(str(receiver), send_msg)
+                continue
+            await manager.send_to_user(str(receiver), send_msg)
+            task = asyncio.create_task(_ack_after_commit(committed, sender, receiver, client_msg_id, timestamp))
+            _ack_tasks.add(task)
+            task.add_done_callback(_ack_tasks.discard)
+
+    except WebSocketDisconnect:
+        logger.info("用户 %s 主动断开WebSocket连接", user_id)
+        manager.disconnect(conn)
     except Exception as exc:
         logger.critical("用户 %s 连接发生未预期异常：%s", user_id, exc, exc_info=True)
-        manager.disconnect(user_id)
-        # 连接异常时同步离线状态
-        try:
-            if _PG_ADAPTER_AVAILABLE and pg_adapter is not None:
-                try:
-                    try:
-                        uid = int(user_id)
-                    except Exception:
-                        uid = None
-                    if uid is not None:
-                        await pg_adapter.set_user_state(user_id=uid, state='offline')
-                    else:
-                        await pg_adapter.set_user_state(username=user_id, state='offline')
-                except Exception:
-                    logger.exception('WebSocket exception: 同步 DB 状态失败')
-            else:
-                logger.warning('WebSocket exception: Postgres 不可用，无法设置用户离线状态')
-        except Exception:
-            logger.exception('WebSocket exception: 更新离线状态失败')
+        manager.disconnect(conn)
         await websocket.close(code=1011)
 # ===================== 静态文件托管与首页重定向 =====================
 import os
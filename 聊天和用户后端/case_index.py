@@ -0,0 +1,102 @@
+import bisect
+from typing import Dict, Iterable, List, Optional, Tuple
+
+KEYWORD_FIELDS = ('关键词1', '关键词2', '关键词3')
+
+# 行之间的分隔符：查询词不会包含它，因此 find 命中不会跨行
+_ROW_SEP = '\x00'
+_FIELD_SEP = '\x01'
+
+
+class CaseIndex:
+    """example_relation 的只读内存索引，供 /api/cases 使用。
+
+    构建时一次性完成：
+    - 关键词 -> 行号的倒排表（行号升序，关键词去除首尾空白）；
+    - 预先小写的「案号 + 摘要」文本，拼接成一个大字符串，子串搜索用 str.find 在 C 层跳跃，
+      命中位置通过行起始偏移二分映射回行号；
+    - 按小写案号排序的数组，支持案号前缀的二分查找。
+
+    实例构建后不再修改；数据变化时整体重建并替换引用（见 `VersionedCache`）。
+    """
+    def __init__(self, rows: Iterable[Dict[str, str]]):
+        self.rows: List[Dict[str, str]] = list(rows)
+        self._texts: List[str] = []
+        self._postings: Dict[str, List[int]] = {}
+        for i, r in enumerate(self.rows):
+            self._texts.append(f"{(r.get('案号') or '').lower()}{_FIELD_SEP}{(r.get('摘要') or '').lower()}")
+            seen = set()
+            for f in KEYWORD_FIELDS:
+                kw = (r.get(f) or '').strip()
+                if kw and kw not in seen:
+                    seen.add(kw)
+                    self._postings.setdefault(kw, []).append(i)
+
+        self._starts: List[int] = []
+        pos = 0
+        for t in self._texts:
+            self._starts.append(pos)
+            pos += len(t) + 1
+        self._haystack = _ROW_SEP.join(self._texts)
+
+        order = sorted(range(len(self.rows)), key=lambda i: (self.rows[i].get('案号') or '').lower())
+        self._case_keys = [(self.rows[i].get('案号') or '').lower() for i in order]
+        self._case_order = order
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def keyword_count(self, keyword: str) -> int:
+        return len(self._postings.get(keyword.strip(), ()))
+
+    def _scan(self, needle: str) -> List[int]:
+        """返回文本中包含 needle 的全部行号（升序）。"""
+        hits: List[int] = []
+        hay, starts = self._haystack, self._starts
+        pos = hay.find(needle)
+        while pos != -1:
+            i = bisect.bisect_right(starts, pos) - 1
+            hits.append(i)
+            if i + 1 >= len(starts):
+                break
+            pos = hay.find(needle, starts[i + 1])
+        return hits
+
+    def _prefix(self, prefix: str) -> List[int]:
+        lo = bisect.bisect_left(self._case_keys, prefix)
+        hi = bisect.bisect_left(self._case_keys, prefix + '\U0010ffff')
+        return sorted(self._case_order[lo:hi])
+
+    def match_ids(self, keyword: str = '', search: str = '', case_prefix: str = '') -> List[int]:
+        """按 keyword（精确）、search（案号/摘要子串，大小写不敏感）、case_prefix（案号前缀）求交集。"""
+        candidates: Optional[List[int]] = None
+        kw = keyword.strip()
+        if kw:
+            candidates = self._postings.get(kw, [])
+        if case_prefix:
+            ids = self._prefix(case_prefix.lower())
+            candidates = ids if candidates is None else _intersect(candidates, ids)
+        s = search.lower()
+        if s:
+            if candidates is None:
+                candidates = self._scan(s)
+            else:
+                texts = self._texts
+                candidates = [i for i in candidates if s in texts[i]]
+        if candidates is None:
+            return list(range(len(self.rows)))
+        return candidates
+
+    def search(self, keyword: str = '', search: str = '', case_prefix: str = '', offset: int = 0, limit: Optional[int] = None) -> Tuple[List[Dict[str, str]], int]:
+        """返回 (当前页行, 命中总数)；`limit=None` 表示不分页。"""
+        ids = self.match_ids(keyword, search, case_prefix)
+        offset = max(0, int(offset))
+        page = ids[offset:] if limit is None else ids[offset:offset + max(0, int(limit))]
+        return [self.rows[i] for i in page], len(ids)
+
+
+def _intersect(a: List[int], b: List[int]) -> List[int]:
+    if len(a) > len(b):
+        a, b = b, a
+    bs = set(b)
+    return [i for i in a if i in bs]
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 本地投递回调：(连接键, 消息) -> 是否投递到了本进程持有的连接
+DeliverFn = Callable[[str, Dict[str, Any]], Awaitable[bool]]
+
+# Postgres NOTIFY 的 payload 上限为 8000 字节，留出信封的余量
+NOTIFY_PAYLOAD_LIMIT = 7800
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+def _new_origin() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class PubSub:
+    """`ConnectionManager.send_to_user` 之下的跨进程扇出层。
+
+    发送方所在进程先投递给本进程的连接，再 `publish()`；其它进程收到后交给 `deliver`
+    投递给它们持有的连接。消息带有发布者的 origin，发布者自己收到的回声会被忽略。
+    子类实现 `_send(envelopes)` 与订阅；收到的信封交给 `_dispatch()`，由单个任务按到达顺序投递。
+    """
+    def __init__(self):
+        self.origin = _new_origin()
+        self._deliver: Optional[DeliverFn] = None
+        self._inbox: Optional[asyncio.Queue] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.stats = {'published': 0, 'received': 0, 'delivered': 0, 'dropped': 0, 'errors': 0}
+
+    async def start(self, deliver: DeliverFn) -> None:
+        self._deliver = deliver
+        self._inbox = asyncio.Queue()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self) -> None:
+        task, self._dispatcher = self._dispatcher, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def publish(self, user_key: str, message: Dict[str, Any]) -> None:
+        self.stats['published'] += 1
+        await self._send([{'o': self.origin, 'u': str(user_key), 'm': message}])
+
+    async def _send(self, envelopes: List[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+    def _dispatch(self, envelope: Dict[str, Any]) -> None:
+        if envelope.get('o') == self.origin or self._inbox is None:
+            return
+        self.stats['received'] += 1
+        self._inbox.put_nowait(envelope)
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            env = await self._inbox.get()
+            try:
+                if await self._deliver(env['u'], env['m']):
+                    self.stats['delivered'] += 1
+                else:
+                    self.stats['dropped'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception("PubSub: 投递来自 %s 的消息失败", env.get('o'))
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'backend': type(self).__name__, 'origin': self.origin, 'inbox': self._inbox.qsize() if self._inbox is not None else 0, **self.stats}
+
+
+class InProcessBroker:
+    """进程内的“频道”：挂在同一个 broker 上的 InProcessPubSub 互相可见（测试中模拟多个 worker）。"""
+    def __init__(self):
+        self.subscribers: List['InProcessPubSub'] = []
+
+
+class InProcessPubSub(PubSub):
+    """单进程实现：不跨进程，默认独占一个 broker（此时发布即空操作）；测试中可共享 broker。"""
+    def __init__(self, broker: Optional[InProcessBroker] = None):
+        super().__init__()
+        self.broker = broker or InProcessBroker()
+
+    async def start(self, deliver: DeliverFn) -> None:
+        await super().start(deliver)
+        self.broker.subscribers.append(self)
+
+    async def stop(self) -> None:
+        if self in self.broker.subscribers:
+            self.broker.subscribers.remove(self)
+        await super().stop()
+
+    async def _send(self, envelopes: List[Dict[str, Any]]) -> None:
+        for sub in list(self.broker.subscribers):
+            for env in envelopes:
+                sub._dispatch(env)
+
+
+class PostgresPubSub(PubSub):
+    """基于 Postgres LISTEN/NOTIFY 的跨 worker 扇出。
+
+    - 一条独立的 asyncpg 连接 LISTEN 频道 `CHAT_PUBSUB_CHANNEL`（默认 chat_fanout），断开后按
+      `CHAT_PUBSUB_RECONNECT`（默认 1 秒）起指数退避重连（断开期间的通知会丢失，消息仍以数据库为准）；
+    - 发布先进入内存队列，另一条连接上的发布任务把积压的信封合并为一条
+      `SELECT pg_notify(channel, x) FROM unnest($2::text[])` 发出，同一进程发布的顺序不变；
+    - 超过 NOTIFY 上限（8000 字节）的信封拆成多段发送，接收端按 (origin, 分段 id) 重组。
+    """
+    def __init__(self, dsn: str, channel: Optional[str] = None, reconnect: Optional[float] = None):
+        super().__init__()
+        self.dsn = dsn
+        self.channel = channel or os.environ.get('CHAT_PUBSUB_CHANNEL', 'chat_fanout')
+        self.reconnect = reconnect if reconnect is not None else _env_float('CHAT_PUBSUB_RECONNECT', 1.0)
+        self._listen_conn = None
+        self._publish_conn = None
+        self._outbox: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._lost: Optional[asyncio.Event] = None
+        self._partial: Dict[Tuple[str, str], Dict[int, str]] = {}
+        self.stats.update({'notifies': 0, 'chunked': 0, 'reconnects': 0})
+
+    async def start(self, deliver: DeliverFn) -> None:
+        await super().start(deliver)
+        self._outbox = asyncio.Queue()
+        self._lost = asyncio.Event()
+        await self._connect()
+        self._tasks = [asyncio.create_task(self._publisher()), asyncio.create_task(self._supervisor())]
+        logger.info("PostgresPubSub: LISTEN %s (origin=%s)", self.channel, self.origin)
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        for t in self._tasks:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        await self._close()
+        await super().stop()
+
+    async def _connect(self) -> None:
+        import asyncpg
+
+        self._listen_conn = await asyncpg.connect(self.dsn)
+        self._listen_conn.add_termination_listener(lambda _conn: self._lost.set())
+        await self._listen_conn.add_listener(self.channel, self._on_notify)
+        self._publish_conn = await asyncpg.connect(self.dsn)
+
+    async def _close(self) -> None:
+        for conn in (self._listen_conn, self._publish_conn):
+            if conn is not None and not conn.is_closed():
+                try:
+                    await conn.close()
+                except Exception:
+                    logger.debug("PostgresPubSub: 关闭连接失败", exc_info=True)
+        self._listen_conn = self._publish_conn = None
+
+    async def _supervisor(self) -> None:
+        delay = self.reconnect
+        while True:
+            await self._lost.wait()
+            logger.warning("PostgresPubSub: LISTEN 连接断开，%ss 后重连", delay)
+            await self._close()
+            await asyncio.sleep(delay)
+            try:
+                self._lost.clear()
+                await self._connect()
+                self.stats['reconnects'] += 1
+                delay = self.reconnect
+            except Exception:
+                logger.exception("PostgresPubSub: 重连失败")
+                self._lost.set()
+                delay = min(delay * 2, 30.0)
+
+    def _encode(self, env: Dict[str, Any]) -> List[str]:
+        payload = json.dumps(env, ensure_ascii=False, separators=(',', ':'))
+        if len(payload.encode('utf-8')) <= NOTIFY_PAYLOAD_LIMIT:
+            return [payload]
+        self.stats['chunked'] += 1
+        # 按字符切分，保证每段 UTF-8 编码后不超过上限（中文最多 3 字节）
+        step = NOTIFY_PAYLOAD_LIMIT // 3 - 64
+        parts = [payload[i:i + step] for i in range(0, len(payload), step)]
+        cid = uuid.uuid4().hex[:12]
+        return [json.dumps({'o': self.origin, 'c': cid, 'i': i, 'n': len(parts), 'd': p}, ensure_ascii=False, separators=(',', ':')) for i, p in enumerate(parts)]
+
+    async def _send(self, envelopes: List[Dict[str, Any]]) -> None:
+        for env in envelopes:
+            for payload in self._encode(env):
+                self._outbox.put_nowait(payload)
+
+    async def _publisher(self) -> None:
+        while True:
+            payloads = [await self._outbox.get()]
+            while not self._outbox.empty():
+                payloads.append(self._outbox.get_nowait())
+            try:
+                await self._publish_conn.execute('SELECT pg_notify($1, x) FROM unnest($2::text[]) AS x', self.channel, payloads)
+                self.stats['notifies'] += len(payloads)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception("PostgresPubSub: 发布 %s 条通知失败（已丢弃）", len(payloads))
+                self._lost.set()
+
+    def _on_notify(self, _conn, _pid, _channel, payload: str) -> None:
+        try:
+            env = json.loads(payload)
+        except Exception:
+            self.stats['errors'] += 1
+            return
+        if env.get('o') == self.origin:
+            return
+        if 'c' in env:
+            key = (env['o'], env['c'])
+            parts = self._partial.setdefault(key, {})
+            parts[int(env['i'])] = env['d']
+            if len(parts) < int(env['n']):
+                if len(self._partial) > 1000:
+                    # 防止丢失分段的消息无限堆积
+                    self._partial.pop(next(iter(self._partial)))
+                return
+            del self._partial[key]
+            try:
+                env = json.loads(''.join(parts[i] for i in range(len(parts))))
+            except Exception:
+                self.stats['errors'] += 1
+                return
+        self._dispatch(env)
+
+
+def create_pubsub(kind: Optional[str] = None) -> PubSub:
+    """按 `CHAT_PUBSUB` 创建扇出实现：postgres（默认，多 worker 部署必需）或 memory（单进程）。"""
+    kind = (kind or os.environ.get('CHAT_PUBSUB', 'postgres')).strip().lower()
+    if kind == 'memory':
+        return InProcessPubSub()
+    if kind != 'postgres':
+        raise ValueError(f"未知的 CHAT_PUBSUB: {kind}")
+    from postgres_data.db_session import asyncpg_dsn
+
+    return PostgresPubSub(asyncpg_dsn())
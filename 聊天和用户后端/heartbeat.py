@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 应用层关闭码：心跳超时（半开连接）与空闲超时
+HEARTBEAT_TIMEOUT_CLOSE_CODE = 4000
+IDLE_TIMEOUT_CLOSE_CODE = 4001
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+class HeartbeatReaper:
+    """WebSocket 心跳与失效连接回收。
+
+    - 每 `WS_PING_INTERVAL` 秒（默认 20）扫描本进程的全部连接，向每条连接的出站队列放入
+      `{"type": "ping", "ts": ...}`，客户端回复 `{"type": "pong"}`；收到任意帧都算存活；
+    - 超过 ping 间隔 + `WS_PONG_TIMEOUT`（默认 20 秒）仍未收到任何帧的连接视为半开连接，
+      以关闭码 4000 关闭；
+    - `WS_IDLE_TIMEOUT` 秒（默认 0，即不启用）内没有业务消息（心跳不算）的连接以关闭码 4001 关闭；
+    - 关闭走 `ClientConnection.close()`，由 ConnectionManager 移除连接并触发在线状态表的 offline 转换。
+
+    `connections` 返回当前连接的可迭代对象（ConnectionManager.iter_connections）。
+    """
+    def __init__(self, connections, ping_interval: Optional[float] = None, pong_timeout: Optional[float] = None, idle_timeout: Optional[float] = None):
+        self._connections = connections
+        self.ping_interval = ping_interval if ping_interval is not None else _env_float('WS_PING_INTERVAL', 20.0)
+        self.pong_timeout = pong_timeout if pong_timeout is not None else _env_float('WS_PONG_TIMEOUT', 20.0)
+        self.idle_timeout = idle_timeout if idle_timeout is not None else _env_float('WS_IDLE_TIMEOUT', 0.0)
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {'sweeps': 0, 'pings_sent': 0, 'reaped_dead': 0, 'reaped_idle': 0}
+
+    def sweep(self, now: Optional[float] = None) -> Dict[str, int]:
+        """检查一遍所有连接：回收失效连接，向其余连接发送 ping。返回本轮计数。"""
+        now = time.monotonic() if now is None else now
+        dead_after = self.ping_interval + self.pong_timeout
+        ping = json.dumps({'type': 'ping', 'ts': int(time.time() * 1000)})
+        counts = {'pings_sent': 0, 'reaped_dead': 0, 'reaped_idle': 0}
+        conns: Iterable[Any] = list(self._connections())
+        for conn in conns:
+            if conn.closed:
+                continue
+            if now - conn.last_seen > dead_after:
+                logger.info("心跳超时，回收连接 %s（用户 %s，%.0fs 未收到任何帧）", conn.id, conn.user_id, now - conn.last_seen)
+                conn.close(HEARTBEAT_TIMEOUT_CLOSE_CODE)
+                counts['reaped_dead'] += 1
+            elif self.idle_timeout > 0 and now - conn.last_activity > self.idle_timeout:
+                logger.info("空闲超时，回收连接 %s（用户 %s）", conn.id, conn.user_id)
+                conn.close(IDLE_TIMEOUT_CLOSE_CODE)
+                counts['reaped_idle'] += 1
+            elif conn.enqueue(ping):
+                counts['pings_sent'] += 1
+        self.stats['sweeps'] += 1
+        for k, v in counts.items():
+            self.stats[k] += v
+        return counts
+
+    async def start(self):
+        if self.ping_interval <= 0:
+            logger.info("HeartbeatReaper: 已禁用（WS_PING_INTERVAL<=0）")
+            return
+        self._task = asyncio.create_task(self._worker())
+        logger.info("HeartbeatReaper: started (ping=%ss pong_timeout=%ss idle_timeout=%ss)", self.ping_interval, self.pong_timeout, self.idle_timeout)
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            logger.info("HeartbeatReaper: stopped")
+
+    async def _worker(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("HeartbeatReaper: 扫描连接失败")
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'ping_interval': self.ping_interval, 'pong_timeout': self.pong_timeout, 'idle_timeout': self.idle_timeout, **self.stats}
@@ -0,0 +1,225 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+def _to_epoch(ts) -> float:
+    if ts is None:
+        return time.time()
+    if isinstance(ts, datetime.datetime):
+        # 不带时区的时间按 UTC 处理（DB 的 now() 均为 UTC）
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=datetime.timezone.utc)
+        return ts.timestamp()
+    return float(ts)
+
+
+class TrendingRanker:
+    """时间衰减热度排行（进程内）。
+
+    每条评论/发帖为帖子贡献一个按半衰期指数衰减的分数。为避免每次更新都重算全部分数，
+    得分以参考时间 `_ref_ts` 为基准存储：时间 t 的事件贡献 `w * 2^((t - ref)/half_life)`，
+    刷新时统一乘以 `2^((ref - now)/half_life)` 并把 ref 移到 now（向量化，一次乘法）。
+
+    post id / 创建时间 / 得分 保存在紧凑的 NumPy 数组中，`record_*` 为 O(1) 摊还，
+    `refresh()` 用 argpartition 求 top-k 并缓存，`top()` 直接返回缓存结果。
+    """
+    def __init__(self, half_life_hours: Optional[float] = None, top_k: Optional[int] = None, post_weight: float = 1.0, comment_weight: float = 1.0, min_score: float = 1e-3, capacity: int = 1024):
+        self.half_life = (half_life_hours if half_life_hours is not None else _env_float('TRENDING_HALF_LIFE_HOURS', 24.0)) * 3600.0
+        self.top_k = top_k if top_k is not None else _env_int('TRENDING_TOP_K', 50)
+        self.post_weight = post_weight
+        self.comment_weight = comment_weight
+        # 衰减到该阈值以下的帖子在刷新时被压缩移除，数组规模只与“近期活跃”帖子数相关
+        self.min_score = min_score
+
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._created = np.zeros(capacity, dtype=np.float64)
+        self._score = np.zeros(capacity, dtype=np.float64)
+        self._size = 0
+        self._index: Dict[int, int] = {}
+        self._ref_ts = time.time()
+        self._top: List[Tuple[int, float]] = []
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _slot(self, post_id: int, created_ts: float) -> int:
+        i = self._index.get(post_id)
+        if i is not None:
+            return i
+        if self._size == len(self._ids):
+            cap = max(len(self._ids) * 2, 16)
+            self._ids = np.resize(self._ids, cap)
+            self._created = np.resize(self._created, cap)
+            self._score = np.resize(self._score, cap)
+        i = self._size
+        self._ids[i] = post_id
+        self._created[i] = created_ts
+        self._score[i] = 0.0
+        self._index[post_id] = i
+        self._size += 1
+        return i
+
+    def _weight(self, ts: float) -> float:
+        return 2.0 ** ((ts - self._ref_ts) / self.half_life)
+
+    def record_post(self, post_id: int, ts=None) -> None:
+        t = _to_epoch(ts)
+        i = self._slot(int(post_id), t)
+        self._created[i] = t
+        self._score[i] += self.post_weight * self._weight(t)
+
+    def record_comment(self, post_id: int, ts=None, post_created=None) -> None:
+        """`post_created` 为帖子真实发帖时间；缺省时才以评论时间代替（仅影响同分排序）。"""
+        t = _to_epoch(ts)
+        created = t if post_created is None else _to_epoch(post_created)
+        i = self._slot(int(post_id), created)
+        self._score[i] += self.comment_weight * self._weight(t)
+
+    def refresh(self, now: Optional[float] = None) -> List[Tuple[int, float]]:
+        """把所有得分衰减到 `now`，移除可忽略的条目，并重新计算缓存的 top-k。"""
+        now = time.time() if now is None else float(now)
+        n = self._size
+        if n:
+            scores = self._score[:n]
+            scores *= 2.0 ** ((self._ref_ts - now) / self.half_life)
+            keep = scores >= self.min_score
+            if not keep.all():
+                m = int(keep.sum())
+                self._ids[:m] = self._ids[:n][keep]
+                self._created[:m] = self._created[:n][keep]
+                self._score[:m] = scores[keep]
+                self._size = n = m
+                self._index = {int(pid): j for j, pid in enumerate(self._ids[:n].tolist())}
+        self._ref_ts = now
+
+        k = min(self.top_k, n)
+        if k == 0:
+            self._top = []
+            return self._top
+        scores = self._score[:n]
+        idx = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+        # 得分降序，得分相同则发帖时间降序
+        idx = idx[np.lexsort((-self._created[idx], -scores[idx]))]
+        self._top = list(zip(self._ids[idx].tolist(), scores[idx].tolist()))
+        return self._top
+
+    def top(self, limit: int) -> List[Tuple[int, float]]:
+        return self._top[:max(0, int(limit))]
+
+
+class TrendingService:
+    """把 `TrendingRanker` 接入应用生命周期：启动时从 DB 预热时间窗口内的活动，
+    之后每 `TRENDING_REFRESH_INTERVAL` 秒从 DB 读取上次水位之后的发帖/评论增量，再刷新排名并缓存 top-k 帖子内容，
+    `/get_hot_posts?mode=trending` 直接读取缓存，不访问数据库。
+
+    排名只由 DB 中的活动驱动（不依赖本进程处理的请求），多 worker 部署下各进程得到相同的列表。
+    """
+    def __init__(self, ranker: Optional[TrendingRanker] = None, refresh_interval: Optional[float] = None, window_half_lives: float = 10.0, overlap: Optional[float] = None):
+        self.ranker = ranker if ranker is not None else TrendingRanker()
+        self.refresh_interval = refresh_interval if refresh_interval is not None else _env_float('TRENDING_REFRESH_INTERVAL', 30.0)
+        # 早于该窗口的活动贡献已不足 2^-10，预热时忽略
+        self.window = self.ranker.half_life * window_half_lives
+        # created_at 取的是写入事务的开始时间，较慢的事务可能在水位推进后才提交；
+        # 增量读取向前重叠该秒数，并按 (类型, id) 去重
+        self.overlap = overlap if overlap is not None else _env_float('TRENDING_DELTA_OVERLAP', 60.0)
+        self._watermark: Optional[datetime.datetime] = None
+        self._seen: Dict[Tuple[str, int], datetime.datetime] = {}
+        self._top_posts: List[Dict] = []
+        self._task: Optional[asyncio.Task] = None
+        self._stop = False
+
+    @property
+    def ready(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception:
+            logger.exception("TrendingService: 预热失败，将在定时刷新中继续累积")
+        self._task = asyncio.create_task(self._worker())
+        logger.info("TrendingService: started (half_life=%.1fh interval=%ss top_k=%s tracked=%s)", self.ranker.half_life / 3600.0, self.refresh_interval, self.ranker.top_k, len(self.ranker))
+
+    async def stop(self):
+        self._stop = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        logger.info("TrendingService: stopped")
+
+    def _first_seen(self, key: Tuple[str, int], ts: datetime.datetime) -> bool:
+        if key in self._seen:
+            return False
+        self._seen[key] = ts
+        if self._watermark is None or ts > self._watermark:
+            self._watermark = ts
+        return True
+
+    async def _pull_activity(self):
+        """读取水位之后的发帖与评论并计入排行；首次调用读取整个时间窗口（预热）。"""
+        from postgres_data import adapter as pg_adapter
+
+        if self._watermark is None:
+            since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.window)
+        else:
+            since = self._watermark - datetime.timedelta(seconds=self.overlap)
+        activity = await pg_adapter.fetch_post_activity_since(since)
+        for pid, ts in activity.get('posts', []):
+            if self._first_seen(('post', pid), ts):
+                self.ranker.record_post(pid, ts)
+        for cid, pid, ts, post_created in activity.get('comments', []):
+            if self._first_seen(('comment', cid), ts):
+                self.ranker.record_comment(pid, ts, post_created)
+        # 去重集合只需覆盖重叠区间
+        if self._watermark is not None:
+            horizon = self._watermark - datetime.timedelta(seconds=self.overlap)
+            self._seen = {k: t for k, t in self._seen.items() if t >= horizon}
+
+    async def refresh(self):
+        from postgres_data import adapter as pg_adapter
+
+        await self._pull_activity()
+        top = self.ranker.refresh()
+        posts = await pg_adapter.fetch_posts_by_ids([pid for pid, _ in top])
+        scores = dict(top)
+        for p in posts:
+            p['trending_score'] = round(scores.get(p['id'], 0.0), 4)
+        self._top_posts = posts
+
+    def top_posts(self, limit: int) -> List[Dict]:
+        return self._top_posts[:max(0, int(limit))]
+
+    async def _worker(self):
+        while not self._stop:
+            try:
+                await asyncio.sleep(self.refresh_interval)
+                await self.refresh()
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                logger.exception("TrendingService: 刷新热度排行失败，继续")
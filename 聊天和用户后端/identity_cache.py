@@ -0,0 +1,214 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# 缓存的最小资料：不含 state / friends 等易变字段（在线状态见 PresenceRegistry）
+IDENTITY_FIELDS = ('id', 'username', 'identity', 'role', 'location')
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+def _minimal(profile: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: profile.get(k) for k in IDENTITY_FIELDS}
+
+
+class IdentityCache:
+    """用户 id <-> username <-> 最小资料 的进程内 LRU + TTL 缓存，位于 adapter 之前。
+
+    - 以 ('id', 1) / ('name', 'alice') 为键，两个键指向同一份资料；容量 `IDENTITY_CACHE_SIZE`
+      （默认 10000 个键），超出时淘汰最久未使用的键；
+    - 正向条目 `IDENTITY_CACHE_TTL` 秒（默认 300）后过期；查无此人也会缓存
+      `IDENTITY_CACHE_NEGATIVE_TTL` 秒（默认 30），避免不存在的 id / 用户名反复打到数据库；
+    - 同一键的并发未命中只触发一次加载；加载异常不缓存，原样抛给调用方；
+    - 注册 / 资料变更时调用 `put()` 或 `invalidate()`，会同时清掉对应的否定条目；
+    - 多 worker 部署时传入 `publish`（例如经 fanout.py 的扇出层）：`put()` / `invalidate()` / `clear()`
+      会把失效通知发给其它 worker，对方收到后调用 `apply_remote()`，不必等到 TTL 过期。
+
+    返回的资料字典是副本，调用方可以修改。
+    """
+    def __init__(
+        self,
+        load_by_id: Callable[[int], Awaitable[Dict[str, Any]]],
+        load_by_username: Callable[[str], Awaitable[Dict[str, Any]]],
+        max_size: Optional[int] = None,
+        ttl: Optional[float] = None,
+        negative_ttl: Optional[float] = None,
+        publish: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None,
+    ):
+        self._load_by_id = load_by_id
+        self._load_by_username = load_by_username
+        self.max_size = max(2, max_size if max_size is not None else _env_int('IDENTITY_CACHE_SIZE', 10000))
+        self.ttl = ttl if ttl is not None else _env_float('IDENTITY_CACHE_TTL', 300.0)
+        self.negative_ttl = negative_ttl if negative_ttl is not None else _env_float('IDENTITY_CACHE_NEGATIVE_TTL', 30.0)
+        # key -> (过期时间, 资料或 None)
+        self._entries: 'collections.OrderedDict[Hashable, Tuple[float, Optional[Dict[str, Any]]]]' = collections.OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.publish = publish
+        self._publishing: Set[asyncio.Task] = set()
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'loads': 0, 'load_errors': 0, 'coalesced': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0, 'remote_invalidations': 0}
+
+    # ---- 条目维护 ----
+
+    def _lookup(self, key: Hashable) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, profile = entry
+        if expires_at <= time.monotonic():
+            self.stats['expirations'] += 1
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        if profile is None:
+            self.stats['negative_hits'] += 1
+        else:
+            self.stats['hits'] += 1
+        return True, profile
+
+    def _store(self, key: Hashable, profile: Optional[Dict[str, Any]], ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, profile)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def _store_profile(self, profile: Dict[str, Any]) -> Dict[str, Any]:
+        minimal = _minimal(profile)
+        self._store(('id', int(minimal['id'])), minimal, self.ttl)
+        if minimal.get('username') is not None:
+            self._store(('name', str(minimal['username'])), minimal, self.ttl)
+        return minimal
+
+    def _drop(self, user_id: Optional[int], username: Optional[str]) -> None:
+        # 两个键可能只剩其一（另一个已被 LRU 淘汰），因此按资料内容扫描；失效是低频操作
+        doomed = [
+            key for key, (_, profile) in self._entries.items()
+            if key in (('id', user_id), ('name', username))
+            or (profile is not None and (profile['id'] == user_id or (username is not None and profile.get('username') == username)))
+        ]
+        for key in doomed:
+            del self._entries[key]
+
+    # ---- 读穿 ----
+
+    async def _get(self, key: Hashable, load: Callable[[], Awaitable[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        found, profile = self._lookup(key)
+        if found:
+            return dict(profile) if profile is not None else None
+        self.stats['misses'] += 1
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.stats['coalesced'] += 1
+            profile = await asyncio.shield(pending)
+            return dict(profile) if profile is not None else None
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            self.stats['loads'] += 1
+            row = await load()
+            profile = self._store_profile(row) if row else None
+            if profile is None:
+                self._store(key, None, self.negative_ttl)
+            fut.set_result(profile)
+        except Exception as exc:
+            self.stats['load_errors'] += 1
+            fut.set_exception(exc)
+            # 无人等待时避免 "Future exception was never retrieved"
+            fut.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+            if not fut.done():
+                fut.cancel()
+        return dict(profile) if profile is not None else None
+
+    async def get_by_id(self, user_id: int) -> Optional[Dict[str, Any]]:
+        uid = int(user_id)
+        return await self._get(('id', uid), lambda: self._load_by_id(uid))
+
+    async def get_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        name = str(username)
+        return await self._get(('name', name), lambda: self._load_by_username(name))
+
+    async def resolve(self, identifier: Union[int, str, None]) -> Optional[Dict[str, Any]]:
+        """按 `resolve_user_identifier` 的语义解析：先当作用户名，不存在且为数字时再当作 id。"""
+        if identifier is None or identifier == '':
+            return None
+        if isinstance(identifier, int):
+            return await self.get_by_id(identifier)
+        profile = await self.get_by_username(str(identifier))
+        if profile is not None:
+            return profile
+        s = str(identifier).strip()
+        if s.isdigit():
+            return await self.get_by_id(int(s))
+        return None
+
+    # ---- 失效 ----
+
+    def put(self, profile: Dict[str, Any]) -> None:
+        """写入（或覆盖）一个用户的资料，例如注册成功后；同时清除该 id / 用户名的否定条目。"""
+        if not profile or profile.get('id') is None:
+            return
+        self.invalidate(user_id=profile['id'], username=profile.get('username'))
+        self._store_profile(profile)
+
+    def invalidate(self, user_id: Optional[int] = None, username: Optional[str] = None) -> None:
+        """资料变更时调用：移除该用户的全部键（含否定条目），并通知其它 worker。"""
+        self.stats['invalidations'] += 1
+        self._drop(int(user_id) if user_id is not None else None, str(username) if username is not None else None)
+        self._broadcast({'user_id': user_id, 'username': username})
+
+    def clear(self) -> None:
+        self.stats['invalidations'] += 1
+        self._entries.clear()
+        self._broadcast({'clear': True})
+
+    def apply_remote(self, message: Dict[str, Any]) -> None:
+        """应用其它 worker 发来的失效通知（不再转发）。"""
+        self.stats['remote_invalidations'] += 1
+        if message.get('clear'):
+            self._entries.clear()
+            return
+        user_id, username = message.get('user_id'), message.get('username')
+        self._drop(int(user_id) if user_id is not None else None, str(username) if username is not None else None)
+
+    def _broadcast(self, message: Dict[str, Any]) -> None:
+        if self.publish is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self._publish_safely(message))
+        self._publishing.add(task)
+        task.add_done_callback(self._publishing.discard)
+
+    async def _publish_safely(self, message: Dict[str, Any]) -> None:
+        try:
+            await self.publish(message)
+        except Exception:
+            logger.exception("IdentityCache: 发布失效通知失败（其它 worker 的条目将按 TTL 过期）")
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.stats['hits'] + self.stats['negative_hits'] + self.stats['misses']
+        hit_rate = (self.stats['hits'] + self.stats['negative_hits']) / lookups if lookups else 0.0
+        return {'size': len(self._entries), 'max_size': self.max_size, **self.stats, 'hit_rate': round(hit_rate, 4)}
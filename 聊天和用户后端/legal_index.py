@@ -0,0 +1,158 @@
+import re
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+_EMPTY = np.zeros(0, dtype=np.int32)
+
+
+def _grams(text: str) -> set:
+    """单字 + 相邻二字组（中文无需分词即可检索）。"""
+    out = set(text)
+    out.update(text[i:i + 2] for i in range(len(text) - 1))
+    return out
+
+
+class LegalIndex:
+    """法规（example_legal）标题 / 地区的字符 n-gram 倒排索引，供 /search 使用。
+
+    每个单字与相邻二字组映射到包含它的行号数组（升序 int32）。标题与地区分别切分，
+    n-gram 不跨字段，因此：
+    - 查询长度 <= 2 时，倒排表本身就是精确结果，总数为数组长度，分页只物化当前页；
+    - 更长的查询先按倒排表长度从小到大求交集（集合迅速收缩，为空即提前结束），
+      再对剩余候选做子串校验，得到精确总数；结果字典只为当前页构建。
+
+    匹配语义与 `build_results` 一致：关键字（不区分大小写）是标题或地区的子串，结果保持行序。
+    """
+    def __init__(self, rows: Iterable[Dict[str, str]]):
+        self.rows: Sequence[Dict[str, str]] = tuple(rows)
+        self._names: List[str] = []
+        self._regions: List[str] = []
+        postings: Dict[str, List[int]] = {}
+        for i, r in enumerate(self.rows):
+            name = (r.get('name') or '').lower()
+            region = (r.get('region') or '').lower()
+            self._names.append(name)
+            self._regions.append(region)
+            for g in _grams(name) | _grams(region):
+                postings.setdefault(g, []).append(i)
+        self._postings: Dict[str, np.ndarray] = {g: np.asarray(ids, dtype=np.int32) for g, ids in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _matches(self, q: str) -> np.ndarray:
+        if not q:
+            return np.arange(len(self.rows), dtype=np.int32)
+        if len(q) <= 2:
+            return self._postings.get(q, _EMPTY)
+        lists = sorted((self._postings.get(q[i:i + 2], _EMPTY) for i in range(len(q) - 1)), key=len)
+        cand = lists[0]
+        for other in lists[1:]:
+            if not len(cand):
+                return _EMPTY
+            cand = np.intersect1d(cand, other, assume_unique=True)
+        names, regions = self._names, self._regions
+        return np.asarray([i for i in cand.tolist() if q in names[i] or q in regions[i]], dtype=np.int32)
+
+    def search(self, keyword: str, offset: int = 0, limit: int = 10) -> Tuple[List[Dict[str, str]], int]:
+        """返回 (当前页结果, 精确命中总数)，结果格式与 `build_results` 相同。"""
+        ids = self._matches(keyword.lower())
+        offset = max(0, int(offset))
+        page = ids[offset:offset + max(0, int(limit))].tolist()
+        results = []
+        for i in page:
+            row = self.rows[i]
+            name = row.get('name', '')
+            region = row.get('region', '')
+            results.append({
+                'name': name or '未命名法律',
+                'desc': f"地区: {region or '未知'}",
+                'url': row.get('url', ''),
+            })
+        return results, int(len(ids))
+
+
+RECOMMEND_LIMIT = 6
+NATIONAL = '全国'
+_NATIONAL_ALIASES = {'', NATIONAL, '中国', '国家', '中央'}
+
+# 较长的后缀在前，保证“广西壮族自治区”先匹配“壮族自治区”
+_REGION_SUFFIXES = ('特别行政区', '维吾尔自治区', '壮族自治区', '回族自治区', '自治区', '自治州', '地区', '省', '市', '盟', '县', '区')
+_REGION_PART = re.compile('.+?(?:' + '|'.join(_REGION_SUFFIXES) + ')')
+
+
+def normalize_region(name: str) -> str:
+    """去掉行政区划后缀：'广东省' -> '广东'，'广西壮族自治区' -> '广西'，'深圳市' -> '深圳'。"""
+    name = (name or '').strip()
+    for suf in _REGION_SUFFIXES:
+        if name.endswith(suf) and len(name) > len(suf):
+            return name[:-len(suf)]
+    return name
+
+
+def region_keys(region: str) -> List[str]:
+    """把地区字段拆成各级地名的规范化键：'广东省深圳市' -> ['广东省深圳', '广东', '深圳']。
+
+    第一个键是整个字段去掉末尾后缀的结果（中间的“省”保留），其后是逐级拆出的地名。
+    """
+    region = (region or '').strip()
+    parts = _REGION_PART.findall(region)
+    rest = region[sum(len(p) for p in parts):]
+    if rest:
+        parts.append(rest)
+    keys = [normalize_region(region)] + [normalize_region(p) for p in parts]
+    return list(dict.fromkeys(k for k in keys if k))
+
+
+class RegionRecommender:
+    """按省 / 市预计算的法规推荐表，替代 `build_recommended` 的逐行过滤。
+
+    构建时遍历一次法规行：每个地区字段拆成规范化的省 / 市键，每个键保留按行序、
+    按 (name, url) 去重的前 RECOMMEND_LIMIT 条；另预计算一份“全国”列表
+    （地区为空或全国级的法规，不足时用其余法规补齐）。
+
+    查询是字典查找：城市列表在前、省份列表补齐；两者都没有时回退到全国列表。
+    """
+    def __init__(self, rows: Iterable[Dict[str, str]], limit: int = RECOMMEND_LIMIT):
+        self.limit = limit
+        self._by_key: Dict[str, List[Dict[str, str]]] = {}
+        seen: Dict[str, set] = {}
+        keys_of: Dict[str, List[str]] = {}
+        national: List[Dict[str, str]] = []
+        filler: List[Dict[str, str]] = []
+        national_seen: set = set()
+        for row in rows:
+            region = row.get('region', '') or ''
+            ident = (row.get('name', ''), row.get('url', ''))
+            item = {'title': row.get('name', '未命名法律'), 'desc': f"来自: {region or '未知'}"}
+            keys = keys_of.get(region)
+            if keys is None:
+                keys = keys_of[region] = region_keys(region)
+            for k in keys:
+                lst = self._by_key.setdefault(k, [])
+                if len(lst) < limit and ident not in seen.setdefault(k, set()):
+                    seen[k].add(ident)
+                    lst.append(item)
+            if ident not in national_seen and (len(national) < limit or len(filler) < limit):
+                national_seen.add(ident)
+                if normalize_region(region) in _NATIONAL_ALIASES:
+                    national.append(item)
+                else:
+                    filler.append(item)
+        self._national = (national + filler)[:limit]
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
+    def recommend(self, location: Dict[str, str]) -> List[Dict[str, str]]:
+        province = normalize_region(location.get('province', ''))
+        city = normalize_region(location.get('city', ''))
+        if not province or province in _NATIONAL_ALIASES:
+            return list(self._national)
+        out: List[Dict[str, str]] = []
+        for key in (city, province):
+            for item in self._by_key.get(key, ()):
+                if item not in out:
+                    out.append(item)
+        return out[:self.limit] if out else list(self._national)
@@ -0,0 +1,222 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+def _percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _Pending(NamedTuple):
+    sender: int
+    receiver: int
+    content: str
+    client_msg_id: str
+    ts: Optional[str]
+    future: asyncio.Future
+    enqueued: float
+
+
+# 会话是否被挂起：(sender, receiver) -> 是否仍有待重试的消息
+HeldFn = Callable[[int, int], bool]
+# 转入重试队列：(sender, receiver, content, client_msg_id, ts)
+DivertFn = Callable[[int, int, str, str, Optional[str]], Awaitable[Any]]
+
+
+async def _default_write(rows: List[Tuple[int, int, str, str]]) -> List[Dict]:
+    from postgres_data import adapter as pg_adapter
+
+    return await pg_adapter.create_personal_messages_bulk(rows)
+
+
+class PersonalMessageWriter:
+    """私信的批量写入器（write-behind）：消息先投递给在线接收方，持久化在后台按批完成。
+
+    - `submit()` 把消息放入有界队列（`MSG_WRITE_QUEUE_MAXSIZE`，默认 10000，满时等待，形成背压），
+      返回一个 future，提交成功后得到与 `create_personal_message` 相同的行字典；
+    - 后台任务取到第一条消息后最多再等 `MSG_BATCH_MAX_WAIT_MS` 毫秒（默认 5）凑批，
+      攒满 `MSG_BATCH_MAX_SIZE` 条（默认 256）立即写入；写入期间到达的消息自然进入下一批；
+    - 每批一条多行 INSERT、一个事务（`adapter.create_personal_messages_bulk`）；
+      整批失败时由 `divert` 把每条消息（带着同一个 `client_msg_id`）转入重试队列，future 的结果为 None
+      （若该批其实已提交，重试时按 client_msg_id 去重，不会写出重复消息）；未配置 `divert` 时
+      每条消息的 future 都抛出该异常，由调用方处理；
+    - 只有一个写入任务、队列先进先出、批内按提交顺序分配 id，因此同一会话内的消息顺序不变；
+      会话在重试队列中还有消息时（`held`），后续消息也转入重试队列排在其后，不会越过重试中的批次。
+    """
+    def __init__(
+        self,
+        write: Optional[Callable[[List[Tuple[int, int, str, str]]], Awaitable[List[Dict]]]] = None,
+        max_batch: Optional[int] = None,
+        max_wait_ms: Optional[float] = None,
+        max_queue: Optional[int] = None,
+        sample_size: int = 2048,
+        held: Optional[HeldFn] = None,
+        divert: Optional[DivertFn] = None,
+    ):
+        self._write = write or _default_write
+        self._held = held
+        self._divert = divert
+        self.max_batch = max(1, max_batch if max_batch is not None else _env_int('MSG_BATCH_MAX_SIZE', 256))
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else _env_float('MSG_BATCH_MAX_WAIT_MS', 5.0)) / 1000.0
+        self.max_queue = max_queue if max_queue is not None else _env_int('MSG_WRITE_QUEUE_MAXSIZE', 10000)
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._counters: Dict[str, int] = {'messages': 0, 'batches': 0, 'failed_batches': 0, 'failed_messages': 0, 'diverted': 0, 'largest_batch': 0}
+        self._commit_latency: Deque[float] = collections.deque(maxlen=sample_size)
+        self._batch_sizes: Deque[int] = collections.deque(maxlen=sample_size)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._batch_full = asyncio.Event()
+        self._task = asyncio.create_task(self._worker())
+        logger.info("PersonalMessageWriter: started (max_batch=%s max_wait=%sms queue_max=%s)", self.max_batch, self.max_wait * 1000, self.max_queue)
+
+    async def stop(self):
+        """停止接收新消息，写完队列中剩余的消息后退出。"""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        await self._queue.put(None)
+        self._batch_full.set()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        logger.info("PersonalMessageWriter: stopped (%s)", self.metrics())
+
+    async def submit(self, sender: int, receiver: int, content: str, client_msg_id: Optional[str] = None, ts: Optional[str] = None) -> asyncio.Future:
+        """放入写入队列，返回提交后完成的 future（值为行字典；转入重试队列时为 None）。未启动时直接单条写入。
+
+        `client_msg_id` 缺省时由服务端生成；调用方在失败后转入重试队列时应沿用同一个 id。
+        """
+        fut = asyncio.get_running_loop().create_future()
+        item = _Pending(int(sender), int(receiver), content, client_msg_id or uuid.uuid4().hex, ts, fut, time.perf_counter())
+        if not self.running:
+            await self._flush([item])
+            return fut
+        await self._queue.put(item)
+        if self._queue.qsize() >= self.max_batch:
+            self._batch_full.set()
+        return fut
+
+    async def write(self, sender: int, receiver: int, content: str, client_msg_id: Optional[str] = None, ts: Optional[str] = None) -> Optional[Dict]:
+        """提交并等待落库，返回行字典；转入重试队列时返回 None（HTTP 接口使用）。"""
+        return await (await self.submit(sender, receiver, content, client_msg_id, ts))
+
+    async def _worker(self):
+        queue = self._queue
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is None:
+                break
+            if queue.qsize() + 1 < self.max_batch and self.max_wait > 0:
+                self._batch_full.clear()
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+            batch = [item]
+            while len(batch) < self.max_batch:
+                try:
+                    nxt = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if nxt is None:
+                    stopping = True
+                    break
+                batch.append(nxt)
+            await self._flush(batch)
+
+    async def _divert_all(self, items: List[_Pending]) -> None:
+        """逐条转入重试队列（保持顺序）；成功的 future 结果为 None，入队失败的抛出该异常。"""
+        for m in items:
+            try:
+                await self._divert(m.sender, m.receiver, m.content, m.client_msg_id, m.ts)
+            except Exception as exc:
+                logger.exception("PersonalMessageWriter: 私信转入重试队列失败：%s -> %s", m.sender, m.receiver)
+                if not m.future.done():
+                    m.future.set_exception(exc)
+                continue
+            self._counters['diverted'] += 1
+            if not m.future.done():
+                m.future.set_result(None)
+
+    async def _flush(self, batch: List[_Pending]) -> None:
+        if self._held is not None and self._divert is not None:
+            # 会话仍有消息在重试队列中：排到它们后面，不直接写入
+            held = {pair for pair in {(m.sender, m.receiver) for m in batch} if self._held(*pair)}
+            if held:
+                await self._divert_all([m for m in batch if (m.sender, m.receiver) in held])
+                batch = [m for m in batch if (m.sender, m.receiver) not in held]
+                if not batch:
+                    return
+        started = time.perf_counter()
+        try:
+            rows = await self._write([(m.sender, m.receiver, m.content, m.client_msg_id) for m in batch])
+            if len(rows) != len(batch):
+                raise RuntimeError(f"批量写入返回 {len(rows)} 行，期望 {len(batch)} 行")
+        except Exception as exc:
+            self._counters['failed_batches'] += 1
+            self._counters['failed_messages'] += len(batch)
+            logger.exception("PersonalMessageWriter: 批量写入 %s 条私信失败", len(batch))
+            if self._divert is not None:
+                # 在写入任务内同步转入，下一批开始前这些会话已在重试队列中挂起
+                await self._divert_all(batch)
+                return
+            for m in batch:
+                if not m.future.done():
+                    m.future.set_exception(exc)
+            return
+        finished = time.perf_counter()
+        self._counters['messages'] += len(batch)
+        self._counters['batches'] += 1
+        self._counters['largest_batch'] = max(self._counters['largest_batch'], len(batch))
+        self._batch_sizes.append(len(batch))
+        for m, row in zip(batch, rows):
+            self._commit_latency.append(finished - m.enqueued)
+            if not m.future.done():
+                m.future.set_result(row)
+        logger.debug("PersonalMessageWriter: 写入 %s 条，耗时 %.1fms", len(batch), (finished - started) * 1000)
+
+    def metrics(self) -> Dict[str, float]:
+        sizes = self._batch_sizes
+        return {
+            'max_batch': self.max_batch,
+            'max_wait_ms': self.max_wait * 1000,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            **self._counters,
+            'avg_batch': round(sum(sizes) / len(sizes), 2) if sizes else 0.0,
+            'commit_latency_p50_ms': round(_percentile(self._commit_latency, 0.50) * 1000, 2),
+            'commit_latency_p99_ms': round(_percentile(self._commit_latency, 0.99) * 1000, 2),
+        }
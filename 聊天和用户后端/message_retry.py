@@ -1,12 +1,27 @@
 import asyncio
+import collections
+import itertools
 import json
+import random
+import time
 import uuid
+import zlib
 import logging
 import os
-from typing import Optional, List
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, List, Tuple
+
+try:
+    from retry_log import RetryLog, RetryLogWriter
+except ImportError:  # 以包形式导入时（如测试中的 `聊天和用户后端.message_retry`）
+    from .retry_log import RetryLog, RetryLogWriter
 
 logger = logging.getLogger(__name__)
 
+# 批量写入：(私信 [(sender_id, receiver_id, content, client_msg_id)], 群消息 [(group, sender, content, client_msg_id)])
+# -> 同一事务提交，按 client_msg_id 去重
+WriteFn = Callable[[List[Tuple[int, int, str, str]], List[Tuple[str, Any, str, str]]], Awaitable[Any]]
+PingFn = Callable[[], Awaitable[Any]]
+
 
 def _env_int(key: str, default: int) -> int:
     try:
@@ -22,50 +37,215 @@ def _env_float(key: str, default: float) -> float:
         return default
 
 
+async def _default_write(personal, group):
+    from postgres_data import adapter as pg_adapter
+
+    return await pg_adapter.create_messages_bulk(personal, group)
+
+
+async def _default_ping():
+    from postgres_data import adapter as pg_adapter
+
+    return await pg_adapter.ping()
+
+
+def _personal_key(sender, receiver) -> str:
+    a, b = sorted((str(sender), str(receiver)))
+    return f"p:{a}:{b}"
+
+
+def _conversation_key(item: dict) -> str:
+    """同一会话内的消息必须按入队顺序写入：私信按无序的 (sender, receiver) 对，群消息按群名。"""
+    p = item.get('payload', {})
+    if item.get('type') == 'group':
+        return f"g:{p.get('group')}"
+    return _personal_key(p.get('sender'), p.get('receiver'))
+
+
+class _CircuitBreaker:
+    """数据库熔断器：写入失败且 ping 也失败（判定为 DB 不可用）时计数，
+    连续 `threshold` 次后打开，冷却期内不再尝试写入；冷却结束进入半开，只放行一个探测批次，
+    成功则关闭，失败则以翻倍（带抖动）的冷却期重新打开。
+    """
+    def __init__(self, threshold: int, cooldown: float, max_cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self.state = 'closed'
+        self.failures = 0
+        self.trips = 0
+        self._opened = 0
+        self._open_until = 0.0
+        self._probing = False
+
+    def acquire(self, now: float) -> float:
+        """返回需要等待的秒数；0 表示可以写入（半开时只放行一个探测者，其它调用方继续等待）。"""
+        if self.state == 'closed':
+            return 0.0
+        if self.state == 'open':
+            if now < self._open_until:
+                return self._open_until - now
+            self.state = 'half_open'
+            self._probing = False
+        if self._probing:
+            return min(self.cooldown, 1.0)
+        self._probing = True
+        return 0.0
+
+    def release(self) -> None:
+        """拿到放行后没有可写的批次时归还探测机会。"""
+        self._probing = False
+
+    def success(self) -> None:
+        if self.state != 'closed':
+            logger.info("MessageRetryManager: 数据库恢复，熔断器关闭")
+        self.state = 'closed'
+        self.failures = 0
+        self._opened = 0
+        self._probing = False
+
+    def failure(self, now: float) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            self._opened += 1
+            self.trips += 1
+            cooldown = min(self.max_cooldown, self.cooldown * 2 ** (self._opened - 1))
+            self._open_until = now + cooldown * random.uniform(0.5, 1.0)
+            self.state = 'open'
+            logger.warning("MessageRetryManager: 数据库不可用（连续 %s 次），熔断 %.1fs", self.failures, self._open_until - now)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'state': self.state, 'consecutive_failures': self.failures, 'trips': self.trips,
+                'open_for': round(max(0.0, self._open_until - time.monotonic()), 2) if self.state == 'open' else 0.0}
+
+
+class _Partition:
+    """一个重试分区：自己的会话队列、唤醒事件与写入任务（会话键哈希决定归属）。"""
+    def __init__(self, index: int):
+        self.index = index
+        self.conversations: Dict[str, Deque[dict]] = {}
+        self.pending = 0
+        self.in_flight = 0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stats = {'written': 0, 'batches': 0}
+
+
 class MessageRetryManager:
     """本地持久化重试队列。
 
     行为与配置：
-    - 持久化文件：由环境变量 `MSG_RETRY_FILE` 指定，默认 `<BASE>/数据库/pending_messages.jsonl`。
-    - 重试间隔：环境变量 `MSG_RETRY_INTERVAL`（秒），默认 5.0。
-    - 最大重试次数：环境变量 `MSG_RETRY_MAX_RETRIES`，默认 5。
-    - 最大队列长度：环境变量 `MSG_RETRY_QUEUE_MAXSIZE`，默认 1000。
+    - 持久化：分段追加日志（见 `retry_log.RetryLog`），目录由环境变量 `MSG_RETRY_DIR` 指定，
+      默认 `<file>.d`；入队、确认、重试更新都只追加一行，不再整文件重写。
+    - 组提交：日志写入统一交给常驻的 `RetryLogWriter`，并发的入队 / 确认合并成一次 write，
+      fsync 策略由 `MSG_RETRY_FSYNC` 指定（`none` / `interval` / `batch`，默认 `interval`，
+      间隔 `MSG_RETRY_FSYNC_INTERVAL` 秒，默认 1.0）；DB 故障期间入队吞吐只受磁盘带宽限制。
+    - 旧版文件：`MSG_RETRY_FILE`，默认 `<BASE>/数据库/pending_messages.jsonl`；启动时若存在，
+      按 id 去重（保留最后一行）后迁入日志，并改名为 `<file>.migrated`。
+    - 排空：入队立即唤醒后台任务（不再轮询）；每次取出最多 `MSG_RETRY_BATCH_SIZE`（默认 500）条
+      已到期的消息，私信与群消息各一条多行 INSERT、同一事务提交（`adapter.create_messages_bulk`）。
+    - 幂等：每条消息带 `client_msg_id`（调用方传入，缺省为队列项 id），写入为
+      `INSERT ... ON CONFLICT (sender, client_msg_id) DO NOTHING`；超时但实际已提交的消息再次入队、
+      批次失败后重写、重启后重放，都不会产生重复行。
+      同一会话（私信双方 / 群）的消息按入队顺序排队，前一条未写入时后面的不会越过它；
+      私信批量写入器在 `has_pending_personal` 为真时把该会话的新消息也转入本队列，而不是直接写入。
+    - 并发：`MSG_RETRY_WORKERS`（默认 4）个分区，会话键按哈希固定归属一个分区，每个分区一个写入任务；
+      同一会话始终串行、保持顺序，不相关的会话并行写入，一条出错的消息只阻塞它自己的会话。
+      `metrics()` 给出每个分区的积压条数与最旧消息的等待时长（lag）。
+    - 失败处理：批次失败后 ping 数据库——
+      - ping 失败视为 DB 不可用：不计入消息的重试次数，交给熔断器（`MSG_RETRY_BREAKER_THRESHOLD`
+        次后打开，默认 3；冷却 `MSG_RETRY_BREAKER_COOLDOWN` 秒起翻倍，默认 2，最长 `MSG_RETRY_BACKOFF_MAX`）；
+      - ping 成功说明是消息本身的问题：按会话二分找出写不进去的消息，只对它计一次重试，
+        以 `MSG_RETRY_INTERVAL`（秒，默认 5.0）为基数指数退避并加抖动，最长 `MSG_RETRY_BACKOFF_MAX`（默认 60）。
+    - 最大重试次数：环境变量 `MSG_RETRY_MAX_RETRIES`，默认 5，超过后转入死信。
+    - 最大队列长度：环境变量 `MSG_RETRY_QUEUE_MAXSIZE`，默认 1000，满时入队等待（启动时重放的消息不受限）。
     - 死信文件：环境变量 `MSG_DEAD_LETTER_FILE`，默认 `<file>.dead`。
+    - 压缩周期：环境变量 `MSG_RETRY_COMPACT_INTERVAL`（秒），默认 30，后台搬移稀疏的旧段。
     """
-    def __init__(self, filepath: Optional[str] = None, retry_interval: Optional[float] = None, max_retries: Optional[int] = None, max_queue_size: Optional[int] = None, dead_letter: Optional[str] = None):
+    def __init__(self, filepath: Optional[str] = None, retry_interval: Optional[float] = None, max_retries: Optional[int] = None, max_queue_size: Optional[int] = None, dead_letter: Optional[str] = None, log_dir: Optional[str] = None, batch_size: Optional[int] = None, workers: Optional[int] = None, write: Optional[WriteFn] = None, ping: Optional[PingFn] = None):
         # 从环境变量读取默认配置（实例化时可覆盖）
         self.filepath = filepath or os.environ.get('MSG_RETRY_FILE', os.path.join(os.path.dirname(__file__), '..', '数据库', 'pending_messages.jsonl'))
         self.retry_interval = retry_interval if retry_interval is not None else _env_float('MSG_RETRY_INTERVAL', 5.0)
         self.max_retries = max_retries if max_retries is not None else _env_int('MSG_RETRY_MAX_RETRIES', 5)
         self.max_queue_size = max_queue_size if max_queue_size is not None else _env_int('MSG_RETRY_QUEUE_MAXSIZE', 1000)
         self.dead_letter = dead_letter or os.environ.get('MSG_DEAD_LETTER_FILE', self.filepath + '.dead')
+        self.log_dir = log_dir or os.environ.get('MSG_RETRY_DIR', self.filepath + '.d')
+        self.compact_interval = _env_float('MSG_RETRY_COMPACT_INTERVAL', 30.0)
+        self.batch_size = max(1, batch_size if batch_size is not None else _env_int('MSG_RETRY_BATCH_SIZE', 500))
+        self.backoff_max = max(self.retry_interval, _env_float('MSG_RETRY_BACKOFF_MAX', 60.0))
+        self.workers = max(1, workers if workers is not None else _env_int('MSG_RETRY_WORKERS', 4))
+        self._write = write or _default_write
+        self._ping = ping or _default_ping
+        self._breaker = _CircuitBreaker(_env_int('MSG_RETRY_BREAKER_THRESHOLD', 3), _env_float('MSG_RETRY_BREAKER_COOLDOWN', 2.0), self.backoff_max)
 
-        self._queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queue_size)
-        self._task: Optional[asyncio.Task] = None
+        self._log = RetryLog(self.log_dir)
+        self._writer = RetryLogWriter(self._log)
+        self._seq = itertools.count(1)
+        # 每个分区：会话键 -> 按 seq 排序的待写消息；消息 id -> 下次可尝试的时刻 / 入队时刻（monotonic）
+        self._partitions = [_Partition(i) for i in range(self.workers)]
+        self._due: Dict[str, float] = {}
+        self._since: Dict[str, float] = {}
+        # 会话键 -> 尚未写入的条数（含正在写入的批次），供 `has_pending_personal` 判断
+        self._pending_keys: Dict[str, int] = collections.Counter()
+        self._size = 0
+        self._space: Optional[asyncio.Event] = None
+        self._compactor: Optional[asyncio.Task] = None
         self._stop = False
+        self.stats = {'written': 0, 'batches': 0, 'failed_batches': 0, 'retried': 0, 'dead_lettered': 0, 'largest_batch': 0}
 
     async def start(self):
-        # 加载持久化文件到内存队列（以安全方式读取并在 event loop 中放入 asyncio.Queue）
+        for part in self._partitions:
+            part.wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        # 重放日志（并迁入旧版文件）
         try:
-            objs = await asyncio.to_thread(self._load_file_to_list)
+            objs = await asyncio.to_thread(self._open_log)
             for obj in objs:
-                # 如果文件中项超过队容量，此处会阻塞直到有空间
-                await self._queue.put(obj)
+                self._add(obj)
         except Exception:
-            logger.exception("MessageRetryManager: 加载持久化文件失败")
-        self._task = asyncio.create_task(self._worker())
-        logger.info("MessageRetryManager: started (file=%s interval=%s max_retries=%s queue_max=%s)", self.filepath, self.retry_interval, self.max_retries, self.max_queue_size)
+            logger.exception("MessageRetryManager: 加载持久化日志失败")
+        await self._writer.start()
+        for part in self._partitions:
+            part.task = asyncio.create_task(self._worker(part))
+        self._compactor = asyncio.create_task(self._compact_loop())
+        logger.info("MessageRetryManager: started (dir=%s pending=%s workers=%s batch=%s fsync=%s interval=%s max_retries=%s queue_max=%s)", self.log_dir, self._size, self.workers, self.batch_size, self._writer.fsync, self.retry_interval, self.max_retries, self.max_queue_size)
 
     async def stop(self):
         self._stop = True
-        if self._task:
-            self._task.cancel()
-            try:
-                await self._task
-            except asyncio.CancelledError:
-                pass
+        for task in [p.task for p in self._partitions] + [self._compactor]:
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        await self._writer.stop()
+        await asyncio.to_thread(self._log.close)
         logger.info("MessageRetryManager: stopped")
 
+    def _open_log(self) -> List[dict]:
+        objs = self._log.open()
+        legacy = self._load_file_to_list()
+        if legacy:
+            # 旧版文件中失败重试会重复追加同一 id，后写的重试计数更新
+            latest = {}
+            for obj in legacy:
+                if obj.get('id'):
+                    latest[obj['id']] = obj
+            seq = max((o.get('seq', 0) for o in objs), default=0)
+            migrated = []
+            for obj in latest.values():
+                seq += 1
+                obj['seq'] = seq
+                migrated.append(obj)
+            self._log.put(migrated)
+            os.replace(self.filepath, self.filepath + '.migrated')
+            logger.info("MessageRetryManager: 从 %s 迁入 %s 条待重试消息", self.filepath, len(migrated))
+            objs = objs + migrated
+        self._seq = itertools.count(max((o.get('seq', 0) for o in objs), default=0) + 1)
+        return objs
+
     def _load_file_to_list(self) -> List[dict]:
         out: List[dict] = []
         try:
@@ -85,139 +265,261 @@ class MessageRetryManager:
             logger.exception("MessageRetryManager: 读取持久化文件失败")
         return out
 
-    async def _append_to_file(self, obj: dict):
+    async def _append_to_dead_letter(self, obj: dict):
         def _write():
-            with open(self.filepath, 'a', encoding='utf-8') as f:
+            with open(self.dead_letter, 'a', encoding='utf-8') as f:
                 f.write(json.dumps(obj, ensure_ascii=False) + "\n")
         await asyncio.to_thread(_write)
 
-    async def _remove_from_file(self, obj_id: str):
-        def _rewrite():
+    async def _compact_loop(self):
+        while not self._stop:
+            await asyncio.sleep(self.compact_interval)
             try:
-                lines = []
-                with open(self.filepath, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        try:
-                            j = json.loads(line)
-                            if j.get('id') != obj_id:
-                                lines.append(line)
-                        except Exception:
-                            lines.append(line)
-                with open(self.filepath, 'w', encoding='utf-8') as f:
-                    f.writelines(lines)
-            except FileNotFoundError:
-                return
+                moved = await asyncio.to_thread(self._log.compact)
+                if moved:
+                    logger.info("MessageRetryManager: 压缩日志，搬移 %s 条待重试消息", moved)
             except Exception:
-                logger.exception("MessageRetryManager: 重写持久化文件失败")
-        await asyncio.to_thread(_rewrite)
+                logger.exception("MessageRetryManager: 压缩日志失败")
 
-    async def _append_to_dead_letter(self, obj: dict):
-        def _write():
-            with open(self.dead_letter, 'a', encoding='utf-8') as f:
-                f.write(json.dumps(obj, ensure_ascii=False) + "\n")
-        await asyncio.to_thread(_write)
+    # ---- 入队 ----
+
+    async def _enqueue(self, obj: dict):
+        while self._space is not None and self._size >= self.max_queue_size and not self._stop:
+            self._space.clear()
+            await self._space.wait()
+        await self._writer.put([obj])
+        self._add(obj)
+
+    def _partition(self, key: str) -> _Partition:
+        return self._partitions[zlib.crc32(key.encode('utf-8')) % len(self._partitions)]
+
+    def _add(self, obj: dict) -> None:
+        key = _conversation_key(obj)
+        part = self._partition(key)
+        part.conversations.setdefault(key, collections.deque()).append(obj)
+        part.pending += 1
+        self._pending_keys[key] += 1
+        self._due[obj['id']] = 0.0
+        self._since[obj['id']] = time.monotonic()
+        self._size += 1
+        if part.wakeup is not None:
+            part.wakeup.set()
 
-    async def enqueue_personal(self, sender: int, receiver: int, content: str, ts: Optional[str] = None):
+    async def enqueue_personal(self, sender: int, receiver: int, content: str, ts: Optional[str] = None, client_msg_id: Optional[str] = None):
+        obj_id = uuid.uuid4().hex
         obj = {
-            'id': uuid.uuid4().hex,
+            'id': obj_id,
+            'seq': next(self._seq),
             'type': 'personal',
             'retries': 0,
             'payload': {
-                'sender': int(sender), 'receiver': int(receiver), 'content': content, 'ts': ts
+                'sender': int(sender), 'receiver': int(receiver), 'content': content, 'ts': ts,
+                'client_msg_id': client_msg_id or obj_id,
             }
         }
-        await self._append_to_file(obj)
-        await self._queue.put(obj)
+        await self._enqueue(obj)
         logger.info("MessageRetryManager: enqueue personal %s->%s", sender, receiver)
 
-    async def enqueue_group(self, group: str, sender: str, content: str, ts: Optional[str] = None):
+    async def enqueue_group(self, group: str, sender: str, content: str, ts: Optional[str] = None, client_msg_id: Optional[str] = None):
+        obj_id = uuid.uuid4().hex
         obj = {
-            'id': uuid.uuid4().hex,
+            'id': obj_id,
+            'seq': next(self._seq),
             'type': 'group',
             'retries': 0,
-            'payload': {'group': group, 'sender': str(sender), 'content': content, 'ts': ts}
+            'payload': {'group': group, 'sender': str(sender), 'content': content, 'ts': ts, 'client_msg_id': client_msg_id or obj_id}
         }
-        await self._append_to_file(obj)
-        await self._queue.put(obj)
+        await self._enqueue(obj)
         logger.info("MessageRetryManager: enqueue group %s@%s", sender, group)
 
-    async def _worker(self):
-        # 延迟导入数据库适配器，避免启动时的循环导入问题
+    def has_pending_personal(self, sender, receiver) -> bool:
+        """该私聊会话是否还有未写入（或正在写入）的消息；为真时新消息也应入队，排在它们之后。"""
+        return self._pending_keys.get(_personal_key(sender, receiver), 0) > 0
+
+    # ---- 排空 ----
+
+    def _backoff(self, retries: int) -> float:
+        """指数退避 + 抖动：基数 retry_interval，上限 backoff_max，实际取 [d/2, d]。"""
+        delay = min(self.backoff_max, self.retry_interval * 2 ** max(0, retries - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _take_ready(self, part: _Partition, now: float) -> Tuple[List[dict], Optional[float]]:
+        """按会话取出分区内已到期的消息（每个会话从队首连续取），返回 (批次, 最近一条未到期消息的等待秒数)。"""
+        batch: List[dict] = []
+        wait: Optional[float] = None
+        for key in list(part.conversations):
+            dq = part.conversations[key]
+            while dq and len(batch) < self.batch_size:
+                due = self._due.get(dq[0]['id'], 0.0)
+                if due > now:
+                    wait = due - now if wait is None else min(wait, due - now)
+                    break
+                batch.append(dq.popleft())
+            if not dq:
+                del part.conversations[key]
+            if len(batch) >= self.batch_size:
+                break
+        return batch, wait
+
+    def _requeue(self, items: List[dict], due: float) -> None:
+        """放回各自会话的队首（保持原顺序），最早在 `due` 时刻重试。"""
+        by_key: Dict[str, List[dict]] = {}
+        for it in items:
+            by_key.setdefault(_conversation_key(it), []).append(it)
+            self._due[it['id']] = max(self._due.get(it['id'], 0.0), due)
+        for key, its in by_key.items():
+            self._partition(key).conversations.setdefault(key, collections.deque()).extendleft(reversed(its))
+
+    def _forget(self, items: List[dict]) -> None:
+        for it in items:
+            key = _conversation_key(it)
+            self._due.pop(it['id'], None)
+            self._since.pop(it['id'], None)
+            self._partition(key).pending -= 1
+            self._pending_keys[key] -= 1
+            if self._pending_keys[key] <= 0:
+                del self._pending_keys[key]
+        self._size -= len(items)
+        if self._space is not None and self._size < self.max_queue_size:
+            self._space.set()
+
+    async def _sleep(self, part: _Partition, timeout: Optional[float]) -> None:
+        part.wakeup.clear()
         try:
-            from postgres_data import adapter as pg_adapter
-        except Exception:
-            pg_adapter = None
+            await asyncio.wait_for(part.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
+    async def _worker(self, part: _Partition):
         while not self._stop:
             try:
-                if self._queue.empty():
-                    await asyncio.sleep(self.retry_interval)
+                now = time.monotonic()
+                wait = self._breaker.acquire(now)
+                if wait > 0:
+                    await asyncio.sleep(wait)
                     continue
-                item = await self._queue.get()
-                obj_id = item.get('id')
-                typ = item.get('type')
-                payload = item.get('payload', {})
-                retries = int(item.get('retries', 0))
-                sent = False
-
+                batch, wait = self._take_ready(part, now)
+                if not batch:
+                    self._breaker.release()
+                    await self._sleep(part, wait)
+                    continue
+                part.in_flight = len(batch)
                 try:
-                    if not (pg_adapter and getattr(pg_adapter, 'create_personal_message', None)):
-                        # 如果没有适配器，放回队列并延迟
-                        await asyncio.sleep(self.retry_interval)
-                        # 增加重试计数
-                        item['retries'] = retries + 1
-                        if item['retries'] > self.max_retries:
-                            logger.warning("MessageRetryManager: 达到最大重试，转入死信: %s", obj_id)
-                            await self._append_to_dead_letter(item)
-                            await self._remove_from_file(obj_id)
-                            continue
-                        await self._append_to_file(item)
-                        await self._queue.put(item)
-                        continue
-
-                    if typ == 'personal':
-                        try:
-                            await pg_adapter.create_personal_message(payload.get('sender'), payload.get('receiver'), payload.get('content'), payload.get('ts'))
-                            sent = True
-                        except Exception:
-                            logger.exception("MessageRetryManager: 发送 personal 到 DB 失败，稍后重试")
-                    elif typ == 'group':
-                        try:
-                            await pg_adapter.create_group_message(payload.get('group'), payload.get('sender'), payload.get('content'), payload.get('ts'))
-                            sent = True
-                        except Exception:
-                            logger.exception("MessageRetryManager: 发送 group 到 DB 失败，稍后重试")
-
-                except Exception:
-                    logger.exception("MessageRetryManager: worker 内部异常")
-
-                if sent:
-                    try:
-                        await self._remove_from_file(obj_id)
-                    except Exception:
-                        logger.exception("MessageRetryManager: 从文件中移除已发送消息失败")
-                else:
-                    # 未发送成功，增加重试计数并判断是否进入死信
-                    retries += 1
-                    item['retries'] = retries
-                    if retries > self.max_retries:
-                        logger.warning("MessageRetryManager: 达到最大重试次数(%s)，将消息转入死信: %s", self.max_retries, obj_id)
-                        try:
-                            await self._append_to_dead_letter(item)
-                            await self._remove_from_file(obj_id)
-                        except Exception:
-                            logger.exception("MessageRetryManager: 写入死信或清理持久化文件失败")
-                        continue
-
-                    # 将更新后的重试对象追加到持久化文件，并在循环结束后等待再放回队列
-                    try:
-                        await self._append_to_file(item)
-                    except Exception:
-                        logger.exception("MessageRetryManager: 更新持久化文件失败")
-                    await asyncio.sleep(self.retry_interval)
-                    await self._queue.put(item)
+                    await self._flush(part, batch)
+                finally:
+                    part.in_flight = 0
             except asyncio.CancelledError:
                 break
             except Exception:
-                logger.exception("MessageRetryManager: worker 主循环异常，继续")
+                logger.exception("MessageRetryManager: 分区 %s 的 worker 主循环异常，继续", part.index)
                 await asyncio.sleep(self.retry_interval)
+
+    async def _try_write(self, part: _Partition, batch: List[dict]) -> bool:
+        personal, group = [], []
+        for it in batch:
+            p = it.get('payload', {})
+            # 旧版队列项没有 client_msg_id，用稳定的队列项 id 代替
+            cid = p.get('client_msg_id') or it['id']
+            if it.get('type') == 'group':
+                group.append((p.get('group'), p.get('sender'), p.get('content'), cid))
+            else:
+                personal.append((p.get('sender'), p.get('receiver'), p.get('content'), cid))
+        try:
+            await self._write(personal, group)
+        except Exception:
+            self.stats['failed_batches'] += 1
+            logger.exception("MessageRetryManager: 批量写入 %s 条消息失败", len(batch))
+            return False
+        self.stats['written'] += len(batch)
+        self.stats['batches'] += 1
+        part.stats['written'] += len(batch)
+        part.stats['batches'] += 1
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], len(batch))
+        self._forget(batch)
+        try:
+            await self._writer.ack([it['id'] for it in batch])
+        except Exception:
+            logger.exception("MessageRetryManager: 记录已写入的消息失败（重启后可能重复写入）")
+        return True
+
+    async def _db_available(self) -> bool:
+        try:
+            await self._ping()
+            return True
+        except Exception:
+            return False
+
+    async def _flush(self, part: _Partition, batch: List[dict]) -> None:
+        if await self._try_write(part, batch):
+            self._breaker.success()
+            return
+        now = time.monotonic()
+        if not await self._db_available():
+            # DB 不可用：不计入消息重试次数，由熔断器暂停写入
+            self._breaker.failure(now)
+            self._requeue(batch, now + self._backoff(1))
+            return
+        self._breaker.success()
+        # DB 可用而写入失败：是消息本身的问题，按会话二分，找出写不进去的那条
+        keys = list(dict.fromkeys(_conversation_key(it) for it in batch))
+        if len(keys) > 1:
+            left = set(keys[:len(keys) // 2])
+            await self._flush(part, [it for it in batch if _conversation_key(it) in left])
+            await self._flush(part, [it for it in batch if _conversation_key(it) not in left])
+        elif len(batch) > 1:
+            head, rest = batch[0], batch[1:]
+            if await self._try_write(part, [head]):
+                await self._flush(part, rest)
+            else:
+                # 同会话后续消息排在失败的队首之后，等它重试成功或转入死信
+                self._requeue(rest, 0.0)
+                await self._fail(head)
+        else:
+            await self._fail(batch[0])
+
+    async def _fail(self, item: dict) -> None:
+        """单条消息写入失败：计一次重试并退避，超过上限转入死信。"""
+        item['retries'] = int(item.get('retries', 0)) + 1
+        if item['retries'] > self.max_retries:
+            logger.warning("MessageRetryManager: 达到最大重试次数(%s)，将消息转入死信: %s", self.max_retries, item.get('id'))
+            self.stats['dead_lettered'] += 1
+            self._forget([item])
+            try:
+                await self._append_to_dead_letter(item)
+                await self._writer.ack([item['id']])
+            except Exception:
+                logger.exception("MessageRetryManager: 写入死信或记录确认失败")
+            return
+        self.stats['retried'] += 1
+        try:
+            await self._writer.put([item])
+        except Exception:
+            logger.exception("MessageRetryManager: 更新持久化日志失败")
+        self._requeue([item], time.monotonic() + self._backoff(item['retries']))
+
+    def _partition_metrics(self, part: _Partition, now: float) -> dict:
+        oldest = min((self._since.get(dq[0]['id'], now) for dq in part.conversations.values() if dq), default=now)
+        return {
+            'index': part.index,
+            'pending': part.pending,
+            'conversations': len(part.conversations),
+            'in_flight': part.in_flight,
+            'lag_seconds': round(now - oldest, 3),
+            **part.stats,
+        }
+
+    def metrics(self) -> dict:
+        now = time.monotonic()
+        partitions = [self._partition_metrics(p, now) for p in self._partitions]
+        return {
+            'pending': self._size,
+            'workers': self.workers,
+            'conversations': sum(p['conversations'] for p in partitions),
+            'backing_off': sum(1 for due in self._due.values() if due > now),
+            'max_lag_seconds': max((p['lag_seconds'] for p in partitions), default=0.0),
+            'breaker': self._breaker.metrics(),
+            **self.stats,
+            'partitions': partitions,
+            'log': self._log.metrics(),
+            'writer': self._writer.metrics(),
+        }
@@ -0,0 +1,117 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DISCONNECT = 'disconnect'
+DROP_OLDEST = 'drop_oldest'
+
+# 慢消费者被断开时使用的关闭码（1013: Try Again Later）
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+_ids = itertools.count(1)
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+class ClientConnection:
+    """一条 WebSocket 连接及其出站队列。
+
+    - 发送方只把已序列化的文本放入有界队列（`WS_SEND_QUEUE_MAX`，默认 256），不等待网络写入；
+      每条连接由自己的写任务按顺序 `send_text`，慢客户端只拖慢它自己；
+    - 队列满时按 `WS_SLOW_CONSUMER_POLICY` 处理：`disconnect`（默认）断开该连接（关闭码 1013），
+      `drop_oldest` 丢弃最旧的一条继续发送；
+    - 写入失败或被断开后调用 `on_close(conn)`，由 ConnectionManager 移除连接、更新在线状态。
+    """
+    def __init__(self, user_id: str, websocket: Any, presence_id: Optional[int] = None, max_queue: Optional[int] = None, policy: Optional[str] = None, on_close: Optional[Callable[['ClientConnection'], None]] = None):
+        self.id = next(_ids)
+        self.user_id = user_id
+        self.websocket = websocket
+        self.presence_id = presence_id
+        self.max_queue = max(1, max_queue if max_queue is not None else _env_int('WS_SEND_QUEUE_MAX', 256))
+        self.policy = policy or os.environ.get('WS_SLOW_CONSUMER_POLICY', DISCONNECT)
+        self.on_close = on_close
+        self.closed = False
+        self.slow_consumer = False
+        self._closer: Optional[asyncio.Future] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queue)
+        self._writer: Optional[asyncio.Task] = None
+        self.stats = {'sent': 0, 'dropped': 0, 'peak_depth': 0}
+        # 心跳：last_seen 为最近一次收到任意帧（含 pong），last_activity 为最近一次收到业务消息
+        self.connected_at = self.last_seen = self.last_activity = time.monotonic()
+
+    def touch(self, activity: bool = True) -> None:
+        now = time.monotonic()
+        self.last_seen = now
+        if activity:
+            self.last_activity = now
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        self._writer = asyncio.create_task(self._drain())
+
+    def enqueue(self, text: str) -> bool:
+        """放入出站队列；连接已关闭或因溢出被断开时返回 False。"""
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait(text)
+        except asyncio.QueueFull:
+            if self.policy == DROP_OLDEST:
+                self._queue.get_nowait()
+                self._queue.put_nowait(text)
+                self.stats['dropped'] += 1
+            else:
+                self.stats['dropped'] += 1
+                logger.warning("连接 %s（用户 %s）出站队列已满（%s），断开慢消费者", self.id, self.user_id, self.max_queue)
+                self.close(SLOW_CONSUMER_CLOSE_CODE, slow_consumer=True)
+                return False
+        self.stats['peak_depth'] = max(self.stats['peak_depth'], self._queue.qsize())
+        return True
+
+    async def _drain(self) -> None:
+        try:
+            while True:
+                text = await self._queue.get()
+                await self.websocket.send_text(text)
+                self.stats['sent'] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.info("连接 %s（用户 %s）写入失败，关闭连接", self.id, self.user_id, exc_info=True)
+            self.close(1011)
+
+    def close(self, code: int = 1000, slow_consumer: bool = False) -> None:
+        """停止写任务并关闭底层连接（可重复调用）。"""
+        if self.closed:
+            return
+        self.closed = True
+        self.slow_consumer = slow_consumer
+        writer = self._writer
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+        if self.on_close is not None:
+            self.on_close(self)
+        if code != 1000:
+            self._closer = asyncio.ensure_future(self._close_socket(code))
+
+    async def _close_socket(self, code: int) -> None:
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            logger.debug("关闭连接 %s 失败（可能已关闭）", self.id, exc_info=True)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'id': self.id, 'user_id': self.user_id, 'depth': self.depth, **self.stats}
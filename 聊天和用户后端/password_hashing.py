@@ -0,0 +1,179 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+from typing import Deque, Dict, Optional
+
+try:
+    from passlib.hash import argon2
+except Exception:
+    argon2 = None
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+# ---- 在工作进程中执行的函数（必须是模块级，以便 pickle） ----
+
+def _hash(password: str) -> str:
+    return argon2.hash(password)
+
+
+def _verify(password: str, password_hash: str) -> bool:
+    return bool(argon2.verify(password, password_hash))
+
+
+def _warm_up() -> int:
+    # 触发 argon2 后端加载，避免首个真实请求承担导入开销
+    return os.getpid() if argon2 is not None and argon2.has_backend() else 0
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+class PasswordHasherUnavailable(RuntimeError):
+    """无法完成哈希 / 校验（未安装 argon2、进程池重建后仍损坏、执行超时），调用方应返回 503。"""
+
+
+class PasswordHasherBusy(PasswordHasherUnavailable):
+    """等待中的哈希请求超过上限（过载保护），调用方应返回 503。"""
+
+
+def _percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class PasswordHasher:
+    """在独立进程池中执行 argon2 哈希 / 校验，避免阻塞事件循环。
+
+    - 进程数：`PASSWORD_HASH_WORKERS`（默认 min(4, CPU 数)）；
+    - 同时提交到进程池的任务数以信号量限制为 workers * 2，其余请求在事件循环中排队，
+      排队数超过 `PASSWORD_HASH_MAX_QUEUE`（默认 1000）时抛出 PasswordHasherBusy；
+    - 进程启动方式：`PASSWORD_HASH_START_METHOD`（默认 spawn，避免 fork 带有线程/连接的服务进程）；
+    - 单次执行超过 `PASSWORD_HASH_TIMEOUT` 秒（默认 30）视为失败；超时、进程池重建后仍损坏、
+      未安装 argon2 都抛出 PasswordHasherUnavailable（PasswordHasherBusy 是它的子类）；
+    - `metrics()` 返回排队 / 执行耗时分位数等指标，供 /health/password_hasher 使用。
+
+    进程池在 `start()` 或首次调用时创建；工作进程异常退出时自动重建。
+    """
+    def __init__(self, max_workers: Optional[int] = None, max_queue: Optional[int] = None, start_method: Optional[str] = None, sample_size: int = 2048, timeout: Optional[float] = None):
+        self.max_workers = max(1, max_workers if max_workers is not None else _env_int('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1)))
+        self.max_queue = max_queue if max_queue is not None else _env_int('PASSWORD_HASH_MAX_QUEUE', 1000)
+        self.timeout = timeout if timeout is not None else _env_float('PASSWORD_HASH_TIMEOUT', 30.0)
+        self.start_method = start_method or os.environ.get('PASSWORD_HASH_START_METHOD', 'spawn')
+        self._pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._slots = asyncio.Semaphore(self.max_workers * 2)
+        self._waiting = 0
+        self._in_flight = 0
+        self._counters: Dict[str, int] = {'submitted': 0, 'completed': 0, 'errors': 0, 'rejected': 0, 'peak_waiting': 0, 'pool_restarts': 0}
+        self._queue_wait: Deque[float] = collections.deque(maxlen=sample_size)
+        self._service: Deque[float] = collections.deque(maxlen=sample_size)
+
+    @property
+    def available(self) -> bool:
+        return argon2 is not None
+
+    def _ensure_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._pool is None:
+            ctx = multiprocessing.get_context(self.start_method)
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers, mp_context=ctx)
+        return self._pool
+
+    async def start(self):
+        if not self.available:
+            logger.warning("PasswordHasher: 未安装 argon2（passlib[argon2]），密码哈希不可用")
+            return
+        pool = self._ensure_pool()
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(loop.run_in_executor(pool, _warm_up) for _ in range(self.max_workers)))
+        logger.info("PasswordHasher: started (workers=%s start_method=%s pids=%s)", self.max_workers, self.start_method, sorted(set(pids)))
+
+    async def stop(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            await asyncio.to_thread(pool.shutdown, True, cancel_futures=True)
+            logger.info("PasswordHasher: stopped")
+
+    async def _run(self, fn, *args):
+        if not self.available:
+            raise PasswordHasherUnavailable("argon2 不可用")
+        if self._waiting >= self.max_queue:
+            self._counters['rejected'] += 1
+            raise PasswordHasherBusy(f"等待中的密码哈希请求过多（{self._waiting}）")
+        enqueued = time.perf_counter()
+        self._waiting += 1
+        self._counters['peak_waiting'] = max(self._counters['peak_waiting'], self._waiting)
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        started = time.perf_counter()
+        self._queue_wait.append(started - enqueued)
+        self._counters['submitted'] += 1
+        self._in_flight += 1
+        try:
+            pool = self._ensure_pool()
+            try:
+                try:
+                    result = await self._submit(pool, fn, args)
+                except concurrent.futures.process.BrokenProcessPool:
+                    # 工作进程被杀（OOM 等）：关闭旧池（回收管理线程与残留子进程）并重建后重试一次；
+                    # 同一个坏池上的并发请求只由第一个负责重建
+                    if self._pool is pool:
+                        logger.warning("PasswordHasher: 进程池已损坏，重建后重试")
+                        self._counters['pool_restarts'] += 1
+                        self._pool = None
+                        pool.shutdown(wait=False, cancel_futures=True)
+                    result = await self._submit(self._ensure_pool(), fn, args)
+            except concurrent.futures.process.BrokenProcessPool as exc:
+                raise PasswordHasherUnavailable("密码哈希进程池重建后仍不可用") from exc
+            except asyncio.TimeoutError as exc:
+                raise PasswordHasherUnavailable(f"密码哈希执行超过 {self.timeout} 秒") from exc
+            self._counters['completed'] += 1
+            return result
+        except Exception:
+            self._counters['errors'] += 1
+            raise
+        finally:
+            self._in_flight -= 1
+            self._service.append(time.perf_counter() - started)
+            self._slots.release()
+
+    async def _submit(self, pool: concurrent.futures.Executor, fn, args):
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(pool, fn, *args), self.timeout)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        return await self._run(_verify, password, password_hash)
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            'workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'waiting': self._waiting,
+            'in_flight': self._in_flight,
+            **self._counters,
+            'queue_wait_p50_ms': round(_percentile(self._queue_wait, 0.50) * 1000, 2),
+            'queue_wait_p99_ms': round(_percentile(self._queue_wait, 0.99) * 1000, 2),
+            'service_p50_ms': round(_percentile(self._service, 0.50) * 1000, 2),
+            'service_p99_ms': round(_percentile(self._service, 0.99) * 1000, 2),
+        }
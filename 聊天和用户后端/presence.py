@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+ONLINE = 'online'
+OFFLINE = 'offline'
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+class PresenceRegistry:
+    """在线状态表，由 `ConnectionManager` 的连接 / 断开驱动，多 worker 部署时经数据库汇总。
+
+    - 每个用户记录本进程存活的 WebSocket 数，0 -> 1 记为 online，1 -> 0 记为 offline；
+    - 状态变化只写入待落库表 `_pending`（同一用户只保留最后一次状态），
+      重连抖动（offline -> online）在一个刷新周期内被合并，通常不产生任何写入；
+    - 后台任务每 `PRESENCE_FLUSH_INTERVAL` 秒（默认 1.0）通过 `adapter.sync_presence` 把本 worker
+      持有连接的用户同步到 presence_connections（按 worker 区分），并据所有 worker 推导 users.state：
+      一个 worker 上的断开不会在其它 worker 仍持有连接时把用户置为 offline。写入失败的条目会被放回，
+      下个周期重试（不会覆盖期间产生的更新状态）；
+    - 同步时顺带刷新本 worker 的心跳（空闲时至少每 `PRESENCE_WORKER_TTL / 3` 秒一次，默认 TTL 30 秒），
+      心跳超时的 worker（崩溃、被杀）的连接由其它 worker 回收；正常退出时 `stop()` 主动回收。
+
+    查询：本进程持有连接的用户直接判为 online，其余以 users.state 为准（其它 worker 的连接
+    最多延迟一个刷新周期可见）。
+    """
+    def __init__(self, flush_interval: Optional[float] = None, worker_id: Optional[str] = None, worker_ttl: Optional[float] = None):
+        self.flush_interval = flush_interval if flush_interval is not None else _env_float('PRESENCE_FLUSH_INTERVAL', 1.0)
+        self.worker_ttl = worker_ttl if worker_ttl is not None else _env_float('PRESENCE_WORKER_TTL', 30.0)
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"[-64:]
+        self._connections: Dict[int, int] = {}
+        self._pending: Dict[int, str] = {}
+        self._last_sync = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._stop = False
+        self._flush_lock = asyncio.Lock()
+        self.stats = {'transitions': 0, 'coalesced': 0, 'flushes': 0, 'rows_written': 0, 'flush_errors': 0}
+
+    # ---- 连接驱动 ----
+
+    def _mark(self, user_id: int, state: str) -> None:
+        self.stats['transitions'] += 1
+        if user_id in self._pending:
+            self.stats['coalesced'] += 1
+        self._pending[user_id] = state
+
+    def connected(self, user_id: int) -> None:
+        n = self._connections.get(user_id, 0) + 1
+        self._connections[user_id] = n
+        if n == 1:
+            self._mark(user_id, ONLINE)
+
+    def disconnected(self, user_id: int) -> None:
+        n = self._connections.get(user_id, 0) - 1
+        if n > 0:
+            self._connections[user_id] = n
+            return
+        if self._connections.pop(user_id, None) is not None:
+            self._mark(user_id, OFFLINE)
+
+    # ---- 查询 ----
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._connections
+
+    def online_count(self) -> int:
+        return len(self._connections)
+
+    def lookup(self, user_ids: Iterable[int]) -> Dict[int, str]:
+        """仅依据本进程持有的连接判断（不访问数据库）；跨 worker 的查询用 `resolve`。"""
+        conns = self._connections
+        return {uid: (ONLINE if uid in conns else OFFLINE) for uid in user_ids}
+
+    async def resolve(self, user_ids: Iterable[int]) -> Dict[int, str]:
+        """批量查询在线状态：本进程持有连接的直接判为 online，其余一条语句读取 users.state。"""
+        uids = list(user_ids)
+        out = self.lookup(uids)
+        remote = [uid for uid, state in out.items() if state != ONLINE]
+        if remote:
+            from postgres_data import adapter as pg_adapter
+
+            states = await pg_adapter.fetch_user_states(remote)
+            for uid in remote:
+                out[uid] = ONLINE if states.get(uid) == ONLINE else OFFLINE
+        return out
+
+    def state_for(self, user_id: int, fallback: Optional[str]) -> Optional[str]:
+        """本进程有连接时为 online，否则返回数据库中的 `fallback`（可能由其它 worker 的连接维持）。"""
+        if user_id in self._connections:
+            return ONLINE
+        return fallback
+
+    # ---- 落库 ----
+
+    async def flush(self, retire: bool = False) -> int:
+        """把待落库的状态一次性同步到数据库（无变化时按需只刷新心跳），返回实际改写 users.state 的行数。"""
+        async with self._flush_lock:
+            if not self._pending and not retire and time.monotonic() - self._last_sync < self.worker_ttl / 3:
+                return 0
+            batch, self._pending = self._pending, {}
+            from postgres_data import adapter as pg_adapter
+
+            try:
+                written = await pg_adapter.sync_presence(self.worker_id, batch, self.worker_ttl, retire=retire)
+                self._last_sync = time.monotonic()
+            except Exception:
+                self.stats['flush_errors'] += 1
+                # 放回未写入的状态；期间产生的新状态优先
+                for uid, state in batch.items():
+                    self._pending.setdefault(uid, state)
+                raise
+            self.stats['flushes'] += 1
+            self.stats['rows_written'] += written
+            return written
+
+    async def settle(self, user_id: int) -> None:
+        """若该用户有尚未落库的状态，立即落库（登录前调用，避免读到过期的 online）。"""
+        if user_id in self._pending:
+            await self.flush()
+
+    async def start(self):
+        self._stop = False
+        self._task = asyncio.create_task(self._worker())
+        logger.info("PresenceRegistry: started (worker=%s flush_interval=%ss worker_ttl=%ss)", self.worker_id, self.flush_interval, self.worker_ttl)
+
+    async def stop(self):
+        self._stop = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        try:
+            # 回收本 worker 的全部连接行：仍在其它 worker 上在线的用户保持 online
+            await self.flush(retire=True)
+        except Exception:
+            logger.exception("PresenceRegistry: 关闭前落库失败")
+        logger.info("PresenceRegistry: stopped")
+
+    async def _worker(self):
+        while not self._stop:
+            try:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                logger.exception("PresenceRegistry: 批量写入在线状态失败，下个周期重试")
+
+    def metrics(self) -> Dict[str, object]:
+        return {'worker_id': self.worker_id, 'online': len(self._connections), 'pending': len(self._pending), **self.stats}
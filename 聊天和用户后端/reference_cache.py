@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+class CacheSnapshot(NamedTuple):
+    """一次构建的不可变结果：`value` 构建后不再修改，读者可在无锁情况下直接使用。"""
+    version: int
+    value: Any
+    etag: str
+    built_at: float
+
+
+def compute_etag(name: str, version: int, value: Any) -> str:
+    """强 ETag：数据版本号 + 内容摘要，同一内容在不同进程中得到相同的值。"""
+    body = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')
+    return f'"{name}-{version}-{hashlib.sha1(body).hexdigest()[:16]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """按 RFC 7232 比较 If-None-Match（支持逗号分隔的多个值与 `*`）。"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+
+class VersionedCache:
+    """以 data_versions 表中的版本号为失效依据的进程内读穿缓存。
+
+    - 读路径无锁：快照新鲜时 `get()` 直接返回当前快照（一次引用读取）；
+    - 最多每 `check_interval` 秒查询一次版本号（单行主键查询），版本变化、快照超过 `ttl`
+      或调用了 `invalidate()` 时调用 `loader` 重建；
+    - 防击穿：同一时刻只有一个协程执行刷新；已有快照时其它请求不等待，继续读旧快照，
+      只有冷启动（尚无快照）时才排队等待首次加载；
+    - 刷新失败（如 Postgres 不可用）时保留上一份成功的快照继续服务，并在 `check_interval`
+      之后再重试；从未成功加载过时把异常抛给调用方。
+    - 快照整体替换（引用赋值），读者拿到的始终是完整的一致版本。
+
+    `etag_source` 用于从非 JSON 值（如索引对象）中取出参与 ETag 计算的内容，默认使用值本身。
+    """
+    def __init__(self, name: str, loader: Callable[[], Awaitable[Any]], version_name: Optional[str] = None, check_interval: Optional[float] = None, ttl: Optional[float] = None, etag_source: Optional[Callable[[Any], Any]] = None):
+        self.name = name
+        self.loader = loader
+        self.etag_source = etag_source
+        self.version_name = version_name or name
+        self.check_interval = check_interval if check_interval is not None else _env_float('REF_VERSION_CHECK_INTERVAL', 5.0)
+        self.ttl = ttl if ttl is not None else _env_float('REF_CACHE_TTL', 600.0)
+        self._snapshot: Optional[CacheSnapshot] = None
+        self._checked_at = 0.0
+        self._loaded_at = 0.0
+        self._invalidated = False
+        self._lock = asyncio.Lock()
+        self.stats = {'reloads': 0, 'failures': 0, 'stale_served': 0}
+
+    @property
+    def snapshot(self) -> Optional[CacheSnapshot]:
+        return self._snapshot
+
+    def invalidate(self) -> None:
+        """标记快照过期：下一次 `get()` 会重新加载（加载失败时仍可回退到当前快照）。"""
+        self._invalidated = True
+
+    def _fresh(self, now: float) -> bool:
+        return (not self._invalidated
+                and now - self._checked_at < self.check_interval
+                and now - self._loaded_at < self.ttl)
+
+    async def _current_version(self) -> int:
+        from postgres_data import adapter as pg_adapter
+
+        return await pg_adapter.get_data_version(self.version_name)
+
+    async def get(self) -> CacheSnapshot:
+        snap = self._snapshot
+        if snap is not None and (self._fresh(time.monotonic()) or self._lock.locked()):
+            return snap
+        async with self._lock:
+            if self._snapshot is not None and self._fresh(time.monotonic()):
+                return self._snapshot
+            return await self._refresh()
+
+    async def _refresh(self) -> CacheSnapshot:
+        snap = self._snapshot
+        try:
+            version = await self._current_version()
+            now = time.monotonic()
+            if snap is None or snap.version != version or self._invalidated or now - self._loaded_at >= self.ttl:
+                # 先清除失效标记：加载期间的新 invalidate() 会在下一轮生效
+                self._invalidated = False
+                value = await self.loader()
+                tagged = self.etag_source(value) if self.etag_source else value
+                snap = CacheSnapshot(version, value, compute_etag(self.name, version, tagged), time.time())
+                self._snapshot = snap
+                self._loaded_at = time.monotonic()
+                self.stats['reloads'] += 1
+                logger.info("VersionedCache[%s]: 已重建 version=%s", self.name, version)
+            self._checked_at = time.monotonic()
+            return snap
+        except Exception:
+            self.stats['failures'] += 1
+            if snap is None:
+                raise
+            self.stats['stale_served'] += 1
+            # 暂不重试，check_interval 后再试；期间继续使用上一份快照
+            self._checked_at = time.monotonic()
+            logger.exception("VersionedCache[%s]: 刷新失败，继续使用 version=%s 的快照", self.name, snap.version)
+            return snap
+
+
+class DerivedCache:
+    """由某个 `VersionedCache` 的快照派生出的只读结构（如倒排索引）。
+
+    源快照对象变化时（按引用判断）在线程中重新执行 `build`，不额外访问数据库；
+    重建期间其它请求继续读取上一份派生结果。
+    """
+    def __init__(self, source: VersionedCache, build: Callable[[Any], Any]):
+        self.source = source
+        self.build = build
+        self._built: Optional[Tuple[CacheSnapshot, Any]] = None
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> Any:
+        src = await self.source.get()
+        built = self._built
+        if built is not None and (built[0] is src or self._lock.locked()):
+            return built[1]
+        async with self._lock:
+            built = self._built
+            if built is None or built[0] is not src:
+                value = await asyncio.to_thread(self.build, src.value)
+                built = (src, value)
+                self._built = built
+            return built[1]
@@ -0,0 +1,395 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_SEGMENT_RE = re.compile(r'^seg-(\d{9})\.jsonl$')
+
+FSYNC_NONE = 'none'
+FSYNC_INTERVAL = 'interval'
+FSYNC_BATCH = 'batch'
+
+# 一次组提交最多合并的操作数（每个操作是一次 put / ack 调用）
+GROUP_COMMIT_MAX_OPS = 4096
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, str(default)))
+    except Exception:
+        return default
+
+
+class RetryLog:
+    """重试队列的分段追加日志（替代整文件重写的 pending_messages.jsonl）。
+
+    目录下为按序编号的段文件 `seg-000000001.jsonl`，每行一条记录：
+    - `{"op": "put", "item": {...}}`：入队或更新（重试计数变化时再写一条，后写覆盖先写）；
+    - `{"op": "ack", "id": "..."}`：墓碑，表示该消息已写入 DB 或转入死信。
+
+    入队、确认、重试更新都只是在活动段末尾追加一行（O(1)）；活动段超过
+    `MSG_RETRY_SEGMENT_BYTES`（默认 4MB）时滚动到新段。内存中记录每条存活消息最新的 put 所在段，
+    以及每段的存活数：
+    - 最旧的段没有存活消息时直接删除。只从最旧的段开始删，保证被删段中的墓碑所指向的 put
+      都在更旧（已删除）的段里，重放时不会“复活”；
+    - `compact()` 把存活比例不超过 `MSG_RETRY_COMPACT_RATIO`（默认 0.5）的最旧段中的存活消息
+      重新追加到活动段，使其可以删除，避免少量长期重试的消息拖住整个日志；全部确认后连同
+      活动段一起清空。
+
+    重放时按段顺序应用记录，返回按 `seq` 排序的存活消息；末尾写了一半的行（崩溃）会被跳过。
+    方法线程安全（调用方通过 asyncio.to_thread 调用）。
+    """
+    def __init__(self, directory: str, segment_bytes: Optional[int] = None, compact_ratio: Optional[float] = None):
+        self.directory = directory
+        self.segment_bytes = max(1024, segment_bytes if segment_bytes is not None else _env_int('MSG_RETRY_SEGMENT_BYTES', 4 * 1024 * 1024))
+        self.compact_ratio = compact_ratio if compact_ratio is not None else _env_float('MSG_RETRY_COMPACT_RATIO', 0.5)
+        self._lock = threading.Lock()
+        self._segments: List[int] = []
+        self._active = None
+        self._active_size = 0
+        self._items: Dict[str, Dict[str, Any]] = {}
+        self._where: Dict[str, int] = {}
+        self._seg_live: Dict[int, int] = {}
+        self._seg_records: Dict[int, int] = {}
+        # 为 True 时滚动前先 fsync 旧段（由 RetryLogWriter 按 fsync 策略设置）
+        self.durable = False
+        self.stats = {'puts': 0, 'acks': 0, 'writes': 0, 'fsyncs': 0, 'segments_created': 0, 'segments_deleted': 0, 'compacted_items': 0}
+
+    # ---- 段文件 ----
+
+    def _path(self, no: int) -> str:
+        return os.path.join(self.directory, f'seg-{no:09d}.jsonl')
+
+    def _roll(self) -> None:
+        if self._active is not None:
+            if self.durable:
+                self._fsync()
+            self._active.close()
+        no = (self._segments[-1] + 1) if self._segments else 1
+        self._segments.append(no)
+        self._seg_live[no] = 0
+        self._seg_records[no] = 0
+        self._active = open(self._path(no), 'a', encoding='utf-8')
+        self._active_size = 0
+        self.stats['segments_created'] += 1
+
+    def _write(self, records: Iterable[Dict[str, Any]]) -> None:
+        lines = []
+        for rec in records:
+            lines.append(json.dumps(rec, ensure_ascii=False) + '\n')
+        if not lines:
+            return
+        data = ''.join(lines)
+        self._active.write(data)
+        self._active.flush()
+        self._active_size += len(data.encode('utf-8'))
+        self.stats['writes'] += 1
+
+    def _fsync(self) -> None:
+        os.fsync(self._active.fileno())
+        self.stats['fsyncs'] += 1
+
+    def _drop_dead_head(self) -> None:
+        while len(self._segments) > 1 and self._seg_live.get(self._segments[0], 0) <= 0:
+            no = self._segments.pop(0)
+            self._seg_live.pop(no, None)
+            self._seg_records.pop(no, None)
+            try:
+                os.remove(self._path(no))
+            except FileNotFoundError:
+                pass
+            self.stats['segments_deleted'] += 1
+
+    # ---- 打开 / 重放 ----
+
+    def open(self) -> List[Dict[str, Any]]:
+        """读取目录中的全部段并重建索引，返回按 `seq` 排序的存活消息。"""
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            nos = sorted(int(m.group(1)) for m in (_SEGMENT_RE.match(n) for n in os.listdir(self.directory)) if m)
+            for no in nos:
+                self._segments.append(no)
+                self._seg_live.setdefault(no, 0)
+                self._seg_records[no] = 0
+                with open(self._path(no), 'r', encoding='utf-8') as f:
+                    for lineno, line in enumerate(f, 1):
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            rec = json.loads(line)
+                        except Exception:
+                            logger.warning("RetryLog: 跳过损坏的记录 %s:%s", self._path(no), lineno)
+                            continue
+                        self._seg_records[no] += 1
+                        if rec.get('op') == 'put':
+                            self._apply_put(rec['item'], no)
+                        elif rec.get('op') == 'ack':
+                            self._apply_ack(rec.get('id'))
+            if self._segments:
+                no = self._segments[-1]
+                self._truncate_torn_tail(self._path(no))
+                self._active = open(self._path(no), 'a', encoding='utf-8')
+                self._active_size = os.path.getsize(self._path(no))
+            else:
+                self._roll()
+            self._drop_dead_head()
+            return sorted(self._items.values(), key=lambda it: it.get('seq', 0))
+
+    @staticmethod
+    def _truncate_torn_tail(path: str) -> None:
+        """截掉末尾没有换行的半行（崩溃时写了一半），否则后续追加会接在它后面、一起被当作损坏记录丢弃。"""
+        with open(path, 'rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                step = min(4096, pos)
+                f.seek(pos - step)
+                chunk = f.read(step)
+                idx = chunk.rfind(b'\n')
+                if idx >= 0:
+                    pos = pos - step + idx + 1
+                    break
+                pos -= step
+            if pos < end:
+                logger.warning("RetryLog: 截掉 %s 末尾不完整的 %s 字节", path, end - pos)
+                f.truncate(pos)
+
+    def _apply_put(self, item: Dict[str, Any], no: int) -> None:
+        obj_id = item['id']
+        old = self._where.get(obj_id)
+        if old is not None:
+            self._seg_live[old] -= 1
+        self._items[obj_id] = item
+        self._where[obj_id] = no
+        self._seg_live[no] = self._seg_live.get(no, 0) + 1
+
+    def _apply_ack(self, obj_id: Optional[str]) -> bool:
+        no = self._where.pop(obj_id, None)
+        if no is None:
+            return False
+        self._items.pop(obj_id, None)
+        self._seg_live[no] -= 1
+        return True
+
+    # ---- 追加 ----
+
+    def _apply_ops(self, ops: List[Tuple[str, list]]) -> None:
+        if self._active_size >= self.segment_bytes:
+            self._roll()
+        no = self._segments[-1]
+        records: List[Dict[str, Any]] = []
+        for op, arg in ops:
+            if op == 'put':
+                for it in arg:
+                    self._apply_put(it, no)
+                    records.append({'op': 'put', 'item': it})
+            else:
+                done = [i for i in arg if self._apply_ack(i)]
+                records.extend({'op': 'ack', 'id': i} for i in done)
+                self.stats['acks'] += len(done)
+        self._write(records)
+        self._seg_records[no] += len(records)
+        self._drop_dead_head()
+
+    def apply(self, ops: List[Tuple[str, list]]) -> None:
+        """把一组 `('put', items)` / `('ack', ids)` 操作按顺序合并成一次写入（组提交）。"""
+        with self._lock:
+            self._apply_ops(ops)
+            self.stats['puts'] += sum(len(arg) for op, arg in ops if op == 'put')
+
+    def put(self, items: List[Dict[str, Any]]) -> None:
+        """追加（或覆盖）若干条消息。"""
+        self.apply([('put', items)])
+
+    def ack(self, ids: List[str]) -> None:
+        """为已完成（写入 DB 或转入死信）的消息追加墓碑；未知 id 忽略。"""
+        self.apply([('ack', ids)])
+
+    def sync(self) -> None:
+        """fsync 活动段。"""
+        with self._lock:
+            if self._active is not None:
+                self._fsync()
+
+    def compact(self) -> int:
+        """把稀疏的最旧段中的存活消息搬到活动段并删除这些段，返回搬移的消息数。"""
+        moved = 0
+        with self._lock:
+            while len(self._segments) > 1:
+                head = self._segments[0]
+                live, records = self._seg_live.get(head, 0), self._seg_records.get(head, 0)
+                if live > 0 and records and live / records > self.compact_ratio:
+                    break
+                items = [self._items[i] for i, no in self._where.items() if no == head]
+                if items:
+                    self._apply_ops([('put', items)])
+                    moved += len(items)
+                self._drop_dead_head()
+            if not self._items and self._active_size > 0:
+                # 已全部确认：换一个空段，旧的活动段随之删除
+                self._roll()
+                self._drop_dead_head()
+            self.stats['compacted_items'] += moved
+        return moved
+
+    def close(self) -> None:
+        with self._lock:
+            if self._active is not None:
+                if self.durable:
+                    self._fsync()
+                self._active.close()
+                self._active = None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            disk = 0
+            for no in self._segments:
+                try:
+                    disk += os.path.getsize(self._path(no))
+                except OSError:
+                    pass
+            return {'pending': len(self._items), 'segments': len(self._segments), 'disk_bytes': disk, **self.stats}
+
+
+class RetryLogWriter:
+    """`RetryLog` 的组提交写入器：一个常驻任务持有日志（段文件保持打开），
+    把并发的 put / ack 合并成一次 `write()`，再按 `MSG_RETRY_FSYNC` 决定是否 fsync：
+
+    - `none`：只写入页缓存（进程崩溃不丢，机器掉电可能丢最近的写入）；
+    - `interval`（默认）：距上次 fsync 超过 `MSG_RETRY_FSYNC_INTERVAL` 秒（默认 1.0）时随批 fsync，
+      空闲时也会在该间隔内补一次，最多丢失一个间隔内的写入；
+    - `batch`：每次组提交都 fsync，`put()` / `ack()` 返回即已落盘。
+
+    调用方 `await put()` / `await ack()` 在所属批次写入（及按策略 fsync）后返回；写入失败时抛出该异常。
+    写入期间到达的操作自然进入下一批，因此吞吐由磁盘带宽而不是每次 open/close 的系统调用决定。
+    未启动时直接在线程中同步写入。
+    """
+    def __init__(self, log: RetryLog, fsync: Optional[str] = None, fsync_interval: Optional[float] = None):
+        self.log = log
+        self.fsync = (fsync or os.environ.get('MSG_RETRY_FSYNC', FSYNC_INTERVAL)).strip().lower()
+        if self.fsync not in (FSYNC_NONE, FSYNC_INTERVAL, FSYNC_BATCH):
+            logger.warning("RetryLogWriter: 未知的 MSG_RETRY_FSYNC=%r，按 %s 处理", self.fsync, FSYNC_INTERVAL)
+            self.fsync = FSYNC_INTERVAL
+        self.fsync_interval = fsync_interval if fsync_interval is not None else _env_float('MSG_RETRY_FSYNC_INTERVAL', 1.0)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._dirty = False
+        self._last_sync = time.monotonic()
+        self.stats = {'ops': 0, 'commits': 0, 'largest_commit': 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self.log.durable = self.fsync != FSYNC_NONE
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """写完已提交的操作并 fsync 后退出。"""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        await self._queue.put(None)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        if self._dirty and self.fsync != FSYNC_NONE:
+            await asyncio.to_thread(self.log.sync)
+            self._dirty = False
+
+    async def put(self, items: List[Dict[str, Any]]) -> None:
+        await self._submit('put', items)
+
+    async def ack(self, ids: List[str]) -> None:
+        await self._submit('ack', ids)
+
+    async def _submit(self, op: str, arg: list) -> None:
+        if not self.running:
+            await asyncio.to_thread(self.log.apply, [(op, arg)])
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, arg, fut))
+        await fut
+
+    async def _run(self) -> None:
+        queue = self._queue
+        stopping = False
+        while not stopping:
+            timeout = None
+            if self._dirty and self.fsync == FSYNC_INTERVAL:
+                timeout = max(0.0, self._last_sync + self.fsync_interval - time.monotonic())
+            try:
+                first = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                # 空闲：补做到期的 fsync
+                await self._sync()
+                continue
+            if first is None:
+                break
+            batch = [first]
+            while len(batch) < GROUP_COMMIT_MAX_OPS and not queue.empty():
+                nxt = queue.get_nowait()
+                if nxt is None:
+                    stopping = True
+                    break
+                batch.append(nxt)
+            await self._commit(batch)
+
+    async def _commit(self, batch: list) -> None:
+        try:
+            sync = self.fsync == FSYNC_BATCH or (self.fsync == FSYNC_INTERVAL and time.monotonic() - self._last_sync >= self.fsync_interval)
+            await asyncio.to_thread(self._write_batch, [(op, arg) for op, arg, _ in batch], sync)
+        except Exception as exc:
+            logger.exception("RetryLogWriter: 组提交 %s 个操作失败", len(batch))
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        self.stats['ops'] += len(batch)
+        self.stats['commits'] += 1
+        self.stats['largest_commit'] = max(self.stats['largest_commit'], len(batch))
+        for _, _, fut in batch:
+            if not fut.done():
+                fut.set_result(None)
+
+    def _write_batch(self, ops: List[Tuple[str, list]], sync: bool) -> None:
+        self.log.apply(ops)
+        if sync:
+            self.log.sync()
+            self._last_sync = time.monotonic()
+            self._dirty = False
+        else:
+            self._dirty = True
+
+    async def _sync(self) -> None:
+        try:
+            await asyncio.to_thread(self.log.sync)
+            self._last_sync = time.monotonic()
+            self._dirty = False
+        except Exception:
+            logger.exception("RetryLogWriter: fsync 失败")
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'fsync': self.fsync, 'queued': self._queue.qsize() if self._queue is not None else 0, **self.stats}
@@ -10,10 +10,11 @@ import os
 
 # 管理脚本改为直接使用 Postgres 的同步 session（移除对 pickle 的依赖）
 try:
-    from postgres_data.adapter import _get_sync_session
+    from postgres_data.adapter import _get_sync_session, fetch_posts_rows_sync
     PG_SYNC_AVAILABLE = True
 except Exception:
     _get_sync_session = None
+    fetch_posts_rows_sync = None
     PG_SYNC_AVAILABLE = False
 # 不再使用本地 pkl 文件；所有数据读写通过 Postgres 完成
 
@@ -60,49 +61,10 @@ def _fetch_all_users_sync() -> list:
 
 
 def _fetch_all_posts_sync() -> list:
-    if not PG_SYNC_AVAILABLE or _get_sync_session is None:
-        return []
-    session = None
-    try:
-        session = _get_sync_session()
-        from postgres_data.models import Post, Comment, User
-        posts = session.query(Post).all()
-        out = []
-        for p in posts:
-            comments_q = session.query(Comment).filter(Comment.post_id == p.id).all()
-            comments_list = []
-            for c in comments_q:
-                comments_list.append({
-                    'id': c.id,
-                    'post_id': c.post_id,
-                    'author': c.author_name,
-                    'content': c.content,
-                    'time': str(c.created_at),
-                })
-            author_name = None
-            if getattr(p, 'author_id', None) is not None:
-                u = session.query(User).filter(User.id == p.author_id).first()
-                if u:
-                    author_name = getattr(u, 'username', None)
-            out.append({
-                'id': p.id,
-                'author': author_name,
-                'title': getattr(p, 'title', ''),
-                'content': getattr(p, 'content', ''),
-                'section': getattr(p, 'section', ''),
-                'time': str(getattr(p, 'created_at', None)),
-                'comments': comments_list,
-            })
-        return out
-    except Exception as e:
-        print(f"fetch_all_posts_sync failed: {e}")
+    if not PG_SYNC_AVAILABLE or fetch_posts_rows_sync is None:
         return []
-    finally:
-        try:
-            if session:
-                session.close()
-        except Exception:
-            pass
+    # 作者与评论由 adapter 批量加载（2 条语句），避免逐帖查询
+    return fetch_posts_rows_sync()
 
 
 def _fetch_personal_messages_sync() -> list: